@@ -1,13 +1,19 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Boolean, LargeBinary, ForeignKey, func, Text
+from sqlalchemy import create_engine, event, select, insert, delete, Column, Integer, String, DateTime, Float, Boolean, LargeBinary, ForeignKey, func, Text, Index, and_, or_
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, defer
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from functools import lru_cache
+import atexit
 import os
+import queue
+import threading
+import time
 import datetime
+import uuid
 import logging
 from pathlib import Path
 import shutil
 import zipfile
-import tempfile
 import json
 
 # Configure logging
@@ -20,8 +26,52 @@ os.makedirs(DB_DIR, exist_ok=True)
 # Database file path
 DB_PATH = os.path.join(DB_DIR, 'smartnvr.db')
 
+# Recordings deleted per retention transaction
+RETENTION_BATCH_SIZE = 500
+
+# Recording content in the database is split into chunks of this size...
+CONTENT_CHUNK_SIZE = 1024 * 1024
+# ...and written this many chunks per transaction
+CONTENT_CHUNKS_PER_WRITE = 8
+
+# Export jobs save their progress (bytes copied so far) at most this often, in seconds
+EXPORT_PROGRESS_INTERVAL = 1.0
+
+# Applied to every SQLite connection. WAL lets readers run alongside the
+# writer; synchronous=NORMAL is safe with WAL (a power loss can only drop the
+# last commits, never corrupt the database).
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 10000,  # ms to wait for a lock before "database is locked"
+    'temp_store': 'MEMORY',
+    'cache_size': -32000,  # KiB of page cache per connection
+    'mmap_size': 256 * 1024 * 1024,
+    'wal_autocheckpoint': 1000  # Pages
+}
+
+# Read connections kept open (each thread checks one out per session)
+READ_POOL_SIZE = 8
+READ_POOL_OVERFLOW = 16
+
+# Writer thread batching: jobs committed together per transaction
+WRITE_BATCH_SIZE = 200
+WRITE_BATCH_DELAY = 0.05  # Seconds to wait for more jobs before committing
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
 # Create SQLAlchemy engine
-engine = create_engine(f'sqlite:///{DB_PATH}', connect_args={'check_same_thread': False})
+engine = create_engine(f'sqlite:///{DB_PATH}', connect_args={'check_same_thread': False},
+                       pool_size=READ_POOL_SIZE, max_overflow=READ_POOL_OVERFLOW)
+event.listen(engine, 'connect', _set_sqlite_pragmas)
 Base = declarative_base()
 Session = sessionmaker(bind=engine)
 
@@ -37,9 +87,8 @@ class Recording(Base):
     size_bytes = Column(Integer, default=0)
     format = Column(String(10), default='mp4')
     path = Column(String(255), nullable=True)  # Physical path for hybrid storage
-    content = Column(LargeBinary, nullable=True)  # Binary content for full DB storage
     has_file = Column(Boolean, default=False)  # Indicates if recording exists as file
-    has_content = Column(Boolean, default=False)  # Indicates if content stored in DB
+    has_content = Column(Boolean, default=False)  # Indicates if content stored in DB (recording_chunks)
     
     # Metadata
     width = Column(Integer, nullable=True)
@@ -51,14 +100,254 @@ class Recording(Base):
     event_id = Column(String(36), nullable=True)
     tags = Column(Text, nullable=True)  # JSON serialized tags
     
+    __table_args__ = (
+        # Playback lists one camera's recordings by time
+        Index('ix_recordings_stream_timestamp', 'stream_id', 'timestamp'),
+        # Recordings are looked up by file path (backfill, file serving)
+        Index('ix_recordings_path', 'path'),
+    )
+    
     def __repr__(self):
         return f"Recording(id={self.id}, camera={self.camera_name}, timestamp={self.timestamp})"
 
 
+class RecordingChunk(Base):
+    """Binary content of a recording stored in the database, in CONTENT_CHUNK_SIZE pieces
+    
+    Kept out of the recordings table so metadata queries never load video
+    data, and so content can be written and read (including byte ranges)
+    one chunk at a time.
+    """
+    __tablename__ = 'recording_chunks'
+    
+    recording_id = Column(Integer, ForeignKey('recordings.id'), primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+
+class StorageUsage(Base):
+    """Running byte and file totals of indexed recordings per camera and volume
+    
+    Updated in the same transaction as every recording insert and delete, so
+    retention and the monitor read the archive size without walking it.
+    """
+    __tablename__ = 'storage_usage'
+    
+    stream_id = Column(String(36), primary_key=True)
+    volume = Column(String(255), primary_key=True)  # Mount point holding the files
+    bytes = Column(Integer, default=0)
+    recordings = Column(Integer, default=0)
+
+
+class RecordingThumbnails(Base):
+    """Keyframe sprite sheet of a recording, for previews and scrubbing
+    
+    The sprite is one JPEG with `columns` x `rows` tiles of tile_width x
+    tile_height pixels, in time order; `times` is a JSON list with the offset
+    (seconds into the recording) of each tile. Rows with `error` set mark
+    recordings the sprite could not be made for, so they aren't retried.
+    """
+    __tablename__ = 'recording_thumbnails'
+    
+    recording_id = Column(Integer, ForeignKey('recordings.id'), primary_key=True)
+    sprite = Column(LargeBinary, nullable=True)
+    columns = Column(Integer, default=0)
+    rows = Column(Integer, default=0)
+    tile_width = Column(Integer, default=0)
+    tile_height = Column(Integer, default=0)
+    interval = Column(Float, default=0.0)  # Seconds between tiles
+    times = Column(Text, nullable=True)  # JSON list of tile offsets in seconds
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'columns': self.columns,
+            'rows': self.rows,
+            'tile_width': self.tile_width,
+            'tile_height': self.tile_height,
+            'interval': self.interval,
+            'times': json.loads(self.times) if self.times else []
+        }
+
+
+class ExportJob(Base):
+    """A queued or running export of a time range of recordings
+    
+    Jobs are picked up by the export workers oldest first. The recordings to
+    copy are fixed when the job is created (see ExportJobFile), so progress
+    and totals are by files and bytes of that list.
+    """
+    __tablename__ = 'export_jobs'
+    
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    
+    id = Column(String(36), primary_key=True)
+    status = Column(String(20), nullable=False, default=QUEUED, index=True)
+    format = Column(String(10), default='zip')  # 'zip' or 'directory'
+    start_date = Column(DateTime, nullable=False)
+    end_date = Column(DateTime, nullable=False)
+    stream_ids = Column(Text, nullable=True)  # JSON list, None for all cameras
+    output_path = Column(String(255), nullable=False)
+    
+    # Progress
+    total_files = Column(Integer, default=0)
+    total_bytes = Column(Integer, default=0)
+    copied_files = Column(Integer, default=0)
+    copied_bytes = Column(Integer, default=0)  # Includes the part of the file being copied
+    missing_files = Column(Integer, default=0)  # Recordings deleted before they were copied
+    
+    cancel_requested = Column(Boolean, default=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    
+    def to_dict(self):
+        done = self.copied_bytes or 0
+        return {
+            'id': self.id,
+            'status': self.status,
+            'format': self.format,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'stream_ids': json.loads(self.stream_ids) if self.stream_ids else None,
+            'filename': os.path.basename(self.output_path),
+            'total_files': self.total_files,
+            'total_bytes': self.total_bytes,
+            'copied_files': self.copied_files,
+            'copied_bytes': done,
+            'missing_files': self.missing_files,
+            'progress': 1.0 if self.status == self.COMPLETED else (
+                round(min(1.0, done / self.total_bytes), 4) if self.total_bytes else 0.0),
+            'cancel_requested': bool(self.cancel_requested),
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class ExportJobFile(Base):
+    """One recording of an export job - the job's manifest
+    
+    Rows are created with the job, with the recording's metadata copied so
+    the export can be finished even if retention deletes the recording. Once
+    a recording is in the output (flushed to disk) its row is marked copied,
+    with its zip entry's offsets and CRC for zip exports; a resumed job skips
+    copied rows and, for zips, truncates the archive after the last of them.
+    """
+    __tablename__ = 'export_job_files'
+    
+    PENDING = 'pending'
+    COPIED = 'copied'
+    MISSING = 'missing'
+    
+    job_id = Column(String(36), ForeignKey('export_jobs.id'), primary_key=True)
+    seq = Column(Integer, primary_key=True)  # Order in the export
+    recording_id = Column(Integer, nullable=False)
+    filename = Column(String(255), nullable=False)
+    stream_id = Column(String(36), nullable=False)
+    camera_name = Column(String(100), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    duration = Column(Float, default=0.0)
+    format = Column(String(10), default='mp4')
+    size_bytes = Column(Integer, default=0)  # Actual size once copied
+    status = Column(String(10), nullable=False, default=PENDING)
+    
+    # Zip entry, for resuming zip exports
+    crc = Column(Integer, nullable=True)
+    header_offset = Column(Integer, nullable=True)
+    end_offset = Column(Integer, nullable=True)
+    
+    def to_entry(self):
+        """metadata.json entry of the recording (see export_entry())"""
+        return {
+            "id": self.recording_id,
+            "stream_id": self.stream_id,
+            "camera_name": self.camera_name,
+            "timestamp": self.timestamp.isoformat(),
+            "duration": self.duration,
+            "size_bytes": self.size_bytes,
+            "format": self.format,
+            "filename": self.filename
+        }
+
+
+def _migrate_recording_indexes(connection):
+    """Add the (stream_id, timestamp) and path indexes to recordings"""
+    for index in Recording.__table__.indexes:
+        index.create(connection, checkfirst=True)
+    # Give the query planner statistics for the new indexes
+    connection.exec_driver_sql("ANALYZE recordings")
+
+
+def _migrate_content_to_chunks(connection):
+    """Move recording content from recordings.content to recording_chunks"""
+    columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(recordings)")]
+    if 'content' not in columns:
+        return
+    
+    ids = [row[0] for row in connection.exec_driver_sql("SELECT id FROM recordings WHERE content IS NOT NULL")]
+    for recording_id in ids:
+        # substr() copies one chunk at a time instead of loading the whole blob here
+        length = connection.exec_driver_sql(
+            "SELECT length(content) FROM recordings WHERE id = ?", (recording_id,)).scalar()
+        for seq, offset in enumerate(range(0, length, CONTENT_CHUNK_SIZE)):
+            data = connection.exec_driver_sql(
+                "SELECT substr(content, ?, ?) FROM recordings WHERE id = ?",
+                (offset + 1, CONTENT_CHUNK_SIZE, recording_id)).scalar()
+            connection.exec_driver_sql(
+                "INSERT INTO recording_chunks (recording_id, seq, data) VALUES (?, ?, ?)", (recording_id, seq, data))
+        connection.exec_driver_sql(
+            "UPDATE recordings SET content = NULL, has_content = 1 WHERE id = ?", (recording_id,))
+    
+    if ids:
+        logger.info(f"Moved the content of {len(ids)} recordings to recording_chunks")
+    try:
+        connection.exec_driver_sql("ALTER TABLE recordings DROP COLUMN content")
+    except Exception as e:
+        # SQLite before 3.35 can't drop columns; the emptied column is harmless
+        logger.warning(f"Could not drop recordings.content: {e}")
+
+
+# Schema upgrades for existing databases, in order: MIGRATIONS[n] takes the
+# schema from version n to n + 1 (stored in PRAGMA user_version). New tables
+# need no step - create_all() adds them - but new indexes and columns on
+# existing tables do.
+MIGRATIONS = [
+    _migrate_recording_indexes,
+    _migrate_content_to_chunks,
+]
+
+
+def migrate_db():
+    """Upgrade the schema of an existing database in place"""
+    with engine.begin() as connection:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Migrating database to schema version {target}: {migration.__doc__}")
+            migration(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {target}")
+
+
 def init_db():
     """Initialize the database"""
     try:
         Base.metadata.create_all(engine)
+        migrate_db()
+        # Databases from before storage accounting start with the current totals
+        session = get_session()
+        try:
+            needs_usage = session.query(StorageUsage).first() is None and session.query(Recording.id).first() is not None
+        finally:
+            session.close()
+        if needs_usage:
+            rebuild_storage_usage()
         logger.info(f"Database initialized at {DB_PATH}")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
@@ -70,21 +359,202 @@ def get_session():
     return Session()
 
 
-def store_recording(stream_id, camera_name, filepath, store_binary=False):
+class DatabaseWriter:
+    """The one thread that writes to the database
+    
+    SQLite allows a single writer at a time, so instead of every recorder
+    committing on its own (and waiting on each other's locks), writes are
+    queued as jobs - callables taking a session - and this thread commits
+    whatever has queued up, up to WRITE_BATCH_SIZE jobs, in one transaction.
+    If a batch fails, its jobs are retried one per transaction so a bad
+    write doesn't take the others with it.
+    """
+    
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.jobs = 0
+    
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="db-writer")
+                self.thread.daemon = True
+                self.thread.start()
+    
+    def submit(self, job, callback=None, wait=False, timeout=None):
+        """Queue a write job
+        
+        Args:
+            job: Callable taking a session; it must not commit
+            callback: Called with the job's return value after the commit
+            wait: Block until the job is committed and return its value
+                (re-raising its exception, if it failed)
+            timeout: Seconds to wait at most when wait is set
+        """
+        self._ensure_started()
+        done = threading.Event() if wait else None
+        outcome = {}
+        self.queue.put((job, callback, done, outcome))
+        if not wait:
+            return None
+        if not done.wait(timeout):
+            raise TimeoutError("Database write not committed in time")
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome.get('value')
+    
+    def flush(self, timeout=None):
+        """Block until every job queued so far is committed"""
+        if self.thread is None and self.queue.empty():
+            return
+        self.submit(lambda session: None, wait=True, timeout=timeout)
+    
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        # Commit early when someone is waiting on a job in the batch
+        while len(batch) < self.batch_size and batch[-1][2] is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = self._collect()
+            session = Session(expire_on_commit=False)
+            try:
+                try:
+                    for job, _, _, outcome in batch:
+                        outcome['value'] = job(session)
+                    _write_usage(session)
+                    session.commit()
+                except Exception as e:
+                    session.rollback()
+                    session.info.pop('usage', None)
+                    if len(batch) > 1:
+                        logger.warning(f"Database write batch failed ({e}), retrying its {len(batch)} jobs one by one")
+                    for job, _, _, outcome in batch:
+                        outcome.pop('value', None)
+                        try:
+                            outcome['value'] = job(session)
+                            _write_usage(session)
+                            session.commit()
+                        except Exception as e:
+                            session.rollback()
+                            session.info.pop('usage', None)
+                            outcome['error'] = e
+                            logger.error(f"Database write failed: {e}")
+            finally:
+                session.close()
+            
+            self.batches += 1
+            self.jobs += len(batch)
+            for _, callback, done, outcome in batch:
+                if callback and 'error' not in outcome:
+                    try:
+                        callback(outcome.get('value'))
+                    except Exception as e:
+                        logger.error(f"Error in database write callback: {e}")
+                if done:
+                    done.set()
+
+
+writer = DatabaseWriter()
+# Don't lose queued writes on a clean shutdown
+atexit.register(writer.flush, 10)
+
+
+def flush_writes(timeout=None):
+    """Block until all queued database writes are committed"""
+    writer.flush(timeout)
+
+
+@lru_cache(maxsize=1024)
+def _directory_volume(directory):
+    path = os.path.abspath(directory)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def volume_for(filepath):
+    """Mount point of the filesystem a recording is (or was) stored on"""
+    if not filepath:
+        return ''
+    return _directory_volume(os.path.dirname(filepath))
+
+
+def _add_usage(session, deltas):
+    """Add {(stream_id, volume): [bytes, recordings]} changes to the storage totals
+    
+    The changes are collected on the session and written by _write_usage()
+    when the writer commits, so a batch costs one update per camera and
+    volume rather than one per recording.
+    """
+    pending = session.info.setdefault('usage', {})
+    for key, (size, count) in deltas.items():
+        total = pending.setdefault(key, [0, 0])
+        total[0] += size
+        total[1] += count
+
+
+def _write_usage(session):
+    for (stream_id, volume), (size, count) in session.info.pop('usage', {}).items():
+        statement = sqlite_insert(StorageUsage).values(stream_id=stream_id, volume=volume, bytes=size, recordings=count)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['stream_id', 'volume'],
+            set_={'bytes': StorageUsage.bytes + size, 'recordings': StorageUsage.recordings + count}
+        ))
+
+
+def _usage_deltas(rows, sign=1):
+    """Storage total changes for (stream_id, path, size_bytes) rows"""
+    deltas = {}
+    for stream_id, path, size in rows:
+        delta = deltas.setdefault((stream_id, volume_for(path)), [0, 0])
+        delta[0] += sign * (size or 0)
+        delta[1] += sign
+    return deltas
+
+
+def store_recording(stream_id, camera_name, filepath, store_binary=False, timestamp=None, duration=None,
+                    event_id=None, tags=None, on_stored=None, wait=False):
     """Store recording information in database
     
+    The row is written by the writer thread. Without wait, this returns as
+    soon as the row is queued, and its id is only set once it is committed
+    (on_stored is then called with the recording).
+    
     Args:
         stream_id: ID of the stream
         camera_name: Name of the camera
         filepath: Path to the recording file
-        store_binary: Whether to store the binary content in DB (hybrid mode if False)
+        store_binary: Whether to also store the file's content in the database
+            (streamed into recording_chunks; blocks until it is written)
+        timestamp: Start time of the recording (defaults to the file's mtime)
+        duration: Duration in seconds, if known
+        event_id: ID of the event the recording belongs to (event clips)
+        tags: List of tags, e.g. the detected labels of an event clip
+        on_stored: Optional callback receiving the Recording after it is committed
+        wait: Block until the row is committed
         
     Returns:
-        Recording object
+        Recording object, or None on failure
     """
     try:
-        session = get_session()
-        
         # Get file information
         file_path = Path(filepath)
         if not file_path.exists():
@@ -98,34 +568,386 @@ def store_recording(stream_id, camera_name, filepath, store_binary=False):
         recording = Recording(
             stream_id=stream_id,
             camera_name=camera_name,
-            timestamp=file_mtime,
+            timestamp=timestamp or file_mtime,
+            duration=duration or 0.0,
             size_bytes=file_size,
             format=file_path.suffix[1:],  # Remove the dot
             path=str(filepath),
-            has_file=True
+            has_file=True,
+            event_id=event_id,
+            tags=json.dumps(tags) if tags is not None else None
         )
         
-        # Store binary content if requested (hybrid mode)
-        if store_binary:
-            with open(filepath, 'rb') as f:
-                recording.content = f.read()
-                recording.has_content = True
+        def insert(session):
+            session.add(recording)
+            _add_usage(session, _usage_deltas([(stream_id, recording.path, file_size)]))
+            return recording
         
-        # Save to database
-        session.add(recording)
-        session.commit()
+        def stored(recording):
+            logger.info(f"Recording stored in database: {recording}")
+            if on_stored:
+                on_stored(recording)
         
-        logger.info(f"Recording stored in database: {recording}")
+        if store_binary:
+            # The content is written after the row, so it needs the row's ID
+            writer.submit(insert, wait=True)
+            write_recording_content(recording.id, filepath)
+            stored(recording)
+            return recording
+        
+        writer.submit(insert, callback=stored, wait=wait)
         return recording
         
     except Exception as e:
         logger.error(f"Failed to store recording: {e}")
-        if session:
-            session.rollback()
         return None
+
+
+def add_recordings(entries, batch_size=1000):
+    """Register many existing recording files at once (metadata only)
+    
+    Args:
+        entries: Iterable of dicts with Recording column values
+        batch_size: Rows inserted per transaction
+        
+    Returns:
+        Number of recordings added
+    """
+    added = 0
+    try:
+        def insert(batch):
+            def job(session):
+                session.bulk_insert_mappings(Recording, batch)
+                _add_usage(session, _usage_deltas(
+                    (entry['stream_id'], entry.get('path'), entry.get('size_bytes')) for entry in batch))
+            # Waiting per batch keeps a large backfill from piling up in the queue
+            writer.submit(job, wait=True)
+            return len(batch)
+        
+        batch = []
+        for entry in entries:
+            batch.append(dict(entry, has_file=True))
+            if len(batch) >= batch_size:
+                added += insert(batch)
+                batch = []
+        if batch:
+            added += insert(batch)
+        return added
+    except Exception as e:
+        logger.error(f"Failed to add recordings: {e}")
+        return added
+
+
+def get_recording_dates(stream_id=None):
+    """Get the days that have recordings, newest first
+    
+    Uses one index seek per day rather than scanning every recording.
+    
+    Args:
+        stream_id: Optional stream ID to filter by
+        
+    Returns:
+        List of datetime.date objects
+    """
+    session = get_session()
+    try:
+        dates = []
+        upper = None
+        while True:
+            query = session.query(Recording.timestamp)
+            if stream_id:
+                query = query.filter(Recording.stream_id == stream_id)
+            if upper is not None:
+                query = query.filter(Recording.timestamp < upper)
+            latest = query.order_by(Recording.timestamp.desc()).limit(1).scalar()
+            if latest is None:
+                break
+            dates.append(latest.date())
+            # Continue below the start of that day
+            upper = datetime.datetime.combine(latest.date(), datetime.time.min)
+        return dates
+    except Exception as e:
+        logger.error(f"Failed to get recording dates: {e}")
+        return []
     finally:
-        if session:
+        session.close()
+
+
+def get_recordings_for_day(day, stream_id=None, camera_name=None):
+    """Get one day's recordings, newest first
+    
+    Args:
+        day: datetime.date
+        stream_id: Optional stream ID to filter by
+        camera_name: Optional camera name to filter by (case-insensitive)
+        
+    Returns:
+        List of Recording objects
+    """
+    start = datetime.datetime.combine(day, datetime.time.min)
+    end = start + datetime.timedelta(days=1)
+    session = get_session()
+    try:
+        query = session.query(Recording).filter(
+            Recording.timestamp >= start,
+            Recording.timestamp < end
+        )
+        if stream_id:
+            query = query.filter(Recording.stream_id == stream_id)
+        if camera_name:
+            query = query.filter(func.lower(Recording.camera_name) == camera_name.lower())
+        return query.order_by(Recording.timestamp.desc()).all()
+    except Exception as e:
+        logger.error(f"Failed to get recordings for {day}: {e}")
+        return []
+    finally:
+        session.close()
+
+
+def get_recordings_page(stream_id=None, camera_name=None, start=None, end=None, before=None, limit=50):
+    """Get one page of recordings, newest first, using keyset pagination
+    
+    Pages are continued from the (timestamp, id) of the last row of the
+    previous page rather than with OFFSET, so every page is an index range
+    scan no matter how deep into the archive it is.
+    
+    Args:
+        stream_id: Optional stream ID to filter by
+        camera_name: Optional camera name to filter by (case-insensitive)
+        start: Optional earliest timestamp (inclusive)
+        end: Optional latest timestamp (exclusive)
+        before: Optional (timestamp, id) of the last row of the previous page
+        limit: Page size
+        
+    Returns:
+        Tuple of (list of Recording objects, whether more rows follow)
+    """
+    session = get_session()
+    try:
+        query = session.query(Recording)
+        if stream_id:
+            query = query.filter(Recording.stream_id == stream_id)
+        if camera_name:
+            query = query.filter(func.lower(Recording.camera_name) == camera_name.lower())
+        if start:
+            query = query.filter(Recording.timestamp >= start)
+        if end:
+            query = query.filter(Recording.timestamp < end)
+        if before:
+            timestamp, recording_id = before
+            query = query.filter(
+                Recording.timestamp <= timestamp,
+                or_(Recording.timestamp < timestamp, and_(Recording.timestamp == timestamp, Recording.id < recording_id))
+            )
+        rows = query.order_by(Recording.timestamp.desc(), Recording.id.desc()).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+    except Exception as e:
+        logger.error(f"Failed to get recordings page: {e}")
+        return [], False
+    finally:
+        session.close()
+
+
+def get_recording(recording_id):
+    """Get a recording by ID
+    
+    Returns:
+        Recording object or None
+    """
+    session = get_session()
+    try:
+        return session.query(Recording).filter(Recording.id == recording_id).first()
+    except Exception as e:
+        logger.error(f"Failed to get recording {recording_id}: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def get_recordings_without_thumbnails(limit=10):
+    """Get recording files that have no sprite sheet (or failed attempt) yet, newest first"""
+    session = get_session()
+    try:
+        return session.query(Recording).outerjoin(
+            RecordingThumbnails, RecordingThumbnails.recording_id == Recording.id
+        ).filter(
+            RecordingThumbnails.recording_id.is_(None),
+            Recording.has_file.is_(True)
+        ).order_by(Recording.timestamp.desc()).limit(limit).all()
+    except Exception as e:
+        logger.error(f"Failed to get recordings without thumbnails: {e}")
+        return []
+    finally:
+        session.close()
+
+
+def store_thumbnails(recording_id, sprite=None, error=None, **layout):
+    """Save the sprite sheet of a recording, or the reason it could not be made
+    
+    Args:
+        recording_id: Recording ID
+        sprite: JPEG bytes
+        error: Error message if extraction failed
+        layout: RecordingThumbnails columns (columns, rows, tile_width, tile_height, interval, times)
+    """
+    if 'times' in layout:
+        layout['times'] = json.dumps(layout['times'])
+    try:
+        writer.submit(lambda session: session.merge(
+            RecordingThumbnails(recording_id=recording_id, sprite=sprite, error=error, **layout)), wait=True)
+        return True
+    except Exception as e:
+        logger.error(f"Failed to store thumbnails for recording {recording_id}: {e}")
+        return False
+
+
+def get_thumbnail_layouts(recording_ids):
+    """Get the sprite layouts (without image data) of several recordings
+    
+    Returns:
+        Dict of recording ID -> RecordingThumbnails.to_dict(), for recordings with a sprite
+    """
+    if not recording_ids:
+        return {}
+    session = get_session()
+    try:
+        rows = session.query(RecordingThumbnails).options(defer(RecordingThumbnails.sprite)).filter(
+            RecordingThumbnails.recording_id.in_(list(recording_ids)),
+            RecordingThumbnails.error.is_(None)
+        ).all()
+        return {row.recording_id: row.to_dict() for row in rows}
+    except Exception as e:
+        logger.error(f"Failed to get thumbnail layouts: {e}")
+        return {}
+    finally:
+        session.close()
+
+
+def get_thumbnail_sprite(recording_id):
+    """Get a recording's sprite sheet
+    
+    Returns:
+        Tuple of (JPEG bytes, creation time), or None
+    """
+    session = get_session()
+    try:
+        row = session.query(RecordingThumbnails.sprite, RecordingThumbnails.created_at).filter(
+            RecordingThumbnails.recording_id == recording_id,
+            RecordingThumbnails.sprite.isnot(None)
+        ).first()
+        return (row.sprite, row.created_at) if row else None
+    except Exception as e:
+        logger.error(f"Failed to get sprite for recording {recording_id}: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def delete_orphaned_thumbnails():
+    """Delete sprite sheets whose recording no longer exists
+    
+    Returns:
+        Number of rows deleted
+    """
+    def job(session):
+        return session.query(RecordingThumbnails).filter(
+            ~RecordingThumbnails.recording_id.in_(session.query(Recording.id))
+        ).delete(synchronize_session=False)
+    
+    try:
+        return writer.submit(job, wait=True)
+    except Exception as e:
+        logger.error(f"Failed to delete orphaned thumbnails: {e}")
+        return 0
+
+
+def write_recording_content(recording_id, filepath):
+    """Copy a recording file into the database, streaming it in chunks
+    
+    At most CONTENT_CHUNKS_PER_WRITE chunks are held in memory at a time.
+    has_content is set once the last chunk is written.
+    """
+    def write_chunks(chunks):
+        writer.submit(lambda session: session.bulk_insert_mappings(RecordingChunk, chunks), wait=True)
+    
+    try:
+        chunks = []
+        with open(filepath, 'rb') as f:
+            for seq, data in enumerate(iter(lambda: f.read(CONTENT_CHUNK_SIZE), b'')):
+                chunks.append({'recording_id': recording_id, 'seq': seq, 'data': data})
+                if len(chunks) >= CONTENT_CHUNKS_PER_WRITE:
+                    write_chunks(chunks)
+                    chunks = []
+        if chunks:
+            write_chunks(chunks)
+        writer.submit(lambda session: session.query(Recording).filter(Recording.id == recording_id).update(
+            {'has_content': True}, synchronize_session=False), wait=True)
+        return True
+    except Exception as e:
+        logger.error(f"Failed to store content of recording {recording_id}: {e}")
+        writer.submit(lambda session: session.query(RecordingChunk).filter(
+            RecordingChunk.recording_id == recording_id).delete(synchronize_session=False))
+        return False
+
+
+def iter_recording_content(recording_id, start=0, end=None):
+    """Stream a recording's content from the database
+    
+    Args:
+        recording_id: Recording ID
+        start: First byte
+        end: Byte after the last one (None for the end of the content)
+        
+    Yields:
+        Byte strings of at most CONTENT_CHUNK_SIZE, loaded one chunk at a time
+    """
+    seq = start // CONTENT_CHUNK_SIZE
+    offset = start - seq * CONTENT_CHUNK_SIZE
+    position = start
+    while end is None or position < end:
+        session = get_session()
+        try:
+            data = session.query(RecordingChunk.data).filter(
+                RecordingChunk.recording_id == recording_id,
+                RecordingChunk.seq == seq
+            ).scalar()
+        finally:
             session.close()
+        if data is None:
+            return
+        
+        data = data[offset:] if end is None else data[offset:offset + end - position]
+        if not data:
+            return
+        yield data
+        position += len(data)
+        seq += 1
+        offset = 0
+
+
+def get_recording_by_path(filepath):
+    """Get a recording by its file path
+    
+    Returns:
+        Recording object or None
+    """
+    session = get_session()
+    try:
+        return session.query(Recording).filter(Recording.path == str(filepath)).first()
+    except Exception as e:
+        logger.error(f"Failed to get recording for {filepath}: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def get_indexed_paths():
+    """Set of file paths already registered in the recordings table"""
+    session = get_session()
+    try:
+        return {path for (path,) in session.query(Recording.path).filter(Recording.path.isnot(None))}
+    finally:
+        session.close()
 
 
 def get_recordings_by_date_range(start_date, end_date, stream_id=None):
@@ -160,115 +982,206 @@ def get_recordings_by_date_range(start_date, end_date, stream_id=None):
             session.close()
 
 
-def export_recordings_by_timeline(start_date, end_date, export_path, stream_ids=None, format="zip"):
-    """Export recordings within a date range to a zip file or directory
+class _ZipStreamSink:
+    """Write-only file object that collects zipfile output between reads
+    
+    Having no tell() or seek(), it makes zipfile write in streaming mode
+    (sizes and CRCs in data descriptors after each entry).
+    """
+    
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def pop(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def get_export_recordings(start_date, end_date, stream_ids=None):
+    """Get the recordings of an export, oldest first
     
     Args:
         start_date: Start date (datetime.datetime)
         end_date: End date (datetime.datetime)
-        export_path: Path to save the export
-        stream_ids: Optional list of stream IDs to filter by
-        format: Export format ('zip' or 'directory')
+        stream_ids: Optional list of stream IDs (or a single ID) to filter by
         
     Returns:
-        Path to the export file/directory or None if failed
+        List of Recording objects
     """
+    session = get_session()
     try:
-        session = get_session()
         query = session.query(Recording).filter(
             Recording.timestamp >= start_date,
             Recording.timestamp <= end_date
         )
-        
         if stream_ids:
             if isinstance(stream_ids, list):
                 query = query.filter(Recording.stream_id.in_(stream_ids))
             else:
                 query = query.filter(Recording.stream_id == stream_ids)
+        return query.order_by(Recording.timestamp).all()
+    finally:
+        session.close()
+
+
+def export_filenames(recordings):
+    """Unique archive file names of recordings, keyed by recording ID"""
+    names = {}
+    used = set()
+    for rec in recordings:
+        name = f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}.{rec.format}"
+        if name in used:
+            name = f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}_{rec.id}.{rec.format}"
+        used.add(name)
+        names[rec.id] = name
+    return names
+
+
+def export_entry(rec, filename):
+    """metadata.json entry of an exported recording"""
+    return {
+        "id": rec.id,
+        "stream_id": rec.stream_id,
+        "camera_name": rec.camera_name,
+        "timestamp": rec.timestamp.isoformat(),
+        "duration": rec.duration,
+        "size_bytes": rec.size_bytes,
+        "format": rec.format,
+        "filename": filename
+    }
+
+
+def export_metadata(entries, start_date, end_date):
+    """Contents of an export's metadata.json, from export_entry() dicts"""
+    return {
+        "export_date": datetime.datetime.now().isoformat(),
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "recording_count": len(entries),
+        "streams": list(set(entry["stream_id"] for entry in entries)),
+        "cameras": list(set(entry["camera_name"] for entry in entries)),
+        "recordings": entries
+    }
+
+
+def open_recording_content(rec):
+    """Size and chunk iterator of a recording's content - its file, else its database chunks
+    
+    Returns:
+        Tuple of (size, iterator of byte strings), or None if there is no content
+    """
+    if rec.has_file and rec.path and os.path.exists(rec.path):
+        def read_file(path):
+            with open(path, 'rb') as f:
+                yield from iter(lambda: f.read(CONTENT_CHUNK_SIZE), b'')
+        return os.path.getsize(rec.path), read_file(rec.path)
+    if rec.has_content:
+        return rec.size_bytes or 0, iter_recording_content(rec.id)
+    return None
+
+
+def iter_export_zip(recordings, start_date, end_date):
+    """Generate a zip archive of recordings piece by piece
+    
+    Media is STORED (it is already compressed) and copied straight from the
+    recording files or database chunks, so memory use stays at about one
+    chunk and the first bytes are ready as soon as the first chunk is read.
+    metadata.json is written last, listing any recordings whose content was
+    missing. Entries larger than 4 GB use zip64.
+    
+    Yields:
+        Byte strings of the archive
+    """
+    sink = _ZipStreamSink()
+    filenames = export_filenames(recordings)
+    missing = []
+    
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for rec in recordings:
+            content = open_recording_content(rec)
+            if content is None:
+                missing.append(rec.id)
+                continue
+            size, chunks = content
+            
+            info = zipfile.ZipInfo(f"recordings/{filenames[rec.id]}", date_time=rec.timestamp.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = size  # Lets zipfile decide on zip64 up front
+            with zipf.open(info, 'w') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield sink.pop()
+            yield sink.pop()
+        
+        metadata = export_metadata([export_entry(rec, filenames[rec.id]) for rec in recordings], start_date, end_date)
+        metadata["missing_recordings"] = missing
+        zipf.writestr("metadata.json", json.dumps(metadata, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    
+    # Central directory
+    yield sink.pop()
+
+
+def export_recordings_by_timeline(start_date, end_date, export_path, stream_ids=None, format="zip"):
+    """Export recordings within a date range to a zip file or directory
+    
+    Args:
+        start_date: Start date (datetime.datetime)
+        end_date: End date (datetime.datetime)
+        export_path: Path to save the export
+        stream_ids: Optional list of stream IDs to filter by
+        format: Export format ('zip' or 'directory')
         
-        recordings = query.order_by(Recording.timestamp).all()
+    Returns:
+        Path to the export file/directory or None if failed
+    """
+    try:
+        recordings = get_export_recordings(start_date, end_date, stream_ids)
         
         if not recordings:
             logger.info(f"No recordings found for the specified timeline")
             return None
-            
-        # Create metadata
-        metadata = {
-            "export_date": datetime.datetime.now().isoformat(),
-            "start_date": start_date.isoformat(),
-            "end_date": end_date.isoformat(),
-            "recording_count": len(recordings),
-            "streams": list(set(rec.stream_id for rec in recordings)),
-            "cameras": list(set(rec.camera_name for rec in recordings)),
-            "recordings": [{
-                "id": rec.id,
-                "stream_id": rec.stream_id,
-                "camera_name": rec.camera_name,
-                "timestamp": rec.timestamp.isoformat(),
-                "duration": rec.duration,
-                "size_bytes": rec.size_bytes,
-                "format": rec.format,
-                "filename": f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}.{rec.format}"
-            } for rec in recordings]
-        }
         
         if format == "zip":
-            # Create a temporary directory
-            temp_dir = tempfile.mkdtemp()
-            try:
-                # Create zip file
-                zip_path = export_path if export_path.endswith('.zip') else f"{export_path}.zip"
-                
-                # Save metadata
-                with open(os.path.join(temp_dir, "metadata.json"), "w") as f:
-                    json.dump(metadata, f, indent=2)
-                
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    # Add metadata to zip
-                    zipf.write(os.path.join(temp_dir, "metadata.json"), "metadata.json")
-                    
-                    # Add recordings to zip
-                    for rec in recordings:
-                        if rec.has_file and rec.path and os.path.exists(rec.path):
-                            # Generate filename based on camera and timestamp
-                            filename = f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}.{rec.format}"
-                            zipf.write(rec.path, f"recordings/{filename}")
-                        elif rec.has_content and rec.content:
-                            # For recordings stored directly in the database
-                            filename = f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}.{rec.format}"
-                            temp_file = os.path.join(temp_dir, filename)
-                            with open(temp_file, 'wb') as f:
-                                f.write(rec.content)
-                            zipf.write(temp_file, f"recordings/{filename}")
-                
-                logger.info(f"Exported {len(recordings)} recordings to {zip_path}")
-                return zip_path
-                
-            finally:
-                shutil.rmtree(temp_dir)  # Clean up temp directory
+            zip_path = export_path if export_path.endswith('.zip') else f"{export_path}.zip"
+            with open(zip_path, 'wb') as f:
+                for data in iter_export_zip(recordings, start_date, end_date):
+                    f.write(data)
+            
+            logger.info(f"Exported {len(recordings)} recordings to {zip_path}")
+            return zip_path
                 
         elif format == "directory":
+            filenames = export_filenames(recordings)
+            
             # Create export directory
             os.makedirs(export_path, exist_ok=True)
             
             # Save metadata
             with open(os.path.join(export_path, "metadata.json"), "w") as f:
-                json.dump(metadata, f, indent=2)
+                entries = [export_entry(rec, filenames[rec.id]) for rec in recordings]
+                json.dump(export_metadata(entries, start_date, end_date), f, indent=2)
                 
             # Copy recordings to directory
             recordings_dir = os.path.join(export_path, "recordings")
             os.makedirs(recordings_dir, exist_ok=True)
             
             for rec in recordings:
+                target = os.path.join(recordings_dir, filenames[rec.id])
                 if rec.has_file and rec.path and os.path.exists(rec.path):
-                    # Generate filename based on camera and timestamp
-                    filename = f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}.{rec.format}"
-                    shutil.copy2(rec.path, os.path.join(recordings_dir, filename))
-                elif rec.has_content and rec.content:
+                    shutil.copy2(rec.path, target)
+                elif rec.has_content:
                     # For recordings stored directly in the database
-                    filename = f"{rec.camera_name}_{rec.timestamp.strftime('%Y%m%d_%H%M%S')}.{rec.format}"
-                    with open(os.path.join(recordings_dir, filename), 'wb') as f:
-                        f.write(rec.content)
+                    with open(target, 'wb') as f:
+                        for chunk in iter_recording_content(rec.id):
+                            f.write(chunk)
             
             logger.info(f"Exported {len(recordings)} recordings to directory {export_path}")
             return export_path
@@ -280,73 +1193,624 @@ def export_recordings_by_timeline(start_date, end_date, export_path, stream_ids=
     except Exception as e:
         logger.error(f"Failed to export recordings: {e}")
         return None
-    finally:
-        if session:
-            session.close()
 
 
-def clean_old_recordings(retention_days, max_space_gb):
-    """Clean old recordings based on retention policy
+def create_export_job(start_date, end_date, export_dir, stream_ids=None, format="zip"):
+    """Queue an export of the recordings within a date range
+    
+    The recordings are listed when the job is created; recordings added to
+    the range afterwards are not part of it.
     
     Args:
-        retention_days: Days to keep recordings
-        max_space_gb: Maximum space to use for recordings in GB
+        start_date: Start date (datetime.datetime)
+        end_date: End date (datetime.datetime), inclusive
+        export_dir: Directory to write the export to
+        stream_ids: Optional list of stream IDs to filter by
+        format: Export format ('zip' or 'directory')
         
     Returns:
-        Number of recordings deleted
+        ExportJob.to_dict() of the new job, or None if there are no recordings in the range
+    """
+    if format not in ("zip", "directory"):
+        raise ValueError(f"Unsupported export format: {format}")
+    if stream_ids and not isinstance(stream_ids, list):
+        stream_ids = [stream_ids]
+    
+    recordings = get_export_recordings(start_date, end_date, stream_ids)
+    if not recordings:
+        return None
+    filenames = export_filenames(recordings)
+    
+    job_id = str(uuid.uuid4())
+    name = f"smartnvr_export_{start_date.strftime('%Y%m%d_%H%M%S')}_{end_date.strftime('%Y%m%d_%H%M%S')}_{job_id[:8]}"
+    output_path = os.path.join(export_dir, f"{name}.zip" if format == "zip" else name)
+    
+    def job(session):
+        export = ExportJob(id=job_id, status=ExportJob.QUEUED, format=format, start_date=start_date,
+                           end_date=end_date, stream_ids=json.dumps(stream_ids) if stream_ids else None,
+                           output_path=output_path, total_files=len(recordings),
+                           total_bytes=sum(rec.size_bytes or 0 for rec in recordings), copied_files=0,
+                           copied_bytes=0, missing_files=0, cancel_requested=False)
+        session.add(export)
+        session.flush()
+        session.execute(insert(ExportJobFile), [{
+            "job_id": job_id,
+            "seq": seq,
+            "recording_id": rec.id,
+            "filename": filenames[rec.id],
+            "stream_id": rec.stream_id,
+            "camera_name": rec.camera_name,
+            "timestamp": rec.timestamp,
+            "duration": rec.duration,
+            "format": rec.format,
+            "size_bytes": rec.size_bytes or 0,
+            "status": ExportJobFile.PENDING
+        } for seq, rec in enumerate(recordings)])
+        return export.to_dict()
+    
+    export = writer.submit(job, wait=True)
+    logger.info(f"Queued export job {job_id} of {len(recordings)} recordings")
+    return export
+
+
+def get_export_job(job_id):
+    """Get an export job by ID
+    
+    Returns:
+        ExportJob object or None
     """
+    session = get_session()
     try:
-        session = get_session()
-        cutoff_date = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+        return session.get(ExportJob, job_id)
+    finally:
+        session.close()
+
+
+def list_export_jobs(limit=50):
+    """Get the most recent export jobs, newest first"""
+    session = get_session()
+    try:
+        return session.query(ExportJob).order_by(ExportJob.created_at.desc()).limit(limit).all()
+    except Exception as e:
+        logger.error(f"Failed to list export jobs: {e}")
+        return []
+    finally:
+        session.close()
+
+
+def claim_export_job():
+    """Mark the oldest queued export job running and return it
+    
+    Claims go through the writer thread one at a time, so concurrent export
+    workers never get the same job.
+    
+    Returns:
+        ExportJob object or None if no job is queued
+    """
+    def job(session):
+        export = session.query(ExportJob).filter(
+            ExportJob.status == ExportJob.QUEUED
+        ).order_by(ExportJob.created_at).first()
+        if export is not None:
+            export.status = ExportJob.RUNNING
+            export.started_at = datetime.datetime.utcnow()
+            export.finished_at = None
+            export.error = None
+        return export
+    
+    try:
+        return writer.submit(job, wait=True)
+    except Exception as e:
+        logger.error(f"Failed to claim an export job: {e}")
+        return None
+
+
+def cancel_export_job(job_id):
+    """Cancel an export job
+    
+    A queued job is cancelled at once; a running job stops before its next
+    recording, keeping what it copied so far for resume_export_job().
+    
+    Returns:
+        ExportJob.to_dict() of the job, or None if there is no such job
+    """
+    def job(session):
+        export = session.get(ExportJob, job_id)
+        if export is None:
+            return None
+        if export.status == ExportJob.QUEUED:
+            export.status = ExportJob.CANCELLED
+            export.finished_at = datetime.datetime.utcnow()
+        elif export.status == ExportJob.RUNNING:
+            export.cancel_requested = True
+        return export.to_dict()
+    
+    return writer.submit(job, wait=True)
+
+
+def resume_export_job(job_id):
+    """Queue a cancelled or failed export job again
+    
+    The job continues after the recordings already in its manifest.
+    
+    Returns:
+        ExportJob.to_dict() of the job, or None if there is no such job
+    """
+    def job(session):
+        export = session.get(ExportJob, job_id)
+        if export is None:
+            return None
+        if export.status in (ExportJob.CANCELLED, ExportJob.FAILED):
+            export.status = ExportJob.QUEUED
+            export.cancel_requested = False
+            export.error = None
+            export.finished_at = None
+        return export.to_dict()
+    
+    return writer.submit(job, wait=True)
+
+
+def delete_export_job(job_id):
+    """Delete an export job that is not running, with its output
+    
+    Returns:
+        ExportJob.to_dict() of the job as it was (a running job is left
+        alone), or None if there is no such job
+    """
+    def job(session):
+        export = session.get(ExportJob, job_id)
+        if export is None:
+            return None
+        if export.status != ExportJob.RUNNING:
+            session.query(ExportJobFile).filter(ExportJobFile.job_id == job_id).delete(synchronize_session=False)
+            session.delete(export)
+        return export
+    
+    export = writer.submit(job, wait=True)
+    if export is None:
+        return None
+    if export.status != ExportJob.RUNNING:
+        try:
+            if os.path.isdir(export.output_path):
+                shutil.rmtree(export.output_path)
+            elif os.path.exists(export.output_path):
+                os.remove(export.output_path)
+        except OSError as e:
+            logger.error(f"Failed to delete export {export.output_path}: {e}")
+    return export.to_dict()
+
+
+def requeue_interrupted_export_jobs():
+    """Queue the jobs that were running when the application stopped, so they resume
+    
+    Returns:
+        Number of jobs queued again
+    """
+    def job(session):
+        now = datetime.datetime.utcnow()
+        session.query(ExportJob).filter(
+            ExportJob.status == ExportJob.RUNNING, ExportJob.cancel_requested.is_(True)
+        ).update({ExportJob.status: ExportJob.CANCELLED, ExportJob.cancel_requested: False,
+                  ExportJob.finished_at: now}, synchronize_session=False)
+        return session.query(ExportJob).filter(
+            ExportJob.status == ExportJob.RUNNING
+        ).update({ExportJob.status: ExportJob.QUEUED}, synchronize_session=False)
+    
+    try:
+        count = writer.submit(job, wait=True)
+        if count:
+            logger.info(f"Resuming {count} interrupted export jobs")
+        return count
+    except Exception as e:
+        logger.error(f"Failed to requeue interrupted export jobs: {e}")
+        return 0
+
+
+class _ExportProgress:
+    """Files and bytes copied by a running export job, saved to its row as the copy goes
+    
+    Progress within a file is saved at most every EXPORT_PROGRESS_INTERVAL
+    seconds without waiting for the commit; each finished file is committed
+    together with its manifest row. Every save also reads back whether the
+    job was cancelled.
+    """
+    
+    def __init__(self, export, items):
+        self.job_id = export.id
+        self.cancel_requested = bool(export.cancel_requested)
+        self.partial = 0  # Bytes copied of the current file
+        self.saved_at = time.monotonic()
+        self._count(items)
+        writer.submit(self._save, wait=True)
+    
+    def _count(self, items):
+        copied = [item for item in items if item.status == ExportJobFile.COPIED]
+        self.copied_files = len(copied)
+        self.copied_bytes = sum(item.size_bytes or 0 for item in copied)
+        self.missing_files = sum(1 for item in items if item.status == ExportJobFile.MISSING)
+    
+    def _save(self, session):
+        export = session.get(ExportJob, self.job_id)
+        export.copied_files = self.copied_files
+        export.copied_bytes = self.copied_bytes + self.partial
+        export.missing_files = self.missing_files
+        return bool(export.cancel_requested)
+    
+    def _set_cancel_requested(self, requested):
+        self.cancel_requested = self.cancel_requested or requested
+    
+    def cancelled(self):
+        return self.cancel_requested
+    
+    def add(self, nbytes):
+        """Count bytes of the file being copied"""
+        self.partial += nbytes
+        now = time.monotonic()
+        if now - self.saved_at >= EXPORT_PROGRESS_INTERVAL:
+            self.saved_at = now
+            writer.submit(self._save, callback=self._set_cancel_requested)
+    
+    def file_done(self, item, status, **fields):
+        """Record a recording as copied (fields: its size and zip entry) or missing"""
+        fields["status"] = status
+        for name, value in fields.items():
+            setattr(item, name, value)
+        self.partial = 0
+        if status == ExportJobFile.COPIED:
+            self.copied_files += 1
+            self.copied_bytes += item.size_bytes or 0
+        else:
+            self.missing_files += 1
         
-        # Delete recordings older than retention period
-        old_recordings = session.query(Recording).filter(Recording.timestamp < cutoff_date).all()
-        deleted_count = len(old_recordings)
+        def job(session):
+            session.query(ExportJobFile).filter(
+                ExportJobFile.job_id == self.job_id, ExportJobFile.seq == item.seq
+            ).update(fields, synchronize_session=False)
+            return self._save(session)
         
-        for rec in old_recordings:
-            # Delete file if exists
-            if rec.has_file and rec.path and os.path.exists(rec.path):
-                try:
-                    os.remove(rec.path)
-                except Exception as e:
-                    logger.error(f"Failed to delete recording file: {e}")
-            
-            # Delete from database
-            session.delete(rec)
+        self._set_cancel_requested(writer.submit(job, wait=True))
+    
+    def restart(self, items):
+        """Forget the copied recordings, for an output that has to be written again"""
+        for item in items:
+            if item.status == ExportJobFile.COPIED:
+                item.status = ExportJobFile.PENDING
+        self._count(items)
+        self.partial = 0
         
-        # Enforce storage limit
-        total_size = session.query(func.sum(Recording.size_bytes)).scalar() or 0
-        total_size_gb = total_size / (1024**3)
+        def job(session):
+            session.query(ExportJobFile).filter(
+                ExportJobFile.job_id == self.job_id, ExportJobFile.status == ExportJobFile.COPIED
+            ).update({ExportJobFile.status: ExportJobFile.PENDING, ExportJobFile.crc: None,
+                      ExportJobFile.header_offset: None, ExportJobFile.end_offset: None},
+                     synchronize_session=False)
+            return self._save(session)
         
-        if total_size_gb > max_space_gb:
-            # Get recordings sorted by date (oldest first)
-            space_recordings = session.query(Recording).order_by(Recording.timestamp.asc()).all()
+        self._set_cancel_requested(writer.submit(job, wait=True))
+
+
+def _open_export_item(item):
+    """Size and chunk iterator of a manifest entry's recording, or None if it is gone"""
+    session = get_session()
+    try:
+        rec = session.get(Recording, item.recording_id)
+    finally:
+        session.close()
+    return open_recording_content(rec) if rec is not None else None
+
+
+def _export_job_metadata(export, items):
+    metadata = export_metadata([item.to_entry() for item in items if item.status == ExportJobFile.COPIED],
+                               export.start_date, export.end_date)
+    metadata["missing_recordings"] = [item.recording_id for item in items if item.status == ExportJobFile.MISSING]
+    return metadata
+
+
+def _export_zip_info(item):
+    info = zipfile.ZipInfo(f"recordings/{item.filename}", date_time=item.timestamp.timetuple()[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    return info
+
+
+def _write_export_zip(export, items, progress):
+    """Copy the pending recordings of a job into its zip archive
+    
+    A resumed job cuts the archive off after the last copied entry (dropping
+    a half-written one and the central directory of an earlier cancel) and
+    rebuilds the directory entries of the copied recordings from the manifest.
+    
+    Returns:
+        False if the job was cancelled
+    """
+    path = export.output_path
+    copied = [item for item in items if item.status == ExportJobFile.COPIED]
+    resume_offset = max((item.end_offset for item in copied), default=0)
+    if copied and (not os.path.isfile(path) or os.path.getsize(path) < resume_offset):
+        logger.warning(f"Export {path} is missing or truncated, starting it over")
+        progress.restart(items)
+        copied, resume_offset = [], 0
+    
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'r+b' if os.path.isfile(path) else 'wb') as f:
+        f.truncate(resume_offset)
+        f.seek(resume_offset)
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+            for item in copied:
+                info = _export_zip_info(item)
+                info.header_offset = item.header_offset
+                info.CRC = item.crc
+                info.file_size = info.compress_size = item.size_bytes
+                zipf.filelist.append(info)
+                zipf.NameToInfo[info.filename] = info
             
-            for rec in space_recordings:
-                # Delete file if exists
-                if rec.has_file and rec.path and os.path.exists(rec.path):
-                    try:
-                        os.remove(rec.path)
-                    except Exception as e:
-                        logger.error(f"Failed to delete recording file: {e}")
-                
-                # Reduce the total size and delete from database
-                total_size -= rec.size_bytes
-                total_size_gb = total_size / (1024**3)
-                session.delete(rec)
-                deleted_count += 1
+            for item in items:
+                if item.status != ExportJobFile.PENDING:
+                    continue
+                if progress.cancelled():
+                    return False
+                content = _open_export_item(item)
+                if content is None:
+                    progress.file_done(item, ExportJobFile.MISSING)
+                    continue
+                size, chunks = content
                 
-                if total_size_gb <= max_space_gb * 0.9:  # 90% of limit
-                    break
+                info = _export_zip_info(item)
+                info.file_size = size  # Lets zipfile decide on zip64 up front
+                with zipf.open(info, 'w') as entry:
+                    for chunk in chunks:
+                        entry.write(chunk)
+                        progress.add(len(chunk))
+                # The manifest must never list an entry that isn't on disk
+                f.flush()
+                os.fsync(f.fileno())
+                progress.file_done(item, ExportJobFile.COPIED, size_bytes=info.file_size, crc=info.CRC,
+                                   header_offset=info.header_offset, end_offset=f.tell())
+            
+            zipf.writestr("metadata.json", json.dumps(_export_job_metadata(export, items), indent=2),
+                          compress_type=zipfile.ZIP_DEFLATED)
+    return True
+
+
+def _write_export_directory(export, items, progress):
+    """Copy the pending recordings of a job into its export directory
+    
+    Each file is written under a .part name and renamed once complete.
+    
+    Returns:
+        False if the job was cancelled
+    """
+    recordings_dir = os.path.join(export.output_path, "recordings")
+    os.makedirs(recordings_dir, exist_ok=True)
+    
+    for item in items:
+        if item.status != ExportJobFile.PENDING:
+            continue
+        if progress.cancelled():
+            return False
+        content = _open_export_item(item)
+        if content is None:
+            progress.file_done(item, ExportJobFile.MISSING)
+            continue
+        _, chunks = content
         
-        session.commit()
-        return deleted_count
+        target = os.path.join(recordings_dir, item.filename)
+        size = 0
+        with open(f"{target}.part", 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+                progress.add(len(chunk))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{target}.part", target)
+        progress.file_done(item, ExportJobFile.COPIED, size_bytes=size)
+    
+    with open(os.path.join(export.output_path, "metadata.json"), "w") as f:
+        json.dump(_export_job_metadata(export, items), f, indent=2)
+    return True
+
+
+def run_export_job(export):
+    """Copy the pending recordings of a claimed export job and finish it
+    
+    Args:
+        export: ExportJob from claim_export_job()
+        
+    Returns:
+        The job's final status: completed, cancelled (the output so far is
+        kept for resume_export_job()) or failed
+    """
+    progress = None
+    error = None
+    try:
+        session = get_session()
+        try:
+            items = session.query(ExportJobFile).filter(
+                ExportJobFile.job_id == export.id
+            ).order_by(ExportJobFile.seq).all()
+        finally:
+            session.close()
         
+        progress = _ExportProgress(export, items)
+        if export.format == "zip":
+            finished = _write_export_zip(export, items, progress)
+        else:
+            finished = _write_export_directory(export, items, progress)
+        status = ExportJob.COMPLETED if finished else ExportJob.CANCELLED
     except Exception as e:
-        logger.error(f"Failed to clean old recordings: {e}")
-        if session:
-            session.rollback()
-        return 0
+        logger.error(f"Export job {export.id} failed: {e}")
+        status, error = ExportJob.FAILED, str(e)
+    
+    def job(session):
+        row = session.get(ExportJob, export.id)
+        if row is None:
+            return
+        row.status = status
+        row.error = error
+        row.cancel_requested = False
+        row.finished_at = datetime.datetime.utcnow()
+        if progress is not None:
+            # Drop the bytes of a file that was cut short
+            row.copied_files = progress.copied_files
+            row.copied_bytes = progress.copied_bytes
+            row.missing_files = progress.missing_files
+    
+    try:
+        writer.submit(job, wait=True)
+    except Exception as e:
+        logger.error(f"Failed to finish export job {export.id}: {e}")
+    logger.info(f"Export job {export.id} {status}: {progress.copied_files if progress else 0} recordings copied")
+    return status
+
+
+def rebuild_storage_usage():
+    """Recompute the storage totals from the recordings table
+    
+    Only needed once for databases that predate storage accounting; the
+    totals are maintained incrementally afterwards.
+    """
+    def job(session):
+        # Totals pending from earlier jobs of the batch are included in the recount
+        session.info.pop('usage', None)
+        session.query(StorageUsage).delete(synchronize_session=False)
+        rows = session.query(Recording.stream_id, Recording.path, Recording.size_bytes).yield_per(10000)
+        _add_usage(session, _usage_deltas(rows))
+    
+    try:
+        writer.submit(job, wait=True)
+        logger.info("Storage usage totals rebuilt from the recordings table")
+    except Exception as e:
+        logger.error(f"Failed to rebuild storage usage: {e}")
+
+
+def get_storage_usage():
+    """Indexed recording totals, overall and per camera and volume
+    
+    Returns:
+        Dict with 'bytes', 'recordings', 'cameras' and 'volumes'
+        ({key: {'bytes', 'recordings'}})
+    """
+    usage = {'bytes': 0, 'recordings': 0, 'cameras': {}, 'volumes': {}}
+    session = get_session()
+    try:
+        for row in session.query(StorageUsage).all():
+            for group, key in (('cameras', row.stream_id), ('volumes', row.volume)):
+                totals = usage[group].setdefault(key, {'bytes': 0, 'recordings': 0})
+                totals['bytes'] += row.bytes or 0
+                totals['recordings'] += row.recordings or 0
+            usage['bytes'] += row.bytes or 0
+            usage['recordings'] += row.recordings or 0
+        return usage
+    except Exception as e:
+        logger.error(f"Failed to get storage usage: {e}")
+        return usage
     finally:
-        if session:
-            session.close()
\ No newline at end of file
+        session.close()
+
+
+def _unlink_recordings(paths):
+    """Delete recording files; files that are already gone are ignored"""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Failed to delete recording file {path}: {e}")
+
+
+def delete_recordings(stream_id=None, before=None, max_bytes=None, batch_size=RETENTION_BATCH_SIZE):
+    """Delete recordings oldest first, in batches of one transaction each
+    
+    Each batch is a single DELETE ... WHERE id IN (oldest matching ids)
+    RETURNING path, size - an index range scan on timestamp or (stream_id,
+    timestamp) - with the thumbnails and storage totals updated in the same
+    transaction. The returned files are unlinked after the commit.
+    
+    Args:
+        stream_id: Only this camera's recordings
+        before: Only recordings that started before this time
+        max_bytes: Stop once at least this many bytes were freed
+        batch_size: Recordings per transaction
+        
+    Returns:
+        Tuple of (recordings deleted, bytes freed)
+    """
+    def oldest_ids(session, remaining):
+        query = select(Recording.id, Recording.size_bytes)
+        if stream_id is not None:
+            query = query.where(Recording.stream_id == stream_id)
+        if before is not None:
+            query = query.where(Recording.timestamp < before)
+        query = query.order_by(Recording.timestamp.asc()).limit(batch_size)
+        if remaining is None:
+            return query.with_only_columns(Recording.id).scalar_subquery()
+        
+        # Take only as many of the oldest as needed to free max_bytes
+        ids = []
+        for recording_id, size in session.execute(query):
+            ids.append(recording_id)
+            remaining -= size or 0
+            if remaining <= 0:
+                break
+        return ids
+    
+    def delete_batch(session, remaining):
+        rows = session.execute(
+            delete(Recording)
+            .where(Recording.id.in_(oldest_ids(session, remaining)))
+            .returning(Recording.id, Recording.stream_id, Recording.path, Recording.size_bytes)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if rows:
+            ids = [row.id for row in rows]
+            session.execute(delete(RecordingThumbnails).where(RecordingThumbnails.recording_id.in_(ids)))
+            session.execute(delete(RecordingChunk).where(RecordingChunk.recording_id.in_(ids)))
+            _add_usage(session, _usage_deltas(((row.stream_id, row.path, row.size_bytes) for row in rows), sign=-1))
+        return rows
+    
+    deleted = freed = 0
+    try:
+        while max_bytes is None or freed < max_bytes:
+            remaining = None if max_bytes is None else max_bytes - freed
+            rows = writer.submit(lambda session: delete_batch(session, remaining), wait=True)
+            if not rows:
+                break
+            _unlink_recordings(row.path for row in rows)
+            deleted += len(rows)
+            freed += sum(row.size_bytes or 0 for row in rows)
+        return deleted, freed
+    except Exception as e:
+        logger.error(f"Failed to delete recordings: {e}")
+        return deleted, freed
+
+
+def clean_old_recordings(retention_days, max_space_gb):
+    """Apply the retention policy to the indexed recordings
+    
+    Recordings older than retention_days are deleted, then the oldest
+    recordings until the archive fits max_space_gb. Candidates come from the
+    timestamp index and the archive size from the storage totals, so a pass
+    costs time in proportion to what it deletes.
+    
+    Args:
+        retention_days: Days to keep recordings
+        max_space_gb: Maximum space to use for recordings in GB
+        
+    Returns:
+        Number of recordings deleted
+    """
+    cutoff_date = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    deleted, freed = delete_recordings(before=cutoff_date)
+    if deleted:
+        logger.info(f"Retention: deleted {deleted} recordings older than {retention_days} days ({freed / 1e9:.2f}GB)")
+    
+    excess = get_storage_usage()['bytes'] - max_space_gb * 1e9
+    if excess > 0:
+        count, freed = delete_recordings(max_bytes=excess)
+        deleted += count
+        logger.info(f"Retention: deleted {count} oldest recordings to stay under {max_space_gb}GB ({freed / 1e9:.2f}GB)")
+    
+    return deleted
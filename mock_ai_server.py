@@ -0,0 +1,215 @@
+"""Stand-in AI server for testing SmartNVR without a real detection backend
+
+Implements the endpoints the NVR calls (/health, /roi, /predict, the
+batched /predict_batch and the shared-memory variants /predict_shm and
+/predict_batch_shm) and returns detections for regions that changed
+since the previous frame of the same stream. Simulated inference latency
+makes the cost difference between single and batched requests visible.
+
+Usage:
+    python3 mock_ai_server.py --port 5054 --latency-ms 40 --per-image-ms 5
+"""
+from flask import Flask, request, jsonify
+import cv2
+import numpy as np
+import argparse
+import logging
+import mmap
+import os
+import threading
+import time
+from datetime import datetime
+
+app = Flask(__name__)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Simulated inference cost: fixed overhead per request plus a cost per image
+settings = {
+    'latency_ms': 40,
+    'per_image_ms': 5,
+    'min_area': 500
+}
+
+# Previous downscaled frame per stream, used to find changed regions
+previous_frames = {}
+previous_frames_lock = threading.Lock()
+
+# ROIs pushed by the NVR, keyed by stream ID
+stream_rois = {}
+
+stats = {
+    'requests': 0,
+    'images': 0,
+    'started': datetime.now().isoformat()
+}
+
+
+def detect(stream_id, image):
+    """Return detections for regions that changed since the stream's previous frame"""
+    small_width = 320
+    scale = image.shape[1] / small_width
+    small = cv2.resize(image, (small_width, int(image.shape[0] / scale)))
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+    with previous_frames_lock:
+        previous = previous_frames.get(stream_id)
+        previous_frames[stream_id] = gray
+
+    if previous is None or previous.shape != gray.shape:
+        return []
+
+    diff = cv2.absdiff(previous, gray)
+    _, mask = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
+    mask = cv2.dilate(mask, None, iterations=2)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    detections = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        area = w * h * scale * scale
+        if area < settings['min_area']:
+            continue
+        detections.append({
+            'label': 'person' if h > w else 'car',
+            'score': round(min(0.99, 0.5 + area / (image.shape[0] * image.shape[1])), 2),
+            'bbox': [int(x * scale), int(y * scale), int((x + w) * scale), int((y + h) * scale)]
+        })
+    return detections
+
+
+def decode_upload(file_storage):
+    data = np.frombuffer(file_storage.read(), np.uint8)
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def read_shared_frame(descriptor):
+    """Copy a raw frame out of the NVR's shared-memory slot described by descriptor"""
+    shape = tuple(descriptor['shape'])
+    dtype = np.dtype(descriptor.get('dtype', 'uint8'))
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    offset = int(descriptor.get('offset', 0))
+    with open(descriptor['path'], 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if offset + nbytes > len(mm):
+                raise ValueError("Descriptor points past the end of the shared-memory slot")
+            return np.frombuffer(mm, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset).reshape(shape).copy()
+
+
+def simulate_latency(image_count):
+    time.sleep((settings['latency_ms'] + settings['per_image_ms'] * image_count) / 1000.0)
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({
+        'status': 'UP',
+        'server': 'mock',
+        'requests': stats['requests'],
+        'images': stats['images'],
+        'started': stats['started']
+    })
+
+
+@app.route('/roi', methods=['POST'])
+def roi():
+    data = request.json or {}
+    stream_rois[data.get('stream_id')] = data.get('rois', {})
+    return jsonify({'status': 'success'})
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image provided'}), 400
+
+    image = decode_upload(request.files['image'])
+    if image is None:
+        return jsonify({'error': 'Could not decode image'}), 400
+
+    stream_id = request.args.get('stream_id', 'default')
+    stats['requests'] += 1
+    stats['images'] += 1
+    simulate_latency(1)
+    return jsonify({'detections': detect(stream_id, image)})
+
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    uploads = request.files.getlist('images')
+    if not uploads:
+        return jsonify({'error': 'No images provided'}), 400
+
+    stream_ids = request.args.get('stream_ids', '').split(',')
+    if len(stream_ids) != len(uploads):
+        return jsonify({'error': 'stream_ids must list one ID per image'}), 400
+
+    stats['requests'] += 1
+    stats['images'] += len(uploads)
+    simulate_latency(len(uploads))
+
+    results = []
+    for stream_id, upload in zip(stream_ids, uploads):
+        image = decode_upload(upload)
+        detections = detect(stream_id, image) if image is not None else []
+        results.append({'stream_id': stream_id, 'detections': detections})
+    return jsonify({'results': results})
+
+
+@app.route('/predict_shm', methods=['POST'])
+def predict_shm():
+    descriptor = request.json
+    if not descriptor or 'path' not in descriptor or 'shape' not in descriptor:
+        return jsonify({'error': 'Invalid frame descriptor'}), 400
+    if not os.path.exists(descriptor['path']):
+        return jsonify({'error': 'Shared-memory slot not found (is the AI server on the same host?)'}), 400
+
+    try:
+        image = read_shared_frame(descriptor)
+    except (OSError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    stats['requests'] += 1
+    stats['images'] += 1
+    simulate_latency(1)
+    return jsonify({'detections': detect(descriptor.get('stream_id', 'default'), image)})
+
+
+@app.route('/predict_batch_shm', methods=['POST'])
+def predict_batch_shm():
+    frames = (request.json or {}).get('frames', [])
+    if not frames:
+        return jsonify({'error': 'No frames provided'}), 400
+
+    stats['requests'] += 1
+    stats['images'] += len(frames)
+    simulate_latency(len(frames))
+
+    results = []
+    for descriptor in frames:
+        stream_id = descriptor.get('stream_id', 'default')
+        try:
+            detections = detect(stream_id, read_shared_frame(descriptor))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read shared frame for {stream_id}: {e}")
+            detections = []
+        results.append({'stream_id': stream_id, 'detections': detections})
+    return jsonify({'results': results})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in AI server for SmartNVR')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5054)
+    parser.add_argument('--latency-ms', type=float, default=settings['latency_ms'],
+                        help='Simulated fixed cost per request')
+    parser.add_argument('--per-image-ms', type=float, default=settings['per_image_ms'],
+                        help='Simulated cost per image')
+    args = parser.parse_args()
+
+    settings['latency_ms'] = args.latency_ms
+    settings['per_image_ms'] = args.per_image_ms
+
+    logger.info(f"Mock AI server listening on {args.host}:{args.port}")
+    app.run(host=args.host, port=args.port, threaded=True)
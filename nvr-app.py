@@ -1,5 +1,6 @@
-from flask import Flask, request, jsonify, Response, render_template, redirect, url_for, session, flash, send_from_directory
+from flask import Flask, request, jsonify, Response, render_template, redirect, url_for, session, flash, send_from_directory, send_file, abort
 import requests
+from requests.adapters import HTTPAdapter
 import cv2
 import numpy as np
 from PIL import Image
@@ -7,21 +8,42 @@ import io
 import logging
 import os
 import random
-from collections import defaultdict
+from collections import defaultdict, deque
 import time
 import json
 import threading
+import queue
+import mmap
+import tempfile
 from datetime import datetime, timedelta
 import uuid
 import hashlib
 import psutil
 import shutil
-from werkzeug.security import generate_password_hash, check_password_hash
+import subprocess
+import signal
+import csv
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.datastructures import ContentRange
+from urllib.parse import quote
 from functools import wraps
 import glob
 import re
+import base64
+# scipy is optional - its linear_sum_assignment is used for track assignment when available
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
 # Import database functionality - fix incorrect function names
-from database import init_db, store_recording, get_recordings_by_date_range, clean_old_recordings, get_session, Recording
+from database import (init_db, store_recording, get_recordings_by_date_range, clean_old_recordings,
+                      add_recordings, get_recording_dates, get_recordings_for_day, get_recordings_page,
+                      get_recording, get_indexed_paths, get_recordings_without_thumbnails, store_thumbnails,
+                      get_thumbnail_layouts, get_thumbnail_sprite, delete_orphaned_thumbnails,
+                      get_storage_usage, delete_recordings, get_recording_by_path, iter_recording_content,
+                      get_export_recordings, iter_export_zip, create_export_job, get_export_job,
+                      list_export_jobs, claim_export_job, cancel_export_job, resume_export_job,
+                      delete_export_job, requeue_interrupted_export_jobs, run_export_job, ExportJob)
 
 # Ensure app can serve static files
 app = Flask(__name__, static_folder='static')
@@ -54,13 +76,49 @@ MAIN_CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
 DEFAULT_CONFIG = {
     "ai_server": {
         "url": "http://localhost:5054",
-        "enabled": True
+        "enabled": True,
+        "batch_enabled": False,  # Send frames from many cameras in one predict_batch request
+        "batch_window_ms": 50,  # How long to wait for more frames before sending a batch
+        "batch_max_size": 8,
+        "transport": "http"  # 'http' uploads JPEGs; 'shm' passes raw frames via shared memory (same host only)
+    },
+    "detection": {
+        "motion_gating": True,  # Only send frames to the AI server when something moves
+        "motion_threshold": 0.002,  # Fraction of (ROI) pixels that must change to count as motion
+        "motion_heartbeat": 10,  # Run inference at least this often (seconds) even without motion
+        "motion_roi_only": True,  # Only look for motion inside the stream's ROIs, if it has any
+        "min_interval": 0.2,  # Fastest detection cadence (seconds) while objects are tracked
+        "max_interval": 2.0,  # Slowest cadence for empty scenes (before AI latency backoff)
+        "latency_target": 0.5,  # AI p95 latency (seconds) above which all streams back off
+        "box_prediction": True,  # Move boxes along each track's velocity between detections
+        "local_roi_filter": False,  # Drop detections outside the stream's ROIs here instead of on the AI server
+        "roi_anchor": "bottom_center"  # Detection point tested against ROIs: "bottom_center" or "center"
     },
     "recording": {
         "path": "",  # Empty by default, will prompt user to set this
         "retention_days": 7,
         "max_space_gb": 100,
-        "storage_mode": "hybrid"  # 'hybrid', 'file', or 'database'
+        "storage_mode": "hybrid",  # 'hybrid', 'file', or 'database'
+        "mode": "continuous",  # 'off', 'continuous' or 'events' (detection-triggered clips)
+        "format": "mp4",  # Segment container: 'mp4' or 'mkv'
+        "segment_seconds": 300,  # Length of each recording file
+        "record_audio": False,  # Copy the camera's audio track too (needs a codec the container accepts)
+        "pre_event_seconds": 10,  # Video kept in memory and saved before a detection...
+        "post_event_seconds": 10,  # ...and recorded after the last matching detection
+        "pre_event_max_mb": 16,  # Per-camera memory cap for the pre-event buffer
+        "max_event_seconds": 300,  # Long events are split into clips of this length
+        "event_labels": [],  # Labels that start an event clip (empty = any)
+        "event_require_roi": True,  # On streams with ROIs, only detections inside an ROI count
+        "thumbnails": True,  # Build keyframe sprite sheets of new recordings for previews
+        "thumbnail_interval": 10,  # Seconds between sprite tiles
+        "hls_playback": False,  # Play long recordings as fragmented-MP4 HLS instead of one progressive file
+        "hls_min_seconds": 600,  # Recordings at least this long use HLS when it is enabled
+        "hls_cache_gb": 2,  # Disk space for remuxed HLS packages (least recently played evicted first)
+        "accel_redirect": ""  # Internal location prefix to hand file transfers to nginx (X-Accel-Redirect)
+    },
+    "export": {
+        "path": "",  # Where background export jobs write; empty for the exports directory next to the app
+        "max_concurrent": 2  # Export jobs copying at the same time
     },
     "system": {
         "name": "SmartNVR",
@@ -99,10 +157,44 @@ prediction_cache = {}
 # How long to keep predictions visible (in seconds)
 PREDICTION_CACHE_DURATION = 1.0
 
+# Per-stream inference workers, keyed by rtsp_url
+inference_workers = {}
+inference_workers_lock = threading.Lock()
+DETECTION_INTERVAL = 0.5  # Seconds between detections on a stream
+INFERENCE_IDLE_TIMEOUT = 30  # Stop an inference worker when no frames have been offered for this long
+
+# Per-stream object trackers, keyed by rtsp_url and shared by all viewers
+stream_trackers = {}
+stream_trackers_lock = threading.Lock()
+TRACK_MAX_AGE = 3.0  # Forget tracks not matched for this many seconds
+TRACK_MIN_IOU = 0.1  # Detections overlapping a track at least this much may match it...
+TRACK_MAX_DISTANCE = 100  # ...as may detections whose center is within this many pixels
+TRACK_INFEASIBLE_COST = 1e6  # Assignment cost for pairs that may not match
+TRACK_VELOCITY_SMOOTHING = 0.5  # Weight of the newest velocity measurement
+TRACK_PREDICT_HORIZON = 1.0  # Never extrapolate a box more than this many seconds
+
+# Motion gating - detection settings are cached here and refreshed when saved
+detection_settings = {}
+MOTION_FRAME_WIDTH = 160  # Width of the grayscale copy used for motion checks
+MOTION_PIXEL_THRESHOLD = 25  # Per-pixel intensity change that counts as "changed"
+MOTION_BACKGROUND_ALPHA = 0.05  # Background model adaptation rate
+
 # Stream configuration storage
 STREAM_CONFIG_DIR = os.path.join(CONFIG_DIR, 'streams')
 os.makedirs(STREAM_CONFIG_DIR, exist_ok=True)
 STREAM_CONFIG_FILE = os.path.join(STREAM_CONFIG_DIR, 'streams.json')
+RECORDING_INDEX_STATE_FILE = os.path.join(CONFIG_DIR, 'recording_index.json')
+RECORDINGS_PAGE_SIZE = 50  # Default page size of /api/recordings...
+RECORDINGS_PAGE_MAX = 500  # ...and the largest page a client may ask for
+RECORDING_MIMETYPES = {'.mp4': 'video/mp4', '.mkv': 'video/x-matroska', '.avi': 'video/x-msvideo'}
+HLS_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'hls')
+HLS_FRAGMENT_SECONDS = 6  # Target fragment length; fragments are cut at the next keyframe
+HLS_BUILD_TIMEOUT = 300
+EXPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports')
+EXPORT_POLL_INTERVAL = 30  # Seconds between checks for queued export jobs (new jobs wake a worker at once)
+HLS_MIMETYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.m4s': 'video/iso.segment', '.mp4': 'video/mp4'}
+hls_build_locks = {}
+hls_build_locks_lock = threading.Lock()
 
 # ROI storage
 ROI_CONFIG_DIR = os.path.join(CONFIG_DIR, 'roi')
@@ -114,6 +206,11 @@ ROI_THICKNESS = 2
 ROI_ACTIVE_COLOR = (255, 0, 255)  # Magenta for active ROIs
 SHOW_ROIS = True
 
+# Rasterized ROI masks, keyed by stream ID and then by (mask shape, source width)
+roi_masks = {}
+roi_mask_generations = defaultdict(int)  # Stream ID -> invalidation count, guards against caching stale masks
+roi_masks_lock = threading.Lock()
+
 # Object counting
 object_counts = defaultdict(int)
 last_count_update = time.time()
@@ -126,14 +223,59 @@ stream_clients = {}
 # Track reconnection attempts and backoff timing for each stream
 reconnection_tracker = {}
 
-# Global variable to track AI server status
-ai_server_status = {
-    'last_check': 0,
-    'available': False,
-    'last_error': None,
-    'status_cache_time': 30  # Cache status for 30 seconds
+# Shared capture workers - one decoder thread per camera, shared by all viewers
+capture_workers = {}
+capture_workers_lock = threading.Lock()
+FRAME_RING_SIZE = 8  # Number of decoded frames kept per camera
+CAPTURE_IDLE_TIMEOUT = 60  # Stop a decoder this many seconds after its last viewer leaves
+
+# Encode-once broadcasters, keyed by (rtsp_url, is_roi_editor, profile)
+frame_broadcasters = {}
+frame_broadcasters_lock = threading.Lock()
+BROADCASTER_IDLE_TIMEOUT = 5  # Stop rendering this many seconds after the last subscriber leaves
+
+# Output profiles for /video_feed. Explicit width/max_fps/quality query parameters override these.
+# width 0 keeps the camera resolution, max_fps 0 sends every decoded frame.
+STREAM_PROFILES = {
+    'full': {'width': 0, 'max_fps': 0, 'quality': 70},
+    'tile': {'width': 640, 'max_fps': 10, 'quality': 60},
+    'thumb': {'width': 320, 'max_fps': 2, 'quality': 50}
 }
 
+# AI server client settings
+AI_POOL_SIZE = 16  # Keep-alive connections to the AI server
+AI_FAILURE_THRESHOLD = 3  # Consecutive failures before the circuit opens
+AI_BACKOFF_BASE = 5  # Seconds the circuit stays open after the first trip
+AI_BACKOFF_MAX = 120  # Upper bound for the (exponential) open period
+AI_LATENCY_WINDOW = 200  # Recent latencies kept per endpoint for percentiles
+AI_HEALTH_PROBE_INTERVAL = 10  # Seconds between background health checks
+
+# Segment recording - one ffmpeg stream-copy process per camera
+recorders = {}  # stream_id -> SegmentRecorder
+recorders_lock = threading.Lock()
+FFMPEG_BINARY = shutil.which('ffmpeg') or 'ffmpeg'
+RECORDING_FORMATS = ('mp4', 'mkv')
+RECORDING_FILENAME_RE = re.compile(r'(.+)_(\d{8})_(\d{6})\.(mp4|avi|mkv)$')
+RECORDER_RESTART_COOLDOWN = 5  # Seconds before restarting ffmpeg after it exits...
+RECORDER_MAX_RESTART_COOLDOWN = 60  # ...growing up to this while the camera stays down
+RECORDER_STOP_TIMEOUT = 10  # Seconds ffmpeg gets to finish its current segment on stop
+RECORDING_MODES = ('off', 'continuous', 'events')
+TS_PACKET_SIZE = 188
+TS_READ_SIZE = TS_PACKET_SIZE * 512  # Bytes read from ffmpeg per pipe read
+TS_VIDEO_STREAM_TYPES = {0x01, 0x02, 0x10, 0x1b, 0x24}  # MPEG-1/2, MPEG-4, H.264, HEVC
+EVENT_KEEPALIVE_INTERVAL = 5  # Seconds between keeping an event camera's detection running
+THUMBNAIL_WIDTH = 160  # Sprite tile width in pixels (height follows the aspect ratio)
+THUMBNAIL_COLUMNS = 10  # Tiles per sprite row
+THUMBNAIL_MAX_TILES = 120  # Longer recordings get a wider tile interval
+THUMBNAIL_BATCH = 10  # Recordings processed per database query
+THUMBNAIL_POLL_INTERVAL = 30  # Seconds between looking for new recordings
+THUMBNAIL_TIMEOUT = 120
+THUMBNAIL_PTS_RE = re.compile(r'pts_time:\s*([0-9.]+)')
+
+# Shared-memory frame transport for a co-located AI server
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+shm_unsupported_until = 0  # Server lacks the shm endpoints; use JPEG uploads until then
+
 # Setup directories
 def setup_directories():
     """Setup all required directories"""
@@ -415,6 +557,8 @@ def get_system_stats():
         }
     else:
         rec_usage = {'error': 'Recording path not found'}
+    # Size of the recording archive itself, from the running totals
+    rec_usage['archive'] = get_storage_usage()
     return {
         'cpu': cpu_percent,
         'memory': {
@@ -433,9 +577,83 @@ def get_system_stats():
         'timestamp': datetime.now().isoformat()
     }
 
+# Recording index
+def backfill_recording_index(rec_path):
+    """One-time registration of recording files that predate the recording index
+    
+    Recorders register their segments as they finish them, so this walks the
+    recording tree only once per recording path (remembered in
+    RECORDING_INDEX_STATE_FILE), e.g. after an upgrade or a path change.
+    
+    Returns:
+        int: Number of recordings registered
+    """
+    try:
+        with open(RECORDING_INDEX_STATE_FILE, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    
+    indexed_paths = set(state.get('indexed_paths', []))
+    if not rec_path or rec_path in indexed_paths or not os.path.exists(rec_path):
+        return 0
+    
+    streams = load_stream_config()
+    stream_ids_by_prefix = {recording_file_prefix(info.get('name', '')): stream_id for stream_id, info in streams.items()}
+    known_paths = get_indexed_paths()
+    
+    def entries():
+        for root, dirs, files in os.walk(rec_path):
+            for file in files:
+                match = RECORDING_FILENAME_RE.match(file)
+                file_path = os.path.join(root, file)
+                if not match or file_path in known_paths:
+                    continue
+                try:
+                    size = os.path.getsize(file_path)
+                    timestamp = datetime.strptime(match.group(2) + match.group(3), "%Y%m%d%H%M%S")
+                except (OSError, ValueError):
+                    continue
+                
+                # Recorders write to <rec_path>/<stream_id>/; older files are matched by camera name
+                directory = os.path.basename(root)
+                if directory in streams:
+                    stream_id = directory
+                else:
+                    stream_id = stream_ids_by_prefix.get(match.group(1).lower(), 'unknown')
+                camera_name = streams[stream_id]['name'] if stream_id in streams else match.group(1).replace('_', ' ').title()
+                yield {
+                    'stream_id': stream_id,
+                    'camera_name': camera_name,
+                    'timestamp': timestamp,
+                    'size_bytes': size,
+                    'format': match.group(4),
+                    'path': file_path
+                }
+    
+    added = add_recordings(entries())
+    indexed_paths.add(rec_path)
+    state['indexed_paths'] = sorted(indexed_paths)
+    with open(RECORDING_INDEX_STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=4)
+    logger.info(f"Recording index backfill for {rec_path}: {added} existing recordings registered")
+    return added
+
+
+def start_recording_index_backfill(rec_path):
+    """Run backfill_recording_index() in the background"""
+    thread = threading.Thread(target=backfill_recording_index, args=(rec_path,), name="recording-index-backfill")
+    thread.daemon = True
+    thread.start()
+
+
 # Recording management
 def manage_recordings():
-    """Manage recordings based on retention policy"""
+    """Manage recordings based on retention policy
+    
+    Works from the recording index and its storage totals (see
+    database.clean_old_recordings), so the recording tree is never walked.
+    """
     config = load_config()
     recording_path = config['recording']['path']
     retention_days = config['recording']['retention_days']
@@ -446,108 +664,9 @@ def manage_recordings():
         return
     
     try:
-        # 1. Remove old recordings based on retention_days
-        cutoff_date = datetime.now() - timedelta(days=retention_days)
-        
-        # Either use database or file system depending on storage mode
-        if config['recording']['storage_mode'] in ['database', 'hybrid']:
-            # Use database to find old recordings
-            session = get_session()
-            try:
-                old_recordings = session.query(Recording).filter(
-                    Recording.timestamp < cutoff_date
-                ).all()
-                
-                for recording in old_recordings:
-                    try:
-                        file_path = recording.path
-                        if file_path and os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"Deleted old recording: {file_path}")
-                        session.delete(recording)
-                    except Exception as e:
-                        logger.error(f"Error deleting recording {recording.id}: {e}")
-                session.commit()
-            finally:
-                session.close()
-                
-        # If using file or hybrid mode, also clean up files
-        if config['recording']['storage_mode'] in ['file', 'hybrid']:
-            # Use file system to find old recordings
-            for root, dirs, files in os.walk(recording_path):
-                for file in files:
-                    if not file.endswith('.mp4') and not file.endswith('.avi') and not file.endswith('.mkv'):
-                        continue
-                        
-                    file_path = os.path.join(root, file)
-                    try:
-                        file_time = datetime.fromtimestamp(os.path.getctime(file_path))
-                        if file_time < cutoff_date:
-                            os.remove(file_path)
-                            logger.info(f"Deleted old recording: {file_path}")
-                            
-                            # For hybrid mode, also remove database entry if exists
-                            if config['recording']['storage_mode'] == 'hybrid':
-                                try:
-                                    session = get_session()
-                                    recording = session.query(Recording).filter(Recording.path == file_path).first()
-                                    if recording:
-                                        session.delete(recording)
-                                        session.commit()
-                                except Exception as e:
-                                    logger.error(f"Error removing database entry for {file_path}: {e}")
-                                finally:
-                                    if 'session' in locals():
-                                        session.close()
-                    except Exception as e:
-                        logger.error(f"Error processing file {file_path}: {e}")
-        
-        # 2. Check total space and remove oldest recordings if needed
-        total_size_gb = sum(os.path.getsize(os.path.join(dirpath, filename)) 
-                            for dirpath, _, filenames in os.walk(recording_path) 
-                            for filename in filenames if filename.endswith(('.mp4', '.avi', '.mkv'))) / 1e9
-        
-        if total_size_gb > max_space_gb:
-            logger.info(f"Recording storage exceeds limit: {total_size_gb:.2f}GB > {max_space_gb}GB")
-            
-            # Find all recordings and sort by creation time
-            recordings = []
-            for root, _, files in os.walk(recording_path):
-                for file in files:
-                    if file.endswith(('.mp4', '.avi', '.mkv')):
-                        file_path = os.path.join(root, file)
-                        ctime = os.path.getctime(file_path)
-                        size = os.path.getsize(file_path)
-                        recordings.append((file_path, ctime, size))
-            
-            # Sort by creation time (oldest first)
-            recordings.sort(key=lambda x: x[1])
-            
-            # Remove oldest recordings until we're under the limit
-            current_size_gb = total_size_gb
-            for file_path, _, size in recordings:
-                if current_size_gb <= max_space_gb:
-                    break
-                
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        size_gb = size / 1e9
-                        current_size_gb -= size_gb
-                        logger.info(f"Deleted recording to save space: {file_path} ({size_gb:.2f}GB)")
-                        
-                        # Also remove from database if using hybrid mode
-                        if config['recording']['storage_mode'] == 'hybrid':
-                            session = get_session()
-                            try:
-                                recording = session.query(Recording).filter(Recording.path == file_path).first()
-                                if recording:
-                                    session.delete(recording)
-                                    session.commit()
-                            finally:
-                                session.close()
-                except Exception as e:
-                    logger.error(f"Error deleting recording {file_path}: {e}")
+        started = time.time()
+        deleted = clean_old_recordings(retention_days, max_space_gb)
+        logger.info(f"Retention pass deleted {deleted} recordings in {time.time() - started:.1f}s")
     except Exception as e:
         logger.error(f"Error managing recordings: {e}")
 
@@ -682,169 +801,2603 @@ def open_stream(rtsp_url):
     
     return stream
 
-def call_ai_server(endpoint, method='get', data=None, json_data=None, params=None, retry=1, timeout=5, files=None):
+class FrameRingBuffer:
+    """Fixed-size ring of decoded frames tagged with sequence numbers
+    
+    A single writer (the capture worker) puts frames in, any number of readers
+    take the newest frame out. Readers never remove frames, so every viewer of a
+    camera sees the same frames instead of splitting them between each other.
     """
-    Helper function to call AI server with better error handling and retries
     
-    Args:
-        endpoint (str): API endpoint path (without base URL)
-        method (str): HTTP method to use ('get', 'post', etc.)
-        data (bytes): Binary data to send
-        json_data (dict): JSON data to send
-        params (dict): URL parameters 
-        retry (int): Number of retry attempts
-        timeout (int): Timeout in seconds
-        files (dict): Files to send in multipart/form-data format
+    def __init__(self, size=FRAME_RING_SIZE):
+        self.size = size
+        self.slots = [None] * size
+        self.seq = 0
+        self.condition = threading.Condition()
+    
+    def put(self, frame, timestamp=None):
+        """Store a frame and wake up waiting readers
         
-    Returns:
-        tuple: (success, result) where result is response or error message
+        Returns:
+            int: Sequence number assigned to the frame
+        """
+        with self.condition:
+            self.seq += 1
+            self.slots[self.seq % self.size] = (self.seq, timestamp or time.time(), frame)
+            self.condition.notify_all()
+            return self.seq
+    
+    def latest(self):
+        """Get the newest frame as (seq, timestamp, frame), or None if empty"""
+        with self.condition:
+            if self.seq == 0:
+                return None
+            return self.slots[self.seq % self.size]
+    
+    def wait_newer(self, last_seq, timeout=1.0):
+        """Get the newest frame if it is newer than last_seq
+        
+        Waits up to timeout seconds when the caller has already seen the newest
+        frame. Frames between last_seq and the newest one are skipped.
+        
+        Returns:
+            tuple: (seq, timestamp, frame) or None on timeout
+        """
+        with self.condition:
+            if self.seq <= last_seq:
+                self.condition.wait(timeout)
+            if self.seq <= last_seq or self.seq == 0:
+                return None
+            return self.slots[self.seq % self.size]
+
+
+class CaptureWorker:
+    """Long-lived decoder thread for one camera feeding a FrameRingBuffer"""
+    
+    def __init__(self, rtsp_url):
+        self.rtsp_url = rtsp_url
+        self.ring = FrameRingBuffer()
+        self.connected = False
+        self.running = False
+        self.last_viewer_time = time.time()
+        self.reconnect_cooldown = 5  # Initial cooldown of 5 seconds
+        self.max_reconnect_cooldown = 30  # Maximum cooldown of 30 seconds
+        self.last_reconnect_attempt = 0
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"capture-{hash(self.rtsp_url)}")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+    
+    def is_alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+    
+    def next_attempt_in(self):
+        """Seconds until the next reconnection attempt"""
+        return max(0, int(self.reconnect_cooldown - (time.time() - self.last_reconnect_attempt)))
+    
+    def _release(self, stream):
+        """Release a capture and drop it from the stream cache so the next open is fresh"""
+        self.connected = False
+        if stream is not None:
+            try:
+                # Properly release the stream to avoid FFmpeg context issues
+                stream.release()
+                # Small delay to ensure complete cleanup
+                time.sleep(0.1)
+            except Exception as e:
+                logger.error(f"Error releasing stream: {e}")
+        stream_cache.pop(self.rtsp_url, None)
+    
+    def _run(self):
+        stream = None
+        reconnection_count = 0
+        last_log_time = 0  # Track when we last logged a connection error
+        
+        while self.running:
+            current_time = time.time()
+            
+            # Stop decoding once nobody has been watching for a while
+            if stream_clients.get(self.rtsp_url, 0) > 0:
+                self.last_viewer_time = current_time
+            elif current_time - self.last_viewer_time > CAPTURE_IDLE_TIMEOUT:
+                logger.info(f"No viewers for {self.rtsp_url} in {CAPTURE_IDLE_TIMEOUT}s, stopping capture worker")
+                break
+            
+            if stream is None:
+                if current_time - self.last_reconnect_attempt < self.reconnect_cooldown and reconnection_count > 0:
+                    time.sleep(0.5)
+                    continue
+                
+                self.last_reconnect_attempt = current_time
+                stream = open_stream(self.rtsp_url)
+                if stream is None:
+                    reconnection_count += 1
+                    # Increase cooldown period exponentially up to max_reconnect_cooldown
+                    self.reconnect_cooldown = min(self.max_reconnect_cooldown, 2 ** min(reconnection_count, 4))
+                    continue
+                
+                self.connected = True
+                reconnection_count = 0
+                self.reconnect_cooldown = 5  # Reset to initial cooldown
+            
+            try:
+                success, frame = stream.read()
+            except Exception as e:
+                success, frame = False, None
+                logger.error(f"Error reading from stream: {e}")
+            
+            cache_entry = stream_cache.get(self.rtsp_url)
+            if success:
+                self.ring.put(frame, current_time)
+                inference = inference_workers.get(self.rtsp_url)
+                if inference is not None:
+                    inference.offer(frame, current_time)
+                if cache_entry:
+                    cache_entry['frames_read'] += 1
+                    cache_entry['failed_reads'] = 0
+                    cache_entry['health'] = 100
+                    cache_entry['last_access'] = current_time
+                continue
+            
+            failed = 1
+            if cache_entry:
+                cache_entry['failed_reads'] += 1
+                failed = cache_entry['failed_reads']
+                if failed > 3:  # After 3 failures, start reducing health
+                    cache_entry['health'] = max(0, 100 - (failed * 10))
+            
+            if failed > 5 or cache_entry is None:
+                # Only log reconnection message periodically to avoid spamming logs
+                if current_time - last_log_time >= 60:
+                    logger.warning(f"Lost connection to stream {self.rtsp_url}, attempting to reconnect...")
+                    last_log_time = current_time
+                self._release(stream)
+                stream = None
+                reconnection_count += 1
+                self.reconnect_cooldown = min(self.max_reconnect_cooldown, 2 ** min(reconnection_count, 4))
+            else:
+                time.sleep(0.05)
+        
+        self._release(stream)
+        self.running = False
+        with capture_workers_lock:
+            if capture_workers.get(self.rtsp_url) is self:
+                del capture_workers[self.rtsp_url]
+
+
+def get_capture_worker(rtsp_url):
+    """Get the shared capture worker for a stream, starting one if needed"""
+    with capture_workers_lock:
+        worker = capture_workers.get(rtsp_url)
+        if worker is None or not worker.is_alive():
+            worker = CaptureWorker(rtsp_url)
+            capture_workers[rtsp_url] = worker
+            worker.start()
+        return worker
+
+
+def stop_capture_worker(rtsp_url):
+    """Stop the capture worker for a stream if one is running"""
+    with capture_workers_lock:
+        worker = capture_workers.pop(rtsp_url, None)
+    if worker:
+        worker.stop()
+
+
+def recording_file_prefix(camera_name):
+    """Filename-safe camera name used as the prefix of recording files"""
+    return re.sub(r'[^A-Za-z0-9]+', '_', camera_name).strip('_').lower() or 'camera'
+
+
+class SegmentRecorder:
+    """Records one camera into rolling segment files without decoding it
+    
+    Runs ffmpeg in stream-copy mode with the segment muxer, so recording a
+    camera costs a remux instead of a decode and re-encode. ffmpeg reports
+    every finished segment on stdout (a CSV segment list), and the segment
+    is then registered with store_recording() along with its start time,
+    duration and size. Files are written to <recording path>/<stream_id>/
+    as <camera>_<YYYYmmdd>_<HHMMSS>.<format>.
     """
-    global ai_server_status
     
-    config = load_config()
-    if not config['ai_server']['enabled']:
-        return False, "AI server is disabled"
+    def __init__(self, stream_id, camera_name, rtsp_url, settings):
+        self.stream_id = stream_id
+        self.camera_name = camera_name
+        self.rtsp_url = rtsp_url
+        self.settings = settings
+        self.output_dir = os.path.join(settings['path'], stream_id)
+        self.process = None
+        self.running = False
+        self.thread = None
+        self.restart_cooldown = RECORDER_RESTART_COOLDOWN
+        self.segments_recorded = 0
+        self.last_segment_time = None
+        self.last_error = None
+        self.stderr_tail = deque(maxlen=20)
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"recorder-{self.stream_id}")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self._stop_process()
+    
+    def _stop_process(self):
+        process = self.process
+        if process is None or process.poll() is not None:
+            return
         
-    ai_server_url = config['ai_server']['url']
+        # SIGINT makes ffmpeg close the current segment properly, so it is playable and registered
+        try:
+            process.send_signal(signal.SIGINT)
+            process.wait(timeout=RECORDER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Recorder for {self.camera_name} did not stop in time, killing ffmpeg")
+            process.kill()
+        except OSError:
+            pass
     
-    # If URL doesn't start with http, add it
-    if not ai_server_url.startswith('http'):
-        ai_server_url = 'http://' + ai_server_url
+    def is_alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+    
+    def build_command(self):
+        """ffmpeg command line that remuxes the stream into rolling segments"""
+        segment_format = self.settings['format']
+        prefix = recording_file_prefix(self.camera_name)
         
-    full_url = f"{ai_server_url}/{endpoint.lstrip('/')}"
+        command = [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error']
+        if self.rtsp_url.startswith('rtsp'):
+            command += ['-rtsp_transport', 'tcp']
+        command += ['-i', self.rtsp_url, '-map', '0:v:0']
+        if self.settings.get('record_audio'):
+            command += ['-map', '0:a?']
+        command += [
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_time', str(self.settings['segment_seconds']),
+            '-segment_atclocktime', '1',  # Align segment boundaries to the wall clock
+            '-segment_format', segment_format,
+        ]
+        if segment_format == 'mp4':
+            # Put the index in front so players can start and seek with a few range requests
+            command += ['-segment_format_options', 'movflags=+faststart']
+        command += [
+            '-reset_timestamps', '1',
+            '-strftime', '1',
+            # Finished segments are reported on stdout as "filename,start,end"
+            '-segment_list', 'pipe:1',
+            '-segment_list_type', 'csv',
+            os.path.join(self.output_dir, f"{prefix}_%Y%m%d_%H%M%S.{segment_format}")
+        ]
+        return command
     
-    # Skip additional calls if we know the server is down (check every 30 seconds)
-    current_time = time.time()
-    if not ai_server_status['available'] and \
-       current_time - ai_server_status['last_check'] < ai_server_status['status_cache_time'] and \
-       ai_server_status['last_check'] > 0:
-        return False, f"AI server is unreachable: {ai_server_status['last_error']}"
+    def _drain_stderr(self, stream):
+        for line in stream:
+            line = line.decode(errors='replace').strip()
+            if line:
+                self.stderr_tail.append(line)
+    
+    def _consume(self, stdout):
+        """Handle ffmpeg's output until it exits - here, one segment list entry per line"""
+        for line in stdout:
+            self._segment_finished(line.decode(errors='replace'))
+    
+    def _run(self):
+        failures = 0
+        
+        while self.running:
+            os.makedirs(self.output_dir, exist_ok=True)
+            try:
+                self.process = subprocess.Popen(
+                    self.build_command(),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+            except OSError as e:
+                # ffmpeg missing or not executable - retrying won't help
+                self.last_error = f"Could not start ffmpeg: {e}"
+                logger.error(f"Recorder for {self.camera_name}: {self.last_error}")
+                break
+            
+            logger.info(f"Recording {self.camera_name} ({self.settings['mode']}) to {self.output_dir}")
+            stderr_thread = threading.Thread(target=self._drain_stderr, args=(self.process.stderr,))
+            stderr_thread.daemon = True
+            stderr_thread.start()
+            started = time.time()
+            
+            consume_error = None
+            try:
+                self._consume(self.process.stdout)
+            except Exception as e:
+                # Nobody reads ffmpeg's stdout any more - stop it rather than leave it blocked on the pipe
+                consume_error = f"Error handling ffmpeg output: {e}"
+                logger.error(f"Recorder for {self.camera_name}: {consume_error}", exc_info=True)
+                self.process.stdout.close()
+                self._stop_process()
+            returncode = self.process.wait()
+            
+            if not self.running:
+                break
+            
+            # ffmpeg exited on its own (usually the camera went offline) or was stopped after an error
+            failures = 0 if time.time() - started > RECORDER_MAX_RESTART_COOLDOWN else failures + 1
+            self.restart_cooldown = min(RECORDER_MAX_RESTART_COOLDOWN, RECORDER_RESTART_COOLDOWN * 2 ** min(failures, 4))
+            self.last_error = consume_error or (self.stderr_tail[-1] if self.stderr_tail else f"ffmpeg exited with code {returncode}")
+            logger.warning(f"Recorder for {self.camera_name} stopped ({self.last_error}), "
+                           f"restarting in {self.restart_cooldown}s")
+            
+            deadline = time.time() + self.restart_cooldown
+            while self.running and time.time() < deadline:
+                time.sleep(0.5)
+        
+        self.running = False
+        with recorders_lock:
+            if recorders.get(self.stream_id) is self:
+                del recorders[self.stream_id]
+    
+    def _segment_finished(self, line):
+        """Register one finished segment reported by ffmpeg"""
+        try:
+            filename, start, end = next(csv.reader([line.strip()]))
+            duration = max(0.0, float(end) - float(start))
+        except (StopIteration, ValueError):
+            logger.warning(f"Unexpected segment list entry from ffmpeg: {line.strip()}")
+            return
+        
+        filename = os.path.basename(filename)
+        path = os.path.join(self.output_dir, filename)
+        if not os.path.exists(path):
+            logger.warning(f"Finished segment not found: {path}")
+            return
+        
+        # The filename carries the wall-clock time the segment started
+        timestamp = None
+        match = RECORDING_FILENAME_RE.match(filename)
+        if match:
+            try:
+                timestamp = datetime.strptime(match.group(2) + match.group(3), "%Y%m%d%H%M%S")
+            except ValueError:
+                pass
+        
+        store_recording(
+            self.stream_id,
+            self.camera_name,
+            path,
+            store_binary=self.settings.get('storage_mode') == 'database',
+            timestamp=timestamp,
+            duration=duration,
+            on_stored=lambda recording: thumbnail_worker.wake()
+        )
+        self.segments_recorded += 1
+        self.last_segment_time = time.time()
     
-    for attempt in range(retry):
+    def get_status(self):
+        """Recorder state for the status API"""
+        return {
+            'active': self.is_alive() and self.process is not None and self.process.poll() is None,
+            'segments_recorded': self.segments_recorded,
+            'last_segment': datetime.fromtimestamp(self.last_segment_time).isoformat() if self.last_segment_time else None,
+            'last_error': self.last_error
+        }
+
+
+class TsKeyframeScanner:
+    """Finds video keyframes in a packet-aligned MPEG-TS byte stream
+    
+    Keeps the latest PAT and PMT packets (needed at the start of any clip cut
+    from the stream) and learns the video PID from the PMT. Keyframes are the
+    video packets that start a PES with the random access indicator set,
+    which ffmpeg's mpegts muxer sets on every keyframe. Packet headers are
+    inspected with NumPy, not one Python loop iteration per packet.
+    """
+    
+    def __init__(self):
+        self.pmt_pids = set()
+        self.video_pid = None
+        self.psi_packets = {}  # PID -> latest PAT/PMT packet
+    
+    def headers(self):
+        """PAT followed by the PMT(s), to prepend to a clip"""
+        return b''.join(packet for pid, packet in sorted(self.psi_packets.items()))
+    
+    def scan(self, data):
+        """Return byte offsets of packets in data that start a video keyframe"""
+        packets = np.frombuffer(data, np.uint8).reshape(-1, TS_PACKET_SIZE)
+        pids = ((packets[:, 1] & 0x1f).astype(np.int32) << 8) | packets[:, 2]
+        unit_start = (packets[:, 1] & 0x40) != 0
+        
+        # PAT first, so a PMT in the same chunk is recognised
+        for i in np.flatnonzero(unit_start & (pids == 0)):
+            self._parse_psi(0, bytes(packets[i]))
+        for i in np.flatnonzero(unit_start & np.isin(pids, list(self.pmt_pids))):
+            self._parse_psi(int(pids[i]), bytes(packets[i]))
+        
+        if self.video_pid is None:
+            return []
+        
+        has_adaptation = (packets[:, 3] & 0x20) != 0
+        random_access = has_adaptation & (packets[:, 4] > 0) & ((packets[:, 5] & 0x40) != 0)
+        starts = np.flatnonzero(random_access & unit_start & (pids == self.video_pid))
+        return (starts * TS_PACKET_SIZE).tolist()
+    
+    def _parse_psi(self, pid, packet):
+        start = 4
+        if packet[3] & 0x20:
+            start += 1 + packet[4]  # Skip the adaptation field
+        if start >= TS_PACKET_SIZE:
+            return
+        section = packet[start + 1 + packet[start]:]  # Skip the pointer field
+        if len(section) < 12:
+            return
+        section_length = ((section[1] & 0x0f) << 8) | section[2]
+        body = section[8:min(len(section), 3 + section_length) - 4]  # Without header and CRC
+        
+        if pid == 0 and section[0] == 0x00:
+            # PAT: program number -> PMT PID
+            for i in range(0, len(body) - 3, 4):
+                if (body[i] << 8) | body[i + 1]:
+                    self.pmt_pids.add(((body[i + 2] & 0x1f) << 8) | body[i + 3])
+        elif section[0] == 0x02:
+            # PMT: elementary streams follow the PCR PID and program descriptors
+            i = 4 + (((body[2] & 0x0f) << 8) | body[3])
+            while i + 5 <= len(body):
+                stream_type = body[i]
+                es_pid = ((body[i + 1] & 0x1f) << 8) | body[i + 2]
+                if stream_type in TS_VIDEO_STREAM_TYPES and self.video_pid is None:
+                    self.video_pid = es_pid
+                i += 5 + (((body[i + 3] & 0x0f) << 8) | body[i + 4])
+        else:
+            return
+        self.psi_packets[pid] = packet
+
+
+class PreEventBuffer:
+    """Bounded in-memory ring of recent compressed video, one entry per GOP
+    
+    Each entry starts at a keyframe, so the buffer can be written out as the
+    decodable start of a clip. Old GOPs are dropped once the remaining ones
+    still cover max_seconds, or when the total exceeds max_bytes.
+    """
+    
+    def __init__(self, max_seconds, max_bytes):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.gops = deque()  # [start_time, bytearray]
+        self.size = 0
+    
+    def append(self, data, keyframe_offsets, now):
+        position = 0
+        for offset in keyframe_offsets:
+            # Data before the first keyframe can't be decoded on its own - drop it
+            if self.gops and offset > position:
+                self.gops[-1][1] += data[position:offset]
+                self.size += offset - position
+            self.gops.append([now, bytearray()])
+            position = offset
+        
+        if self.gops and position < len(data):
+            self.gops[-1][1] += data[position:]
+            self.size += len(data) - position
+        
+        # Always keep the GOP being filled, even if it alone exceeds the memory cap
+        while len(self.gops) > 1 and (self.gops[1][0] <= now - self.max_seconds or self.size > self.max_bytes):
+            self.size -= len(self.gops.popleft()[1])
+    
+    def seconds(self, now):
+        return now - self.gops[0][0] if self.gops else 0.0
+
+
+class EventRecorder(SegmentRecorder):
+    """Detection-triggered recorder that includes the seconds before the detection
+    
+    ffmpeg stream-copies the camera to MPEG-TS on stdout. The packets are kept
+    in a PreEventBuffer (compressed data, a few MB per camera), and when
+    trigger() is called for a matching detection the buffer is written out as
+    the start of an event clip, followed by live packets until
+    post_event_seconds after the last trigger. Finished clips are remuxed to
+    the recording format and registered with their event ID and labels.
+    
+    Detection only runs for streams that are being decoded, so this recorder
+    also keeps the camera's capture and inference workers alive.
+    """
+    
+    def __init__(self, stream_id, camera_name, rtsp_url, settings):
+        super().__init__(stream_id, camera_name, rtsp_url, settings)
+        self.buffer = PreEventBuffer(settings['pre_event_seconds'], settings['pre_event_max_mb'] * 1024 * 1024)
+        self.scanner = TsKeyframeScanner()
+        self.lock = threading.Lock()
+        self.event_until = 0  # Guarded by lock, as is event_labels
+        self.event_labels = set()
+        self.clip = None
+        self.continue_clip = False  # Start the next clip at a keyframe instead of from the buffer
+        self.events_recorded = 0
+        self.last_keepalive = 0
+    
+    def build_command(self):
+        """ffmpeg command line that remuxes the stream to MPEG-TS on stdout"""
+        command = [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error']
+        if self.rtsp_url.startswith('rtsp'):
+            command += ['-rtsp_transport', 'tcp']
+        command += ['-i', self.rtsp_url, '-map', '0:v:0']
+        if self.settings.get('record_audio'):
+            command += ['-map', '0:a?']
+        command += ['-c', 'copy', '-f', 'mpegts', 'pipe:1']
+        return command
+    
+    def trigger(self, labels):
+        """Start an event clip, or extend the current one, for a matching detection"""
+        with self.lock:
+            self.event_until = time.time() + self.settings['post_event_seconds']
+            self.event_labels.update(labels)
+    
+    def _consume(self, stdout):
         try:
-            headers = {}
+            self._read_packets(stdout)
+        finally:
+            if self.clip is not None:
+                self._close_clip(time.time())
+    
+    def _read_packets(self, stdout):
+        pending = b''
+        while True:
+            data = stdout.read1(TS_READ_SIZE)
+            if not data:
+                break
             
-            # Set appropriate content type headers based on request type
-            # Note: Don't set Content-Type when using files parameter, as requests will set it automatically
-            if data and not files:
-                headers['Content-Type'] = 'image/jpeg'
-            elif json_data:
-                headers['Content-Type'] = 'application/json'
-                
-            # Debug log to see what's being sent
-            logger.debug(f"AI server request to {full_url}, method={method}, headers={headers}")
-            if params:
-                logger.debug(f"Request params: {params}")
+            # Only handle whole packets; keep the remainder for the next read
+            data = pending + data
+            usable = len(data) - len(data) % TS_PACKET_SIZE
+            data, pending = data[:usable], data[usable:]
+            if not data:
+                continue
+            if data[0] != 0x47:
+                logger.error(f"Lost MPEG-TS sync for {self.camera_name}, restarting recorder")
+                break
             
-            # Make the request based on the method
-            if method.lower() == 'get':
-                response = requests.get(full_url, params=params, headers=headers, timeout=timeout)
-            elif method.lower() == 'post':
-                if files:
-                    # When sending files, let requests handle the Content-Type header
-                    response = requests.post(
-                        full_url, 
-                        files=files,
-                        params=params,
-                        timeout=timeout
-                    )
-                else:
-                    response = requests.post(
-                        full_url, 
-                        data=data, 
-                        json=json_data,
-                        params=params,
-                        headers=headers,
-                        timeout=timeout
-                    )
-            else:
-                return False, f"Unsupported HTTP method: {method}"
+            now = time.time()
+            keyframes = self.scanner.scan(data)
+            self.buffer.append(data, keyframes, now)
+            self._update_clip(data, keyframes, now)
             
-            # Log response info for debugging
-            logger.debug(f"AI server response: {response.status_code}")
-            if response.status_code != 200:
-                logger.debug(f"AI server error response: {response.text}")
-                
-            # Update AI server status
-            ai_server_status['last_check'] = current_time
-            ai_server_status['available'] = True
-            ai_server_status['last_error'] = None
+            if now - self.last_keepalive >= EVENT_KEEPALIVE_INTERVAL:
+                self.last_keepalive = now
+                self._keep_detection_running(now)
+    
+    def _keep_detection_running(self, now):
+        if not ai_client.enabled:
+            return
+        capture = get_capture_worker(self.rtsp_url)
+        capture.last_viewer_time = now
+        get_inference_worker(self.rtsp_url, self.stream_id)
+    
+    def _update_clip(self, data, keyframes, now):
+        with self.lock:
+            active = now < self.event_until
+            labels, self.event_labels = self.event_labels, set()
+        
+        if self.clip is None:
+            if not active:
+                self.continue_clip = False
+                return
+            if self.continue_clip:
+                # Continuation of a split event: start at the next keyframe
+                if not keyframes:
+                    return
+                self._open_clip(now, [data[keyframes[0]:]])
+                self.continue_clip = False
+            elif self.buffer.gops:
+                # New event: the buffered pre-roll (which already holds this data) comes first
+                self._open_clip(self.buffer.gops[0][0], [bytes(gop) for _, gop in self.buffer.gops])
+            if self.clip is not None:
+                self.clip['labels'] |= labels
+            return
+        
+        self.clip['labels'] |= labels
+        if not active:
+            self.clip['file'].write(data)
+            self._close_clip(now)
+        elif now - self.clip['start_time'] >= self.settings['max_event_seconds'] and keyframes:
+            # Split long events at a keyframe so both clips are decodable
+            self.clip['file'].write(data[:keyframes[0]])
+            self._close_clip(now)
+            self._open_clip(now, [data[keyframes[0]:]])
+            self.continue_clip = False
+        else:
+            self.clip['file'].write(data)
+    
+    def _open_clip(self, start_time, chunks):
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"{recording_file_prefix(self.camera_name)}_{datetime.fromtimestamp(start_time).strftime('%Y%m%d_%H%M%S')}"
+        path = os.path.join(self.output_dir, f".{name}.ts")
+        try:
+            clip_file = open(path, 'wb')
+            clip_file.write(self.scanner.headers())
+            for chunk in chunks:
+                clip_file.write(chunk)
+        except OSError as e:
+            logger.error(f"Could not start event clip for {self.camera_name}: {e}")
+            self.last_error = str(e)
+            return
+        self.clip = {'file': clip_file, 'path': path, 'name': name, 'start_time': start_time, 'labels': set()}
+        logger.info(f"Event recording started for {self.camera_name}")
+    
+    def _close_clip(self, end_time):
+        clip, self.clip = self.clip, None
+        clip['file'].close()
+        if self.running and end_time - clip['start_time'] >= self.settings['max_event_seconds']:
+            self.continue_clip = True
+        
+        # Remuxing takes a moment - don't hold up reading the stream
+        thread = threading.Thread(target=self._finish_clip, args=(clip, end_time), name=f"event-clip-{self.stream_id}")
+        thread.daemon = True
+        thread.start()
+    
+    def _finish_clip(self, clip, end_time):
+        """Remux a finished MPEG-TS clip to the recording format and register it"""
+        path = os.path.join(self.output_dir, f"{clip['name']}.{self.settings['format']}")
+        command = [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y',
+                   '-i', clip['path'], '-map', '0', '-c', 'copy']
+        if self.settings['format'] == 'mp4':
+            command += ['-movflags', '+faststart']
+        command.append(path)
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=120)
+            failed = result.returncode != 0
+            error = result.stderr.decode(errors='replace').strip()
+        except (OSError, subprocess.TimeoutExpired) as e:
+            failed, error = True, str(e)
+        
+        if failed:
+            # Keep the raw MPEG-TS so the event isn't lost
+            fallback = os.path.join(self.output_dir, f"{clip['name']}.ts")
+            os.replace(clip['path'], fallback)
+            self.last_error = f"Could not remux event clip: {error}"
+            logger.error(f"{self.camera_name}: {self.last_error} (kept {fallback})")
+            return
+        
+        os.remove(clip['path'])
+        store_recording(
+            self.stream_id,
+            self.camera_name,
+            path,
+            store_binary=self.settings.get('storage_mode') == 'database',
+            timestamp=datetime.fromtimestamp(clip['start_time']),
+            duration=end_time - clip['start_time'],
+            event_id=str(uuid.uuid4()),
+            tags=sorted(clip['labels']),
+            on_stored=lambda recording: thumbnail_worker.wake()
+        )
+        self.events_recorded += 1
+        self.last_segment_time = time.time()
+        logger.info(f"Event clip saved for {self.camera_name}: {path} ({', '.join(sorted(clip['labels']))})")
+    
+    def get_status(self):
+        status = super().get_status()
+        now = time.time()
+        with self.lock:
+            event_active = now < self.event_until
+        status.update({
+            'event_active': event_active or self.clip is not None,
+            'events_recorded': self.events_recorded,
+            'pre_event_seconds': round(self.buffer.seconds(now), 1),
+            'pre_event_bytes': self.buffer.size
+        })
+        return status
+
+
+def event_trigger_labels(predictions, settings):
+    """Labels of the detections that should start or extend an event clip
+    
+    A detection counts if its label is in recording.event_labels (or that list
+    is empty) and, when event_require_roi is set and the stream has ROIs, it
+    lies inside at least one ROI (see apply_roi_filter()).
+    """
+    wanted = {label.lower() for label in settings.get('event_labels') or []}
+    labels = set()
+    for pred in predictions:
+        if not isinstance(pred, dict):
+            continue
+        label = str(pred.get('label', 'unknown')).lower()
+        if wanted and label not in wanted:
+            continue
+        if settings.get('event_require_roi', True) and 'rois' in pred and not pred['rois']:
+            continue
+        labels.add(label)
+    return labels
+
+
+def trigger_event_recording(stream_id, predictions):
+    """Start or extend an event clip on the stream's event recorder for matching detections"""
+    recorder = recorders.get(stream_id)
+    if not isinstance(recorder, EventRecorder) or not predictions:
+        return
+    labels = event_trigger_labels(predictions, recorder.settings)
+    if labels:
+        recorder.trigger(labels)
+
+
+def recording_settings(config=None):
+    """Recording options with defaults filled in and validated"""
+    settings = dict(DEFAULT_CONFIG['recording'])
+    settings.update((config or load_config()).get('recording', {}))
+    if settings.get('format') not in RECORDING_FORMATS:
+        settings['format'] = 'mp4'
+    if settings.get('mode') not in RECORDING_MODES:
+        settings['mode'] = 'continuous'
+    try:
+        settings['segment_seconds'] = max(10, int(settings.get('segment_seconds', 300)))
+    except (TypeError, ValueError):
+        settings['segment_seconds'] = 300
+    return settings
+
+
+def stop_recorder(stream_id):
+    """Stop a camera's recorder, letting ffmpeg finish its current segment"""
+    with recorders_lock:
+        recorder = recorders.pop(stream_id, None)
+    if recorder:
+        recorder.stop()
+
+
+def sync_recorders(config=None):
+    """Start, stop or restart recorders so they match the stream and recording settings"""
+    settings = recording_settings(config)
+    streams = load_stream_config()
+    
+    wanted = {}
+    if settings['mode'] != 'off' and settings.get('path'):
+        for stream_id, stream_info in streams.items():
+            if stream_info.get('enabled', True) and stream_info.get('url'):
+                wanted[stream_id] = stream_info
+    
+    with recorders_lock:
+        running = dict(recorders)
+    
+    for stream_id, recorder in running.items():
+        stream_info = wanted.get(stream_id)
+        if stream_info is None or recorder.rtsp_url != stream_info['url'] or \
+                recorder.camera_name != stream_info['name'] or recorder.settings != settings:
+            stop_recorder(stream_id)
+    
+    for stream_id, stream_info in wanted.items():
+        with recorders_lock:
+            if stream_id in recorders:
+                continue
+            recorder_class = EventRecorder if settings['mode'] == 'events' else SegmentRecorder
+            recorder = recorders[stream_id] = recorder_class(stream_id, stream_info['name'], stream_info['url'], settings)
+        recorder.start()
+
+
+class ThumbnailWorker:
+    """Background job that builds a keyframe sprite sheet for every recording
+    
+    ffmpeg decodes only the keyframes (-skip_frame nokey), keeps one per
+    thumbnail interval, scales it to THUMBNAIL_WIDTH and tiles the results
+    into a single JPEG. The tile times are read from the showinfo filter, so
+    the index holds the real keyframe offsets rather than nominal ones.
+    Sprites are stored in the recording_thumbnails table next to their
+    Recording row, newest recordings first.
+    """
+    
+    def __init__(self):
+        self.thread = None
+        self.wake_event = threading.Event()
+        self.sprites_built = 0
+        self.last_error = None
+    
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="thumbnails")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def wake(self):
+        """Look for new recordings now instead of at the next poll"""
+        self.wake_event.set()
+    
+    def _run(self):
+        while True:
+            settings = recording_settings()
+            pending = get_recordings_without_thumbnails(THUMBNAIL_BATCH) if settings.get('thumbnails', True) else []
+            for recording in pending:
+                self.build(recording, settings.get('thumbnail_interval', 10))
             
-            if response.status_code == 200:
-                return True, response
-            else:
-                error_msg = f"AI server returned error: HTTP {response.status_code}"
-                if response.text:
-                    error_msg += f" - {response.text}"
-                logger.warning(error_msg)
-                if attempt + 1 < retry:
-                    logger.info(f"Retrying AI server call ({attempt+1}/{retry})")
-                    time.sleep(1)  # Wait a second before retrying
-                    continue
-                return False, error_msg
-                
-        except requests.exceptions.ConnectionError as e:
-            ai_server_status['available'] = False
-            ai_server_status['last_error'] = "Connection error"
-            logger.warning(f"AI server connection failed: {str(e)}")
-        except requests.exceptions.Timeout as e:
-            ai_server_status['available'] = False
-            ai_server_status['last_error'] = "Timeout"
-            logger.warning(f"AI server timeout: {str(e)}")
-        except Exception as e:
-            ai_server_status['available'] = False
-            ai_server_status['last_error'] = str(e)
-            logger.error(f"Error calling AI server: {str(e)}")
+            if len(pending) < THUMBNAIL_BATCH:
+                delete_orphaned_thumbnails()
+                self.wake_event.wait(THUMBNAIL_POLL_INTERVAL)
+                self.wake_event.clear()
+    
+    def build_command(self, path, interval, rows):
+        """ffmpeg command line that writes the sprite JPEG to stdout"""
+        filters = ','.join([
+            f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{interval})'",
+            'showinfo',
+            f'scale={THUMBNAIL_WIDTH}:-2',
+            f'tile={THUMBNAIL_COLUMNS}x{rows}'
+        ])
+        return [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'info',
+                '-skip_frame', 'nokey', '-i', path,
+                '-map', '0:v:0', '-an', '-vf', filters, '-vsync', 'vfr',
+                '-frames:v', '1', '-q:v', '5', '-c:v', 'mjpeg', '-f', 'image2pipe', 'pipe:1']
+    
+    def build(self, recording, interval):
+        """Build and store the sprite sheet of one recording"""
+        if not recording.path or not os.path.isfile(recording.path):
+            store_thumbnails(recording.id, error="Recording file not found")
+            return
+        
+        # Spread the tiles wider on long recordings to bound the sprite size
+        if recording.duration:
+            interval = max(interval, recording.duration / THUMBNAIL_MAX_TILES)
+        tiles = min(THUMBNAIL_MAX_TILES, int(recording.duration // interval) + 1) if recording.duration else THUMBNAIL_MAX_TILES
+        rows = -(-tiles // THUMBNAIL_COLUMNS)
+        
+        try:
+            result = subprocess.run(self.build_command(recording.path, interval, rows),
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    timeout=THUMBNAIL_TIMEOUT)
+            log = result.stderr.decode(errors='replace')
+            sprite = cv2.imdecode(np.frombuffer(result.stdout, np.uint8), cv2.IMREAD_COLOR) if result.stdout else None
+            if result.returncode != 0 or sprite is None:
+                raise RuntimeError(log.strip().splitlines()[-1] if log.strip() else f"ffmpeg exited with {result.returncode}")
+        except FileNotFoundError as e:
+            # ffmpeg missing - leave the recording pending rather than failing it
+            self.last_error = str(e)
+            return
+        except (OSError, subprocess.TimeoutExpired, RuntimeError) as e:
+            self.last_error = f"Recording {recording.id}: {e}"
+            logger.warning(f"Could not build thumbnails for recording {recording.id}: {e}")
+            store_thumbnails(recording.id, error=str(e))
+            return
+        
+        times = [round(float(t), 3) for t in THUMBNAIL_PTS_RE.findall(log)]
+        tile_height = sprite.shape[0] // rows
+        tile_width = sprite.shape[1] // THUMBNAIL_COLUMNS
+        
+        # Drop the empty rows tile pads the sheet with when there were fewer keyframes
+        used_rows = max(1, -(-len(times) // THUMBNAIL_COLUMNS))
+        data = result.stdout
+        if used_rows < rows:
+            _, encoded = cv2.imencode('.jpg', sprite[:used_rows * tile_height], [cv2.IMWRITE_JPEG_QUALITY, 80])
+            data = encoded.tobytes()
+        
+        store_thumbnails(recording.id, sprite=data, columns=THUMBNAIL_COLUMNS, rows=used_rows,
+                         tile_width=tile_width, tile_height=tile_height, interval=interval, times=times)
+        self.sprites_built += 1
+
+
+thumbnail_worker = ThumbnailWorker()
+
+
+def export_settings(config=None):
+    """Export job options with defaults filled in"""
+    settings = dict(DEFAULT_CONFIG['export'])
+    settings.update((config or load_config()).get('export', {}))
+    settings['path'] = settings.get('path') or EXPORTS_DIR
+    try:
+        settings['max_concurrent'] = max(1, int(settings.get('max_concurrent', 2)))
+    except (TypeError, ValueError):
+        settings['max_concurrent'] = 2
+    return settings
+
+
+class ExportWorker:
+    """Pool of threads running the queued export jobs
+    
+    At most max_concurrent jobs copy at a time (a pool size change applies
+    after a restart). The queue lives in the export_jobs table, so jobs
+    outlive the request that created them; jobs that were running when the
+    application stopped are queued again at start and resume from their
+    manifest.
+    """
+    
+    def __init__(self):
+        self.threads = []
+        self.wake_event = threading.Event()
+        self.lock = threading.Lock()
+    
+    def start(self):
+        with self.lock:
+            if any(thread.is_alive() for thread in self.threads):
+                return
+            requeue_interrupted_export_jobs()
+            self.threads = []
+            for index in range(export_settings()['max_concurrent']):
+                thread = threading.Thread(target=self._run, name=f"export-{index}")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+    
+    def wake(self):
+        """Look for queued jobs now instead of at the next poll"""
+        self.wake_event.set()
+    
+    def _run(self):
+        while True:
+            job = claim_export_job()
+            if job is None:
+                self.wake_event.wait(EXPORT_POLL_INTERVAL)
+                self.wake_event.clear()
+                continue
+            logger.info(f"Starting export job {job.id} ({job.total_files} recordings)")
+            run_export_job(job)
+
+
+export_worker = ExportWorker()
+
+class AIClient:
+    """Client for the AI server with connection pooling and a circuit breaker
+    
+    - One keep-alive requests.Session shared by all threads, so detections
+      reuse TCP connections instead of handshaking on every call
+    - Circuit breaker: after AI_FAILURE_THRESHOLD consecutive failures the
+      circuit opens and calls fail fast; after a jittered, exponentially
+      growing backoff one trial call is let through (half-open) and its
+      outcome closes or re-opens the circuit
+    - Per-endpoint request/error counters and recent latencies
+    - A background prober that keeps the last /health result, so the NVR's
+      /health route never has to make a live call
+    
+    Configuration is cached; call configure() when the AI settings change.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=AI_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        self.config = {}
+        self.base_url = None
+        
+        # Circuit breaker state
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0  # Consecutive times the circuit opened without recovering
+        self.open_until = 0
+        self.trial_in_flight = False
+        self.last_error = None
+        
+        # Per-endpoint metrics
+        self.endpoint_stats = {}
+        
+        # Last health probe result
+        self.health = {'status': 'UNKNOWN', 'checked_at': None}
+        self.prober = None
+    
+    def configure(self, ai_config):
+        """Apply AI server settings (URL, enabled flag, batching options)"""
+        url = ai_config.get('url', '')
+        # If URL doesn't start with http, add it
+        if url and not url.startswith('http'):
+            url = 'http://' + url
+        with self.lock:
+            url_changed = url.rstrip('/') != self.base_url
+            self.config = dict(ai_config)
+            self.base_url = url.rstrip('/')
+            if url_changed:
+                # A different server starts with a clean slate
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+                self.trips = 0
+                self.last_error = None
+    
+    @property
+    def enabled(self):
+        return bool(self.config.get('enabled'))
+    
+    def start_health_prober(self):
+        if self.prober is None or not self.prober.is_alive():
+            self.prober = threading.Thread(target=self._probe_loop, name="ai-health-prober")
+            self.prober.daemon = True
+            self.prober.start()
+    
+    # Circuit breaker
+    
+    def _allow_request(self):
+        """Decide whether a call may go out; returns an error message if it may not"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return None
+            if self.state == self.OPEN and time.time() >= self.open_until:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return None
+            return f"AI server is unreachable: {self.last_error} (circuit {self.state})"
+    
+    def _record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("AI server recovered, closing circuit")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trips = 0
+            self.trial_in_flight = False
+            self.last_error = None
+    
+    def _record_failure(self, error):
+        with self.lock:
+            self.last_error = error
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= AI_FAILURE_THRESHOLD:
+                self.trips += 1
+                backoff = min(AI_BACKOFF_BASE * (2 ** (self.trips - 1)), AI_BACKOFF_MAX)
+                # Jitter so many NVRs (or restarts) don't hammer a recovering server in lockstep
+                backoff *= random.uniform(0.5, 1.5)
+                self.open_until = time.time() + backoff
+                if self.state != self.OPEN:
+                    logger.warning(f"AI server failing ({error}), opening circuit for {backoff:.1f}s")
+                self.state = self.OPEN
+    
+    # Metrics
+    
+    def _record_stats(self, endpoint, latency, error=None):
+        with self.lock:
+            stats = self.endpoint_stats.get(endpoint)
+            if stats is None:
+                stats = self.endpoint_stats[endpoint] = {
+                    'requests': 0,
+                    'errors': 0,
+                    'latencies': deque(maxlen=AI_LATENCY_WINDOW),
+                    'last_error': None
+                }
+            stats['requests'] += 1
+            stats['latencies'].append(latency)
+            if error:
+                stats['errors'] += 1
+                stats['last_error'] = error
+    
+    def latency_percentile(self, endpoint, percentile):
+        """Latency in seconds at the given percentile over recent calls, or None without data"""
+        with self.lock:
+            stats = self.endpoint_stats.get(endpoint)
+            latencies = sorted(stats['latencies']) if stats else []
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))
+        return latencies[index]
+    
+    def detection_latency_p95(self):
+        """Worst p95 latency in seconds across the detection endpoints, or None without data"""
+        latencies = [
+            self.latency_percentile(endpoint, 95)
+            for endpoint in list(self.endpoint_stats)
+            if endpoint.startswith('predict')
+        ]
+        latencies = [latency for latency in latencies if latency is not None]
+        return max(latencies) if latencies else None
+    
+    def get_stats(self):
+        """Snapshot of circuit state and per-endpoint counters"""
+        with self.lock:
+            endpoints = {
+                endpoint: {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'last_error': stats['last_error']
+                }
+                for endpoint, stats in self.endpoint_stats.items()
+            }
+            circuit = {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'retry_in': max(0, round(self.open_until - time.time(), 1)) if self.state == self.OPEN else 0,
+                'last_error': self.last_error
+            }
+        for endpoint in endpoints:
+            for percentile in (50, 95):
+                latency = self.latency_percentile(endpoint, percentile)
+                endpoints[endpoint][f'p{percentile}_ms'] = round(latency * 1000, 1) if latency is not None else None
+        return {'circuit': circuit, 'endpoints': endpoints}
+    
+    # Requests
+    
+    def request(self, endpoint, method='get', data=None, json_data=None, params=None, retry=1, timeout=5, files=None):
+        """
+        Call the AI server
+        
+        Args:
+            endpoint (str): API endpoint path (without base URL)
+            method (str): HTTP method to use ('get', 'post', etc.)
+            data (bytes): Binary data to send
+            json_data (dict): JSON data to send
+            params (dict): URL parameters 
+            retry (int): Number of retry attempts
+            timeout (int): Timeout in seconds
+            files (dict): Files to send in multipart/form-data format
+            
+        Returns:
+            tuple: (success, result) where result is response or error message
+        """
+        if not self.enabled:
+            return False, "AI server is disabled"
+        
+        endpoint = endpoint.lstrip('/')
+        full_url = f"{self.base_url}/{endpoint}"
+        method = method.lower()
+        if method not in ('get', 'post'):
+            return False, f"Unsupported HTTP method: {method}"
+        
+        headers = {}
+        # Set appropriate content type headers based on request type
+        # Note: Don't set Content-Type when using files parameter, as requests will set it automatically
+        if data and not files:
+            headers['Content-Type'] = 'image/jpeg'
+        
+        error_msg = "Max retries exceeded"
+        for attempt in range(retry):
+            rejected = self._allow_request()
+            if rejected:
+                return False, rejected
+            
+            start = time.time()
+            try:
+                logger.debug(f"AI server request to {full_url}, method={method}, params={params}")
+                if method == 'get':
+                    response = self.session.get(full_url, params=params, headers=headers, timeout=timeout)
+                else:
+                    response = self.session.post(
+                        full_url,
+                        data=data,
+                        json=json_data,
+                        files=files,
+                        params=params,
+                        headers=headers,
+                        timeout=timeout
+                    )
+                latency = time.time() - start
+                
+                if response.status_code == 200:
+                    self._record_stats(endpoint, latency)
+                    self._record_success()
+                    return True, response
+                
+                error_msg = f"AI server returned error: HTTP {response.status_code}"
+                if response.text:
+                    error_msg += f" - {response.text}"
+                self._record_stats(endpoint, latency, error_msg)
+                if response.status_code >= 500:
+                    self._record_failure(f"HTTP {response.status_code}")
+                else:
+                    # The server answered; a client error says nothing about its health
+                    self._record_success()
+                    logger.warning(error_msg)
+                    return False, error_msg
+                logger.warning(error_msg)
+            except requests.exceptions.ConnectionError as e:
+                error_msg = "Connection error"
+                self._record_stats(endpoint, time.time() - start, error_msg)
+                self._record_failure(error_msg)
+                logger.warning(f"AI server connection failed: {str(e)}")
+            except requests.exceptions.Timeout as e:
+                error_msg = "Timeout"
+                self._record_stats(endpoint, time.time() - start, error_msg)
+                self._record_failure(error_msg)
+                logger.warning(f"AI server timeout: {str(e)}")
+            except Exception as e:
+                error_msg = str(e)
+                self._record_stats(endpoint, time.time() - start, error_msg)
+                self._record_failure(error_msg)
+                logger.error(f"Error calling AI server: {str(e)}")
+            
+            # Only retry if we haven't tried the max number of times
+            if attempt + 1 < retry:
+                logger.info(f"Retrying AI server call ({attempt+1}/{retry})")
+                time.sleep(1)  # Wait a second before retrying
+        
+        return False, error_msg
+    
+    # Health probing
+    
+    def probe_health(self):
+        """Call the AI server's health endpoint directly (bypassing the circuit) and cache the result"""
+        if not self.enabled:
+            self.health = {'status': 'DISABLED', 'checked_at': datetime.now().isoformat()}
+            return self.health
+        
+        start = time.time()
+        try:
+            response = self.session.get(f"{self.base_url}/health", timeout=2)
+            self._record_stats('health', time.time() - start)
+            if response.status_code == 200:
+                try:
+                    health = response.json()
+                except ValueError:
+                    health = {}
+                if not isinstance(health, dict):
+                    health = {'response': health}
+                health.setdefault('status', 'UP')
+                self._record_success()
+            else:
+                health = {'status': 'DOWN', 'error': f"HTTP {response.status_code}"}
+                if response.status_code >= 500:
+                    self._record_failure(health['error'])
+        except requests.exceptions.RequestException as e:
+            error = "Timeout" if isinstance(e, requests.exceptions.Timeout) else "Connection error"
+            self._record_stats('health', time.time() - start, error)
+            self._record_failure(error)
+            health = {'status': 'DOWN', 'error': error}
+        
+        health['checked_at'] = datetime.now().isoformat()
+        self.health = health
+        return health
+    
+    def _probe_loop(self):
+        while True:
+            try:
+                self.probe_health()
+            except Exception as e:
+                logger.error(f"Error probing AI server health: {e}")
+            time.sleep(AI_HEALTH_PROBE_INTERVAL)
+
+
+# Shared AI server client, configured from config.json at startup and on settings changes
+ai_client = AIClient()
+ai_client.configure(load_config()['ai_server'])
+
+
+class DetectionBatcher:
+    """Collects detection requests from many streams and sends them as one batch
+    
+    Inference workers call detect() and block until their result arrives. A
+    single thread gathers requests for up to batch_window_ms (or until
+    batch_max_size requests are queued), posts them to the AI server in one
+    request - predict_batch for JPEG uploads, predict_batch_shm for
+    shared-memory frame descriptors - and hands each stream its own
+    detections back.
+    """
+    
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.unsupported_until = {}  # endpoint -> time; server lacks it, retry afterwards
+        self.thread = threading.Thread(target=self._run, name="detection-batcher")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def available(self, endpoint='predict_batch'):
+        return time.time() >= self.unsupported_until.get(endpoint, 0)
+    
+    def detect(self, stream_id, payload, params, timeout=5, release=None):
+        """Queue a frame for batched detection and wait for its result
+        
+        Args:
+            stream_id (str): Stream the frame belongs to
+            payload: JPEG bytes, or a shared-memory descriptor dict from SharedFrameSlot.write()
+            params (dict): Request parameters ('check_roi')
+            timeout (float): Seconds to wait for the batch to come back
+            release (callable): Called once the frame is no longer needed - its
+                request completed or it was dropped unsent - even after a timeout
+        
+        Returns:
+            tuple: (status, result) where status is 'ok' (result is the list of
+            predictions), 'error' (result is an error message) or 'unsupported'
+            (the server has no batch endpoint; caller should send a single request)
+        """
+        item = {
+            'stream_id': stream_id,
+            'payload': payload,
+            'check_roi': params.get('check_roi') == 'true',
+            'done': threading.Event(),
+            'release': release,
+            'status': 'error',
+            'result': "Batch request timed out"
+        }
+        self.requests.put(item)
+        if not item['done'].wait(timeout):
+            # Nobody will read the result - don't send the frame if it is still queued
+            item['cancelled'] = True
+        return item['status'], item['result']
+    
+    def _take(self, timeout=None):
+        """Next request whose caller is still waiting (raises queue.Empty on timeout)"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            item = self.requests.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            if not item.get('cancelled'):
+                return item
+            self._drop(item)
+    
+    def _drop(self, item):
+        """Finish a request without sending it"""
+        self._finish(item)
+    
+    def _finish(self, item):
+        item['done'].set()
+        if item['release']:
+            item['release']()
+    
+    def _collect(self, window, max_size):
+        """Block for the first request, then gather more until the window closes or the batch is full"""
+        batch = [self._take()]
+        deadline = time.time() + window
+        while len(batch) < max_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._take(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            config = ai_client.config
+            window = config.get('batch_window_ms', 50) / 1000.0
+            max_size = max(1, int(config.get('batch_max_size', 8)))
+            
+            batch = self._collect(window, max_size)
+            uploads = [item for item in batch if isinstance(item['payload'], bytes)]
+            shared = [item for item in batch if not isinstance(item['payload'], bytes)]
+            for group, sender in ((uploads, self._send_images), (shared, self._send_shared)):
+                if not group:
+                    continue
+                try:
+                    sender(group)
+                except Exception as e:
+                    logger.error(f"Error sending detection batch: {e}")
+                    for item in group:
+                        item['status'], item['result'] = 'error', str(e)
+                finally:
+                    for item in group:
+                        self._finish(item)
+    
+    def _send_images(self, batch):
+        files = [
+            ('images', (f"{item['stream_id']}.jpg", item['payload'], 'image/jpeg'))
+            for item in batch
+        ]
+        params = {
+            'stream_ids': ','.join(item['stream_id'] for item in batch),
+            'check_roi': ','.join('true' if item['check_roi'] else 'false' for item in batch)
+        }
+        self._send(batch, 'predict_batch', files=files, params=params)
+    
+    def _send_shared(self, batch):
+        frames = []
+        for item in batch:
+            descriptor = dict(item['payload'])
+            descriptor['stream_id'] = item['stream_id']
+            descriptor['check_roi'] = item['check_roi']
+            frames.append(descriptor)
+        self._send(batch, 'predict_batch_shm', json_data={'frames': frames})
+    
+    def _send(self, batch, endpoint, files=None, params=None, json_data=None):
+        if not self.available(endpoint):
+            for item in batch:
+                item['status'], item['result'] = 'unsupported', None
+            return
+        
+        logger.debug(f"Sending batch of {len(batch)} frames to AI server ({endpoint})")
+        success, response = ai_client.request(
+            endpoint=endpoint,
+            method="post",
+            files=files,
+            params=params,
+            json_data=json_data,
+            timeout=2 + 0.25 * len(batch)
+        )
+        
+        if not success:
+            if isinstance(response, str) and 'HTTP 404' in response:
+                logger.warning(f"AI server does not support {endpoint}, falling back to single requests")
+                self.unsupported_until[endpoint] = time.time() + 300
+                status = 'unsupported'
+            else:
+                status = 'error'
+            for item in batch:
+                item['status'], item['result'] = status, response
+            return
+        
+        try:
+            response_data = response.json()
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse AI server batch response as JSON: {e}")
+            for item in batch:
+                item['status'], item['result'] = 'error', "Invalid JSON in batch response"
+            return
+        
+        # Accept {"results": [...]} or a bare list, one entry per image in request order.
+        # Entries may be detection lists or dicts carrying 'detections' (and optionally 'stream_id').
+        results = response_data.get('results', []) if isinstance(response_data, dict) else response_data
+        by_stream = {
+            entry['stream_id']: entry for entry in results
+            if isinstance(entry, dict) and 'stream_id' in entry
+        }
+        for index, item in enumerate(batch):
+            if item['stream_id'] in by_stream:
+                entry = by_stream[item['stream_id']]
+            elif index < len(results):
+                entry = results[index]
+            else:
+                item['status'], item['result'] = 'error', "Missing result in batch response"
+                continue
+            item['status'], item['result'] = 'ok', extract_predictions(entry)
+
+
+class SharedFrameSlot:
+    """Memory-mapped buffer holding the latest raw BGR frame of one stream
+    
+    Used with a co-located AI server: the frame is copied once into shared
+    memory and only a small descriptor (path, shape, dtype, sequence number)
+    is sent over HTTP, skipping the JPEG encode, temp file and server-side
+    decode. Each inference worker owns one slot. A frame stays in flight
+    until its request completes, or is dropped unsent by the batcher after
+    the worker gave up waiting; the slot refuses new frames until then, so
+    the server never sees a torn frame.
+    """
+    
+    def __init__(self, stream_id):
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', stream_id)
+        self.path = os.path.join(SHM_DIR, f"smartnvr_{safe_id}.frame")
+        self.size = 0
+        self.fd = None
+        self.mm = None
+        self.seq = 0
+        self.idle = threading.Event()  # Cleared while the frame in the slot may still be read
+        self.idle.set()
+    
+    def _resize(self, size):
+        self.close(unlink=False)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        self.size = size
+    
+    def write(self, frame):
+        """Copy a frame into the slot and return its descriptor
+        
+        Returns:
+            dict: The descriptor, or None if the previous frame is still in flight
+        """
+        if not self.idle.is_set():
+            return None
+        if frame.nbytes > self.size:
+            self._resize(frame.nbytes)
+        view = np.ndarray(frame.shape, dtype=frame.dtype, buffer=self.mm)
+        view[...] = frame
+        self.seq += 1
+        self.idle.clear()
+        return {
+            'path': self.path,
+            'offset': 0,
+            'shape': list(frame.shape),
+            'dtype': str(frame.dtype),
+            'seq': self.seq
+        }
+    
+    def release(self):
+        """Mark the frame in the slot as no longer needed by the AI server"""
+        self.idle.set()
+    
+    def close(self, unlink=True):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.size = 0
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def ai_batching_enabled(endpoint='predict_batch'):
+    """Check whether detection requests should go through the batcher"""
+    return ai_client.config.get('batch_enabled', False) and detection_batcher.available(endpoint)
+
+
+def shm_transport_enabled():
+    """Check whether frames should be handed to the AI server through shared memory"""
+    return ai_client.config.get('transport') == 'shm' and time.time() >= shm_unsupported_until
+
+
+def extract_predictions(response_data):
+    """Get the detection list out of an AI server response body"""
+    # Handle different response formats - check if the response is a nested structure
+    if isinstance(response_data, dict) and 'detections' in response_data:
+        # Extract the detections array from the nested structure
+        return response_data['detections']
+    # Use the response directly if it's already an array
+    return response_data
+
+
+# Shared batching stage for all inference workers
+detection_batcher = DetectionBatcher()
+
+class MotionDetector:
+    """Cheap motion check used to skip inference on static scenes
+    
+    Works on a small grayscale copy of the frame: the difference against a
+    running-average background gives the fraction of changed pixels,
+    optionally counted only inside the stream's enabled ROI polygons.
+    """
+    
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.background = None
+        self.empty_roi_logged = False
+    
+    def measure(self, frame, roi_only=True):
+        """Update the background model and return the fraction of changed pixels (0.0-1.0)"""
+        height, width = frame.shape[:2]
+        scale = MOTION_FRAME_WIDTH / width
+        small = cv2.resize(frame, (MOTION_FRAME_WIDTH, max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        
+        if self.background is None or self.background.shape != gray.shape:
+            # First frame (or resolution change) - no reference yet, so treat it as motion
+            self.background = gray.astype(np.float32)
+            return 1.0
+        
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(gray, self.background, MOTION_BACKGROUND_ALPHA)
+        changed = diff > MOTION_PIXEL_THRESHOLD
+        
+        roi_mask = get_roi_mask(self.stream_id, gray.shape) if roi_only else None
+        if roi_mask is not None:
+            mask = roi_mask.area
+            roi_pixels = np.count_nonzero(mask)
+            if roi_pixels:
+                return float(np.count_nonzero(changed & mask)) / roi_pixels
+            # Degenerate polygons or ROIs outside the frame cover no pixels - watch the whole frame
+            if not self.empty_roi_logged:
+                logger.warning(f"ROIs of stream {self.stream_id} cover no pixels, using whole-frame motion")
+                self.empty_roi_logged = True
+        return float(np.count_nonzero(changed)) / changed.size
+
+
+def apply_detection_settings(config):
+    """Refresh the cached detection settings from the main configuration"""
+    detection_settings.clear()
+    detection_settings.update(DEFAULT_CONFIG['detection'])
+    detection_settings.update(config.get('detection', {}))
+
+
+apply_detection_settings(load_config())
+
+
+class DetectionIntervalController:
+    """Chooses how often a stream is sent for detection
+    
+    Shortens the interval while objects are being tracked, lengthens it
+    step by step while the scene stays empty, and stretches every stream's
+    interval when the AI server's p95 latency rises above its target. The
+    current interval and the reason for it are reported by /api/streams/status.
+    """
+    
+    def __init__(self):
+        self.base_interval = DETECTION_INTERVAL
+        self.scene_interval = DETECTION_INTERVAL  # Interval before global backoff
+        self.interval = DETECTION_INTERVAL
+        self.reason = 'default interval'
+        self.tracked_objects = 0
+    
+    def update(self, object_count=None, motion=False):
+        """Recompute the interval after a detection (object_count) or a skipped static frame (None)
+        
+        motion says whether the motion gate saw the scene change; an empty
+        detection without motion counts as an empty scene.
+        
+        Returns:
+            float: The new interval in seconds
+        """
+        min_interval = detection_settings.get('min_interval', 0.2)
+        max_interval = detection_settings.get('max_interval', 2.0)
+        
+        if object_count:
+            self.tracked_objects = object_count
+            self.scene_interval = min_interval
+            reason = f"tracking {object_count} object{'s' if object_count != 1 else ''}"
+        elif motion:
+            self.tracked_objects = 0
+            self.scene_interval = self.base_interval
+            reason = 'motion without objects'
+        else:
+            self.tracked_objects = 0
+            self.scene_interval = min(max_interval, max(self.scene_interval, self.base_interval) * 1.5)
+            reason = 'scene empty'
+        
+        # Global backoff when the AI server is slow - applies to every stream
+        p95 = ai_client.detection_latency_p95()
+        target = detection_settings.get('latency_target', 0.5)
+        interval = self.scene_interval
+        if p95 is not None and p95 > target:
+            factor = min(p95 / target, 4.0)
+            interval *= factor
+            reason += f", AI server slow (p95 {p95 * 1000:.0f}ms, x{factor:.1f})"
+        
+        self.interval = max(min_interval, min(interval, max_interval * 4.0))
+        self.reason = reason
+        return self.interval
+    
+    def get_status(self):
+        return {
+            'interval': round(self.interval, 3),
+            'reason': self.reason,
+            'tracked_objects': self.tracked_objects
+        }
+
+
+def roi_points_to_pixels(points, shape):
+    """Pixel coordinates of ROI points in a frame of the given (height, width)
+    
+    The ROI editor stores points as percentages (0-100) of the frame width
+    and height, so the same zones apply at any resolution.
+    """
+    height, width = shape[:2]
+    return (np.array(points, np.float32) * np.float32([width / 100.0, height / 100.0])).astype(np.int32)
+
+
+class RoiMask:
+    """A stream's enabled ROI polygons rasterized into one label image
+    
+    Bit i of each pixel is set when the pixel lies inside roi_ids[i], so
+    overlapping zones are represented exactly and testing any number of
+    detections is a single vectorized lookup.
+    """
+    
+    def __init__(self, rois, shape):
+        zones = []
+        for roi_id, roi_info in rois.items():
+            points = roi_info.get('points', [])
+            if roi_info.get('enabled', True) and len(points) > 2:
+                zones.append((roi_id, roi_points_to_pixels(points, shape)))
+        
+        if len(zones) > 64:
+            logger.warning(f"Only the first 64 of {len(zones)} ROIs are used for filtering")
+            zones = zones[:64]
+        
+        # Smallest integer type with a bit per ROI
+        dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if len(zones) <= np.iinfo(t).bits)
+        
+        self.shape = shape
+        self.roi_ids = [roi_id for roi_id, _ in zones]
+        self.labels = np.zeros(shape, dtype)
+        layer = np.zeros(shape, np.uint8)
+        for bit, (_, pts) in enumerate(zones):
+            layer[:] = 0
+            cv2.fillPoly(layer, [pts], 1)
+            self.labels[layer.astype(bool)] |= dtype(1 << bit)
+        self._area = None
+    
+    @property
+    def area(self):
+        """Boolean mask of pixels inside any ROI"""
+        if self._area is None:
+            self._area = self.labels != 0
+        return self._area
+    
+    def lookup(self, points):
+        """ROI bits for each (x, y) point; points outside the frame are clamped to its edge"""
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        height, width = self.shape[:2]
+        xs = np.clip(points[:, 0], 0, width - 1).astype(np.intp)
+        ys = np.clip(points[:, 1], 0, height - 1).astype(np.intp)
+        return self.labels[ys, xs]
+    
+    def roi_ids_for(self, bits):
+        """Decode one lookup() value into the list of ROI IDs"""
+        bits = int(bits)
+        return [roi_id for i, roi_id in enumerate(self.roi_ids) if bits >> i & 1]
+
+
+def get_roi_mask(stream_id, shape):
+    """Get a stream's rasterized ROI mask at the given resolution
+    
+    Masks are built on first use and kept until invalidate_roi_masks() is
+    called, which /roi/<stream_id>/save does whenever the polygons change.
+    
+    Args:
+        stream_id (str): Stream ID
+        shape (tuple): (height, width) of the mask; ROI points are percentages of the frame,
+            so a mask for a resized copy of a frame covers the same zones
+    
+    Returns:
+        RoiMask: The mask, or None if the stream has no enabled ROIs
+    """
+    key = tuple(shape[:2])
+    with roi_masks_lock:
+        stream_masks = roi_masks.setdefault(stream_id, {})
+        if key in stream_masks:
+            return stream_masks[key]
+        generation = roi_mask_generations[stream_id]
+    
+    mask = None
+    roi_file = os.path.join(ROI_CONFIG_DIR, f"{stream_id}.json")
+    if os.path.exists(roi_file):
+        try:
+            with open(roi_file, 'r') as f:
+                rois = json.load(f)
+            mask = RoiMask(rois, tuple(shape[:2]))
+            if not mask.roi_ids:
+                mask = None
+        except Exception as e:
+            logger.error(f"Error loading ROIs for stream {stream_id}: {e}")
+    
+    with roi_masks_lock:
+        # Don't cache a mask built from a ROI file that was replaced meanwhile
+        if roi_mask_generations[stream_id] == generation:
+            roi_masks.setdefault(stream_id, {})[key] = mask
+    return mask
+
+
+def invalidate_roi_masks(stream_id):
+    """Drop a stream's cached ROI masks so they are rebuilt from the ROI file"""
+    with roi_masks_lock:
+        roi_masks.pop(stream_id, None)
+        roi_mask_generations[stream_id] += 1
+
+
+def apply_roi_filter(stream_id, predictions, frame_shape):
+    """Tag detections with the ROIs they are in, optionally dropping those outside every ROI
+    
+    Each detection's anchor point (bottom-center of the box by default, i.e.
+    where a person stands) is looked up in the stream's ROI mask and the
+    matching ROI IDs are stored in pred['rois']. With detection.local_roi_filter
+    enabled, detections outside all ROIs are removed. Streams without enabled
+    ROIs are returned unchanged.
+    """
+    boxes = [pred for pred in predictions if isinstance(pred, dict) and 'bbox' in pred]
+    if not boxes or not stream_id or frame_shape is None:
+        return predictions
+    
+    mask = get_roi_mask(stream_id, frame_shape)
+    if mask is None:
+        return predictions
+    
+    bbox = np.array([pred['bbox'] for pred in boxes], np.float64).reshape(-1, 4)
+    x = (bbox[:, 0] + bbox[:, 2]) / 2
+    if detection_settings.get('roi_anchor', 'bottom_center') == 'center':
+        y = (bbox[:, 1] + bbox[:, 3]) / 2
+    else:
+        y = bbox[:, 3]
+    
+    for pred, bits in zip(boxes, mask.lookup(np.stack([x, y], axis=1))):
+        pred['rois'] = mask.roi_ids_for(bits)
+    
+    if not detection_settings.get('local_roi_filter', False):
+        return predictions
+    return [pred for pred in predictions if not isinstance(pred, dict) or pred.get('rois', True)]
+
+
+class InferenceWorker:
+    """Per-stream detection thread fed by a depth-1 "latest frame wins" slot
+    
+    The capture worker offers every decoded frame; offering just replaces the
+    slot, so it never blocks. The worker wakes up once per detection interval,
+    takes whatever frame is newest, sends it to the AI server and publishes the
+    results to prediction_cache. Display loops only ever read prediction_cache,
+    so live view frame rate no longer depends on inference latency.
+    """
+    
+    def __init__(self, rtsp_url, stream_id=None):
+        self.rtsp_url = rtsp_url
+        self.stream_id = stream_id if stream_id else str(hash(rtsp_url))
+        self.condition = threading.Condition()
+        self.slot = None  # (frame, timestamp) - newest offered frame not yet processed
+        self.interval_controller = DetectionIntervalController()
+        self.last_detection_time = 0
+        self.last_offer_time = time.time()
+        self.shm_slot = None  # Created on first use of the shared-memory transport
+        self.motion = MotionDetector(self.stream_id)
+        self.motion_level = 0.0
+        self.motion_detected = False  # Whether the motion gate saw motion in the last frame
+        self.last_inference_time = 0
+        self.skipped_frames = 0
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"inference-{self.stream_id}")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+    
+    def is_alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+    
+    def offer(self, frame, timestamp):
+        """Replace the pending frame with a newer one (never blocks on inference)"""
+        with self.condition:
+            self.slot = (frame, timestamp)
+            self.last_offer_time = timestamp
+            self.condition.notify()
+    
+    def _take(self, timeout):
+        with self.condition:
+            if self.slot is None:
+                self.condition.wait(timeout)
+            item, self.slot = self.slot, None
+            return item
+    
+    def _run(self):
+        while self.running:
+            # Sleep until the next detection is due
+            wait = self.interval_controller.interval - (time.time() - self.last_detection_time)
+            if wait > 0:
+                time.sleep(wait)
+            
+            item = self._take(timeout=1.0)
+            if item is None:
+                if time.time() - self.last_offer_time > INFERENCE_IDLE_TIMEOUT:
+                    logger.debug(f"No frames for stream {self.stream_id}, stopping inference worker")
+                    break
+                continue
+            
+            frame, frame_time = item
+            self.last_detection_time = time.time()
+            try:
+                if self.should_detect(frame):
+                    self.last_inference_time = self.last_detection_time
+                    predictions = self.detect(frame, frame_time)
+                    if predictions is not None:
+                        # An empty result on an unchanged scene (heartbeat, or no gating) keeps backing off
+                        self.interval_controller.update(len(predictions), motion=self.motion_detected)
+                else:
+                    # Scene unchanged - the previous detections are still accurate
+                    self.skipped_frames += 1
+                    refresh_predictions(self.rtsp_url)
+                    self.interval_controller.update(None, motion=False)
+            except Exception as e:
+                logger.error(f"AI prediction error: {str(e)}")
+                import traceback
+                logger.error(traceback.format_exc())
+        
+        self.running = False
+        if self.shm_slot is not None:
+            self.shm_slot.close()
+        with inference_workers_lock:
+            if inference_workers.get(self.rtsp_url) is self:
+                del inference_workers[self.rtsp_url]
+    
+    def should_detect(self, frame):
+        """Motion gate: skip inference on static scenes, but never for longer than the heartbeat"""
+        self.motion_detected = False
+        if not detection_settings.get('motion_gating', True):
+            return True
+        
+        self.motion_level = self.motion.measure(frame, detection_settings.get('motion_roi_only', True))
+        if self.motion_level >= detection_settings.get('motion_threshold', 0.002):
+            self.motion_detected = True
+            return True
+        return time.time() - self.last_inference_time >= detection_settings.get('motion_heartbeat', 10)
+    
+    def detect(self, frame, frame_time):
+        """Send one frame to the AI server and publish the results to prediction_cache
+        
+        Returns:
+            list: The predictions, or None if detection failed
+        """
+        # The AI server expects 'stream_id' as a parameter
+        params = {'stream_id': self.stream_id}
+        # ROIs are checked here instead when local filtering is on
+        if not detection_settings.get('local_roi_filter', False) and \
+                os.path.exists(os.path.join(ROI_CONFIG_DIR, f"{self.stream_id}.json")):
+            params['check_roi'] = 'true'
+        
+        # Debug info for troubleshooting
+        logger.debug(f"Sending frame from stream {self.stream_id} to AI server for processing")
+        
+        if shm_transport_enabled():
+            status, result = self.detect_shared(frame, params)
+            if status == 'ok':
+                return publish_predictions(self.rtsp_url, result, frame_time, self.stream_id, frame.shape)
+            if status == 'error':
+                logger.warning(f"AI prediction failed: {result}")
+                return None
+            # 'unsupported' - fall back to JPEG upload below
+        
+        # Use higher quality for detection frames
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+        _, img_encoded = cv2.imencode('.jpg', frame, encode_param)
+        img_bytes = img_encoded.tobytes()
+        
+        if ai_batching_enabled():
+            status, result = detection_batcher.detect(self.stream_id, img_bytes, params)
+            if status == 'ok':
+                return publish_predictions(self.rtsp_url, result, frame_time, self.stream_id, frame.shape)
+            if status == 'error':
+                logger.warning(f"AI prediction failed: {result}")
+                return None
+            # 'unsupported' - the server has no batch endpoint, send this frame on its own
+        
+        predictions = self.detect_single(img_bytes, params)
+        if predictions is not None:
+            predictions = publish_predictions(self.rtsp_url, predictions, frame_time, self.stream_id, frame.shape)
+        return predictions
+    
+    def detect_shared(self, frame, params):
+        """Hand a raw frame to a co-located AI server through shared memory
+        
+        Returns:
+            tuple: (status, result) like DetectionBatcher.detect()
+        """
+        global shm_unsupported_until
+        
+        try:
+            if self.shm_slot is None:
+                self.shm_slot = SharedFrameSlot(self.stream_id)
+            descriptor = self.shm_slot.write(np.ascontiguousarray(frame))
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to write frame to shared memory, using JPEG upload: {e}")
+            return 'unsupported', None
+        if descriptor is None:
+            return 'error', "Previous shared-memory frame may still be read by the AI server"
+        
+        if ai_batching_enabled('predict_batch_shm'):
+            # The batcher releases the slot, also when this call times out first
+            status, result = detection_batcher.detect(self.stream_id, descriptor, params,
+                                                      release=self.shm_slot.release)
+            if status != 'unsupported':
+                return status, result
+        
+        descriptor = dict(descriptor, stream_id=self.stream_id, check_roi=params.get('check_roi') == 'true')
+        try:
+            success, response = ai_client.request(
+                endpoint="predict_shm",
+                method="post",
+                json_data=descriptor,
+                timeout=2
+            )
+        finally:
+            self.shm_slot.release()
+        if not success:
+            if isinstance(response, str) and 'HTTP 404' in response:
+                logger.warning("AI server does not support shared-memory frames, falling back to JPEG upload")
+                shm_unsupported_until = time.time() + 300
+                return 'unsupported', None
+            return 'error', response
+        
+        try:
+            return 'ok', extract_predictions(response.json())
+        except json.JSONDecodeError as e:
+            return 'error', f"Failed to parse AI server response as JSON: {e}"
+    
+    def detect_single(self, img_bytes, params):
+        """Send one encoded frame to the predict endpoint
+        
+        Returns:
+            list: Predictions, or None if the request failed
+        """
+        # Save the image to a temporary file first - this ensures proper image format
+        temp_img_path = os.path.join('/tmp', f"frame_{self.stream_id}_{int(time.time())}.jpg")
+        with open(temp_img_path, 'wb') as f:
+            f.write(img_bytes)
+        
+        # Send the image file to the AI server using multipart/form-data
+        try:
+            with open(temp_img_path, 'rb') as img_file:
+                files = {'image': ('image.jpg', img_file, 'image/jpeg')}
+                
+                logger.debug(f"Sending image to AI server with params: {params}")
+                
+                success, response = ai_client.request(
+                    endpoint="predict",
+                    method="post",
+                    files=files,
+                    params=params,
+                    timeout=2
+                )
+        except requests.RequestException as e:
+            logger.error(f"Request to AI server failed: {e}")
+            return None
+        finally:
+            # Clean up temporary file
+            try:
+                os.unlink(temp_img_path)
+            except OSError:
+                pass
+        
+        if not success:
+            logger.warning(f"AI prediction failed: {response}")
+            return None
+        
+        try:
+            response_data = response.json()
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse AI server response as JSON: {e}")
+            logger.debug(f"Response content: {response.text}")
+            return None
+        
+        logger.debug(f"Received response from AI server: {response_data}")
+        return extract_predictions(response_data)
+    
+    def get_status(self):
+        """Detection cadence and motion gate state for the status API"""
+        status = self.interval_controller.get_status()
+        status.update({
+            'motion_level': round(self.motion_level, 4),
+            'skipped_frames': self.skipped_frames,
+            'last_inference': datetime.fromtimestamp(self.last_inference_time).isoformat() if self.last_inference_time else None
+        })
+        return status
+
+
+def box_iou_matrix(boxes_a, boxes_b):
+    """Pairwise IoU between two arrays of [x1, y1, x2, y2] boxes (N x M)"""
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-6), 0.0)
+
+
+def box_center_distance_matrix(boxes_a, boxes_b):
+    """Pairwise distance between box centers (N x M)"""
+    centers_a = (boxes_a[:, :2] + boxes_a[:, 2:]) / 2.0
+    centers_b = (boxes_b[:, :2] + boxes_b[:, 2:]) / 2.0
+    return np.linalg.norm(centers_a[:, None, :] - centers_b[None, :, :], axis=2)
+
+
+def hungarian_assignment(cost):
+    """Minimum-cost assignment for a rectangular cost matrix
+    
+    Uses scipy's linear_sum_assignment when available, otherwise a
+    Kuhn-Munkres implementation with row/column potentials (O(n^2 m)).
+    
+    Returns:
+        tuple: (row_indices, col_indices) arrays of matched pairs
+    """
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    
+    # 1-indexed potentials; p[j] is the row assigned to column j (0 = none)
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, np.int64)
+    way = np.zeros(m + 1, np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            # Vectorized relaxation over all unused columns
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improve = free & (reduced < minv[1:])
+            minv[1:][improve] = reduced[improve]
+            way[1:][improve] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            used_idx = np.nonzero(used)[0]
+            u[p[used_idx]] += delta
+            v[used_idx] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+    
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+    if transposed:
+        rows, cols = cols, rows
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+    return rows, cols
+
+
+class StreamTracker:
+    """Per-camera object tracker shared by every viewer of the stream
+    
+    Tracks are stored as parallel NumPy arrays (ids, boxes, velocities,
+    label codes, last-seen times) rather than a dict per object. Detections
+    are matched to tracks of the same class with a cost built from IoU and
+    center distance, solved optimally with the Hungarian algorithm.
+    
+    Each track also carries a smoothed constant-velocity estimate of its box
+    edges, so renderers can move boxes along between detections (predict())
+    instead of freezing them until the next inference result.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = np.empty(0, np.int64)
+        self.boxes = np.empty((0, 4), np.float32)
+        self.velocities = np.empty((0, 4), np.float32)  # Box edge velocities in pixels/second
+        self.labels = np.empty(0, np.int32)
+        self.last_seen = np.empty(0, np.float64)
+        self.label_codes = {}  # label -> small integer code
+        self.label_names = []  # code -> label
+        self.next_id = 1
+    
+    def _label_code(self, label):
+        code = self.label_codes.get(label)
+        if code is None:
+            code = self.label_codes[label] = len(self.label_codes)
+            self.label_names.append(label)
+        return code
+    
+    def update(self, predictions, timestamp):
+        """Assign a 'tracking_id' to each prediction and update the track table
+        
+        Args:
+            predictions (list): Detections from the AI server (modified in place)
+            timestamp (float): Capture time of the frame the detections came from
+        """
+        valid = []
+        det_boxes = []
+        det_labels = []
+        for pred in predictions:
+            if isinstance(pred, dict) and 'bbox' in pred and 'label' in pred:
+                try:
+                    det_boxes.append([float(v) for v in pred['bbox'][:4]])
+                except (ValueError, TypeError) as e:
+                    logger.error(f"Error processing prediction for tracking: {e}, pred: {pred}")
+                    continue
+                valid.append(pred)
+                det_labels.append(self._label_code(str(pred.get('label', 'unknown')).lower()))
+        
+        det_boxes = np.array(det_boxes, np.float32).reshape(-1, 4)
+        det_labels = np.array(det_labels, np.int32)
+        
+        with self.lock:
+            # Drop tracks that haven't been seen recently
+            alive = timestamp - self.last_seen <= TRACK_MAX_AGE
+            if not alive.all():
+                self._keep(alive)
+            
+            track_for_det = np.full(len(valid), -1, np.int64)
+            if len(self.ids) and len(valid):
+                iou = box_iou_matrix(self.boxes, det_boxes)
+                distance = box_center_distance_matrix(self.boxes, det_boxes)
+                same_label = self.labels[:, None] == det_labels[None, :]
+                feasible = same_label & ((iou >= TRACK_MIN_IOU) | (distance < TRACK_MAX_DISTANCE))
+                cost = (1.0 - iou) + distance / TRACK_MAX_DISTANCE
+                cost = np.where(feasible, cost, TRACK_INFEASIBLE_COST)
+                
+                rows, cols = hungarian_assignment(cost)
+                matched = feasible[rows, cols]
+                rows, cols = rows[matched], cols[matched]
+                track_for_det[cols] = rows
+                
+                # Smoothed velocity from the displacement since the track was last seen
+                dt = (timestamp - self.last_seen[rows])[:, None]
+                moving = dt[:, 0] > 1e-3
+                measured = (det_boxes[cols] - self.boxes[rows]) / np.maximum(dt, 1e-3)
+                smoothed = TRACK_VELOCITY_SMOOTHING * measured + (1 - TRACK_VELOCITY_SMOOTHING) * self.velocities[rows]
+                self.velocities[rows[moving]] = smoothed[moving]
+                self.boxes[rows] = det_boxes[cols]
+                self.last_seen[rows] = timestamp
+            
+            # Unmatched detections start new tracks
+            new = np.nonzero(track_for_det < 0)[0]
+            if len(new):
+                new_ids = np.arange(self.next_id, self.next_id + len(new), dtype=np.int64)
+                self.next_id += len(new)
+                track_for_det[new] = np.arange(len(self.ids), len(self.ids) + len(new))
+                self.ids = np.concatenate([self.ids, new_ids])
+                self.boxes = np.concatenate([self.boxes, det_boxes[new]])
+                self.velocities = np.concatenate([self.velocities, np.zeros((len(new), 4), np.float32)])
+                self.labels = np.concatenate([self.labels, det_labels[new]])
+                self.last_seen = np.concatenate([self.last_seen, np.full(len(new), timestamp)])
+            
+            for pred, track_index in zip(valid, track_for_det):
+                pred['tracking_id'] = int(self.ids[track_index])
+    
+    def predict(self, timestamp):
+        """Extrapolate every track's box to the given time
+        
+        Returns:
+            tuple: (ids, boxes) arrays; boxes are [x1, y1, x2, y2] floats
+        """
+        with self.lock:
+            # Don't extrapolate further than the horizon - stale tracks just stop moving
+            dt = np.clip(timestamp - self.last_seen, 0, TRACK_PREDICT_HORIZON)[:, None]
+            return self.ids.copy(), self.boxes + self.velocities * dt
+    
+    def get_tracks(self, timestamp):
+        """Predicted track positions as JSON-friendly dicts for the status API"""
+        ids, boxes = self.predict(timestamp)
+        with self.lock:
+            labels = [self.label_names[code] for code in self.labels]
+            velocities = self.velocities.copy()
+            ages = timestamp - self.last_seen
+        return [
+            {
+                'tracking_id': int(track_id),
+                'label': label,
+                'bbox': [round(float(v), 1) for v in box],
+                'velocity': [round(float(v), 1) for v in velocity],
+                'age': round(float(age), 2)
+            }
+            for track_id, label, box, velocity, age in zip(ids, labels, boxes, velocities, ages)
+        ]
+    
+    def _keep(self, mask):
+        self.ids = self.ids[mask]
+        self.boxes = self.boxes[mask]
+        self.velocities = self.velocities[mask]
+        self.labels = self.labels[mask]
+        self.last_seen = self.last_seen[mask]
+    
+    def __len__(self):
+        return len(self.ids)
+
+
+def get_stream_tracker(rtsp_url):
+    """Get the shared tracker for a stream, creating it if needed"""
+    with stream_trackers_lock:
+        tracker = stream_trackers.get(rtsp_url)
+        if tracker is None:
+            tracker = stream_trackers[rtsp_url] = StreamTracker()
+        return tracker
+
+
+def drop_malformed_predictions(predictions):
+    """Remove detections whose bbox is not four finite numbers, logging each one"""
+    valid = []
+    for pred in predictions:
+        if isinstance(pred, dict) and 'bbox' in pred:
+            try:
+                bbox = np.asarray(pred['bbox'], np.float64)
+                if bbox.shape != (4,) or not np.isfinite(bbox).all():
+                    raise ValueError("expected four finite numbers")
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Skipping detection with invalid bbox {pred.get('bbox')!r}: {e}")
+                continue
+        valid.append(pred)
+    return valid
+
+
+def publish_predictions(rtsp_url, predictions, frame_time, stream_id=None, frame_shape=None):
+    """Store fresh detection results for a stream and update object counts
+    
+    Returns:
+        list: The predictions after ROI filtering
+    """
+    global last_count_update
+    current_time = time.time()
+    
+    # One bad entry from the AI server must not take the rest of the batch with it
+    predictions = drop_malformed_predictions(predictions)
+    # ROI gating happens before anything downstream sees the detections
+    predictions = apply_roi_filter(stream_id, predictions, frame_shape)
+    trigger_event_recording(stream_id, predictions)
+    
+    # Assign stable track IDs once per detection, not once per viewer
+    get_stream_tracker(rtsp_url).update(predictions, frame_time)
+    
+    previous = prediction_cache.get(rtsp_url)
+    prediction_cache[rtsp_url] = {
+        'time': current_time,
+        'frame_time': frame_time,
+        'seq': previous['seq'] + 1 if previous else 1,
+        'predictions': predictions
+    }
+    
+    # Process object counts
+    if current_time - last_count_update >= COUNT_UPDATE_INTERVAL:
+        for pred in predictions:
+            if isinstance(pred, dict):
+                label = pred.get('label', 'unknown')
+                object_counts[label] += 1
+        
+        # Update the last count update time
+        last_count_update = current_time
+    
+    return predictions
+
+
+def refresh_predictions(rtsp_url):
+    """Keep the current detections visible when inference was skipped for a static scene"""
+    cache_data = prediction_cache.get(rtsp_url)
+    if cache_data:
+        cache_data['time'] = time.time()
+
+
+def get_inference_worker(rtsp_url, stream_id=None):
+    """Get the inference worker for a stream, starting one if needed"""
+    with inference_workers_lock:
+        worker = inference_workers.get(rtsp_url)
+        if worker is None or not worker.is_alive():
+            worker = InferenceWorker(rtsp_url, stream_id)
+            inference_workers[rtsp_url] = worker
+            worker.start()
+        return worker
+
+
+def stop_inference_worker(rtsp_url):
+    """Stop the inference worker for a stream if one is running"""
+    with inference_workers_lock:
+        worker = inference_workers.pop(rtsp_url, None)
+    if worker:
+        worker.stop()
+
+def make_overlay_patch(x, y, color, alpha):
+    """Build a premultiplied overlay patch from a BGR image and its alpha mask
+    
+    Only pixels with non-zero alpha are kept, so thin outlines and text cost
+    in proportion to their pixel count rather than their bounding box.
+    
+    Args:
+        x, y (int): Position of the layer's top-left corner in the frame
+        color (ndarray): HxWx3 uint8 overlay colors
+        alpha (ndarray): HxW uint8 opacity (0-255)
+    
+    Returns:
+        tuple: (ys, xs, premultiplied color, inverse alpha) - frame coordinates
+            and uint16 per-pixel values
+    """
+    ys, xs = np.nonzero(alpha)
+    a = alpha[ys, xs].astype(np.uint16)[:, None]
+    return (ys + y, xs + x, color[ys, xs].astype(np.uint16) * a, 255 - a)
+
+
+def blend_overlay_patch(frame, patch):
+    """Alpha-blend a premultiplied patch into the frame, touching only its pixels"""
+    ys, xs, premultiplied, inverse_alpha = patch
+    
+    # Clip the patch to the frame
+    frame_height, frame_width = frame.shape[:2]
+    if ys.size and (ys.min() < 0 or xs.min() < 0 or ys.max() >= frame_height or xs.max() >= frame_width):
+        inside = (ys >= 0) & (xs >= 0) & (ys < frame_height) & (xs < frame_width)
+        ys, xs, premultiplied, inverse_alpha = ys[inside], xs[inside], premultiplied[inside], inverse_alpha[inside]
+    
+    # uint16 arithmetic: pixel * (255 - a) + color * a never exceeds 255 * 255
+    frame[ys, xs] = (frame[ys, xs] * inverse_alpha + premultiplied + 127) // 255
+
+
+def blend_rect(frame, x1, y1, x2, y2, color, alpha):
+    """Fill a rectangle with a semi-transparent color, blending only that rectangle"""
+    frame_height, frame_width = frame.shape[:2]
+    x1, y1 = max(x1, 0), max(y1, 0)
+    x2, y2 = min(x2 + 1, frame_width), min(y2 + 1, frame_height)
+    if x1 >= x2 or y1 >= y2:
+        return
+    
+    region = frame[y1:y2, x1:x2]
+    fill = np.empty_like(region)
+    fill[:] = color
+    frame[y1:y2, x1:x2] = cv2.addWeighted(fill, alpha, region, 1 - alpha, 0)
+
+
+class OverlayCompositor:
+    """Draws a stream's overlays onto output frames without full-frame copies
+    
+    Static layers are rasterized once into sparse premultiplied patches: one
+    per ROI (outline and name), rebuilt only when the ROI file or the output
+    size changes, and one for the timestamp bar, rebuilt once per second.
+    Semi-transparent detection label bars are blended over their own
+    rectangles only, and everything is composited onto the frame in one pass.
+    """
+    
+    def __init__(self, stream_id=None):
+        self.stream_id = stream_id  # None disables the ROI layer
+        self.roi_key = None
+        self.roi_patches = []
+        self.timestamp_text = None
+        self.timestamp_patch = None
+    
+    def _get_roi_patches(self, frame_shape):
+        if not self.stream_id:
+            return []
+        
+        roi_file = os.path.join(ROI_CONFIG_DIR, f"{self.stream_id}.json")
+        try:
+            mtime = os.path.getmtime(roi_file)
+        except OSError:
+            mtime = None
+        
+        key = (mtime, frame_shape[:2])
+        if key != self.roi_key:
+            self.roi_key = key
+            self.roi_patches = []
+            if mtime is not None:
+                try:
+                    with open(roi_file, 'r') as f:
+                        rois = json.load(f)
+                    self.roi_patches = [patch for patch in
+                                        (self._render_roi(roi_info, frame_shape) for roi_info in rois.values())
+                                        if patch is not None]
+                except Exception as e:
+                    logger.error(f"Error loading ROIs: {e}")
+        return self.roi_patches
+    
+    @staticmethod
+    def _render_roi(roi_info, frame_shape):
+        """Rasterize one ROI's outline and name label into a patch"""
+        points = roi_info.get('points', [])
+        if not points or len(points) <= 2:
+            return None
+        
+        # Points are stored as percentages of the frame
+        pts = roi_points_to_pixels(points, frame_shape)
+        
+        # Use different color for active ROIs
+        color = ROI_ACTIVE_COLOR if roi_info.get('enabled', True) else ROI_COLOR
+        
+        # Bounds of everything drawn for this ROI
+        x1, y1 = pts.min(axis=0) - ROI_THICKNESS
+        x2, y2 = pts.max(axis=0) + ROI_THICKNESS
+        name = roi_info.get('name')
+        if name:
+            # Label sits above the ROI's top-left corner
+            min_x, min_y = pts.min(axis=0)
+            text_size = cv2.getTextSize(name, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)[0]
+            label_rect = ((min_x, min_y - 20), (min_x + text_size[0], min_y))
+            x1, y1 = min(x1, min_x), min(y1, min_y - 22)
+            x2 = max(x2, min_x + text_size[0] + 2)
+        
+        layer = np.zeros((y2 - y1 + 1, x2 - x1 + 1, 3), np.uint8)
+        alpha = np.zeros(layer.shape[:2], np.uint8)
+        offset = np.array([x1, y1], np.int32)
+        
+        # Draw polygon
+        polygon = (pts - offset).reshape((-1, 1, 2))
+        cv2.polylines(layer, [polygon], True, color, ROI_THICKNESS)
+        cv2.polylines(alpha, [polygon], True, 255, ROI_THICKNESS)
+        
+        # Draw label if available
+        if name:
+            (lx1, ly1), (lx2, ly2) = label_rect
+            top_left = (int(lx1 - x1), int(ly1 - y1))
+            bottom_right = (int(lx2 - x1), int(ly2 - y1))
+            cv2.rectangle(layer, top_left, bottom_right, color, -1)
+            cv2.rectangle(alpha, top_left, bottom_right, 255, -1)
+            text_origin = (int(lx1 - x1), int(ly2 - 5 - y1))
+            cv2.putText(layer, name, text_origin, cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+            cv2.putText(alpha, name, text_origin, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 255, 1)
+        
+        return make_overlay_patch(int(x1), int(y1), layer, alpha)
+    
+    def _get_timestamp_patch(self):
+        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if current_datetime != self.timestamp_text:
+            self.timestamp_text = current_datetime
+            
+            ts_size = cv2.getTextSize(current_datetime, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)[0]
+            layer = np.zeros((45, ts_size[0] + 20, 3), np.uint8)
+            alpha = np.zeros(layer.shape[:2], np.uint8)
+            
+            # Semi-transparent black background
+            cv2.rectangle(alpha, (5, 5), (ts_size[0] + 15, 40), 128, -1)
+            
+            # Timestamp with outline for better visibility
+            cv2.putText(alpha, current_datetime, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2)  # Outline
+            cv2.putText(layer, current_datetime, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)  # Text
+            
+            self.timestamp_patch = make_overlay_patch(0, 0, layer, alpha)
+        return self.timestamp_patch
+    
+    def composite(self, frame, scale, predictions=(), predicted_boxes=None):
+        """Draw ROIs, detections and the timestamp onto the frame in place
+        
+        Args:
+            frame (ndarray): Output frame (already resized)
+            scale (float): Output size relative to the detection frame
+            predictions (list): Cached detections for the stream
+            predicted_boxes (dict): tracking_id -> extrapolated bbox, overriding the detected one
+        """
+        predicted_boxes = predicted_boxes or {}
+        
+        for patch in self._get_roi_patches(frame.shape):
+            blend_overlay_patch(frame, patch)
+        
+        for pred in predictions:
+            if isinstance(pred, dict) and 'bbox' in pred and 'label' in pred:
+                try:
+                    self._draw_detection(frame, pred, predicted_boxes.get(pred.get('tracking_id'), pred['bbox']), scale)
+                except (ValueError, TypeError) as e:
+                    logger.error(f"Error drawing prediction: {e}, pred: {pred}")
+        
+        blend_overlay_patch(frame, self._get_timestamp_patch())
+    
+    @staticmethod
+    def _draw_detection(frame, pred, bbox, scale):
+        x1, y1, x2, y2 = (int(v * scale) for v in bbox)
+        label = pred['label']
+        formatted_label = format_class_name(label)
+        
+        # Look for 'score' first, then fall back to 'confidence' if not found
+        confidence = pred.get('score', pred.get('confidence', 0))
+        
+        # Get tracking ID or default to 0
+        tracking_id = pred.get('tracking_id', 0)
+        
+        # Get color for this object type
+        color = get_color(label)
+        
+        # Draw bounding box
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        
+        # Top identification bar that shows object class and confidence
+        text = f"{formatted_label} {confidence*100:.0f}%"
+        text_size = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)[0]
+        
+        # Ensure text background doesn't extend beyond the box
+        text_width = min(text_size[0] + 10, x2 - x1)
+        
+        # Semi-transparent background, blended over the bar's rectangle only
+        blend_rect(frame, x1, y1 - 22, x1 + text_width, y1, color, 0.7)
+        
+        cv2.putText(frame, text, (x1 + 5, y1 - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        
+        # Draw ID label (bottom-right)
+        if tracking_id > 0:
+            id_text = f"#{tracking_id}"
+            id_size = cv2.getTextSize(id_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)[0]
             
-        # Only retry if we haven't tried the max number of times
-        if attempt + 1 < retry:
-            logger.info(f"Retrying AI server call ({attempt+1}/{retry})")
-            time.sleep(1)  # Wait a second before retrying
-        else:
-            return False, ai_server_status['last_error']
-    
-    return False, "Max retries exceeded"
-
-def generate_frames(rtsp_url, is_roi_editor=False):
-    """Generate video frames with object detection and ROI overlays"""
-    # Access global variables needed for tracking state
-    global last_count_update, object_counts, stream_cache
-    
-    # Track reconnection status for this specific stream session
-    last_reconnect_attempt = 0
-    reconnect_cooldown = 5  # Initial cooldown of 5 seconds
-    max_reconnect_cooldown = 30  # Maximum cooldown of 30 seconds
-    reconnection_count = 0
-    last_log_time = 0  # Track when we last logged a connection error
-    
-    # Create object tracking dictionary to maintain consistent object IDs across frames
-    object_tracker = {}
-    next_object_id = 1
-    
-    # Open the stream
-    stream = open_stream(rtsp_url)
-    if not stream:
-        # Return an error image
-        error_img = np.zeros((480, 640, 3), np.uint8)
-        cv2.putText(error_img, "Error: Could not open stream", (50, 240), 
-                  cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-        
-        # Convert to JPEG
-        ret, buffer = cv2.imencode('.jpg', error_img)
-        error_frame = buffer.tobytes()
-        
-        # Yield the error frame once
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + error_frame + b'\r\n')
-        return
+            # Small box in bottom right of bounding box
+            cv2.rectangle(frame, (x2 - id_size[0] - 5, y2 - id_size[1] - 5), (x2, y2), color, -1)
+            cv2.putText(frame, id_text, (x2 - id_size[0] - 3, y2 - 5),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+
+
+def generate_frames(rtsp_url, is_roi_editor=False, profile=None):
+    """Generate video frames with object detection and ROI overlays
+    
+    Runs once per FrameBroadcaster; viewers receive the broadcaster's output
+    rather than iterating this generator themselves.
+    
+    Args:
+        rtsp_url (str): Stream URL
+        is_roi_editor (bool): Skip overlays and detection for the ROI editor
+        profile (tuple): (width, max_fps, quality) as returned by parse_stream_profile()
+    """
+    # Frames come from the shared per-camera decoder instead of a private capture
+    worker = get_capture_worker(rtsp_url)
+    last_seq = 0
+    
+    # Output profile - resizing and rate limiting happen before overlays and encoding
+    out_width, max_fps, jpeg_quality = profile or parse_stream_profile({})
+    min_frame_interval = 1.0 / max_fps if max_fps else 0
+    last_output_time = 0
     
     # Get configuration for AI detection
     config = load_config()
     ai_enabled = config['ai_server']['enabled']
-    ai_server_url = config['ai_server']['url']
     
-    # Load ROIs for this stream if not in ROI editor mode
-    rois = {}
     stream_id = None
     
     try:
@@ -853,96 +3406,43 @@ def generate_frames(rtsp_url, is_roi_editor=False):
             if s_info.get('url') == rtsp_url:
                 stream_id = s_id
                 break
-        
-        if stream_id and not is_roi_editor:
-            roi_file = os.path.join(ROI_CONFIG_DIR, f"{stream_id}.json")
-            if os.path.exists(roi_file):
-                with open(roi_file, 'r') as f:
-                    rois = json.load(f)
     except Exception as e:
-        logger.error(f"Error loading ROIs: {e}")
+        logger.error(f"Error looking up stream ID: {e}")
+    
+    # ROIs are not drawn in ROI editor mode; the compositor reloads them when the ROI file changes
+    compositor = OverlayCompositor(stream_id if SHOW_ROIS and not is_roi_editor else None)
+    
+    # Detection runs on the stream's inference worker; we only read prediction_cache
+    # Skip detection in ROI editor mode
+    run_detection = ai_enabled and not is_roi_editor
+    inference = get_inference_worker(rtsp_url, stream_id) if run_detection else None
     
     # Process frames
     frame_count = 0
-    last_detection_time = time.time()
-    detection_interval = 0.5  # Detect every 0.5 seconds
-    
-    # Create a default error image once
-    error_img = np.zeros((480, 640, 3), np.uint8)
     
     while True:
-        success = False
+        # Take the newest decoded frame, waiting briefly if we've already shown it
+        entry = worker.ring.wait_newer(last_seq, timeout=1.0)
         current_time = time.time()
-        frame = None
         
-        # Use the per-stream lock if available to prevent threading issues
-        stream_lock = None
-        if rtsp_url in stream_cache and 'lock' in stream_cache[rtsp_url]:
-            stream_lock = stream_cache[rtsp_url]['lock']
-        else:
-            # Create a lock if it doesn't exist yet
-            stream_lock = threading.Lock()
-            if rtsp_url in stream_cache:
-                stream_cache[rtsp_url]['lock'] = stream_lock
-        
-        # Try to read a frame with lock protection
-        try:
-            if stream is not None:
-                # Use the lock to prevent concurrent access to the stream
-                with stream_lock:
-                    success, frame = stream.read()
-                
-                # Update stream health metrics if stream exists in cache
-                if rtsp_url in stream_cache:
-                    if success:
-                        stream_cache[rtsp_url]['frames_read'] += 1
-                        # Reset failed reads counter on successful read
-                        if stream_cache[rtsp_url]['failed_reads'] > 0:
-                            stream_cache[rtsp_url]['failed_reads'] = 0
-                    else:
-                        stream_cache[rtsp_url]['failed_reads'] += 1
-                        # Update health metric
-                        failed = stream_cache[rtsp_url]['failed_reads']
-                        if failed > 3:  # After 3 failures, start reducing health
-                            stream_cache[rtsp_url]['health'] = max(0, 100 - (failed * 10))
-        except Exception as e:
-            success = False
-            logger.error(f"Error reading from stream: {e}")
-        
-        if not success:
-            # Check if we should attempt reconnection
-            if current_time - last_reconnect_attempt >= reconnect_cooldown:
-                # Only log reconnection message periodically to avoid spamming logs
-                if current_time - last_log_time >= 60:  # Only log once per minute
-                    logger.warning(f"Lost connection to stream {rtsp_url}, attempting to reconnect...")
-                    last_log_time = current_time
-                
-                # Update reconnection tracking
-                last_reconnect_attempt = current_time
-                reconnection_count += 1
-                
-                # Try to reconnect
-                if stream is not None:
-                    try:
-                        # Properly release the stream to avoid FFmpeg context issues
-                        with stream_lock:
-                            stream.release()
-                            # Small delay to ensure complete cleanup
-                            time.sleep(0.1)
-                    except Exception as e:
-                        logger.error(f"Error releasing stream: {e}")
-                
-                stream = open_stream(rtsp_url)
-                
-                # Increase cooldown period exponentially up to max_reconnect_cooldown
-                reconnect_cooldown = min(max_reconnect_cooldown, 2 ** min(reconnection_count, 4))
+        if entry is None:
+            if worker.connected and worker.is_alive():
+                continue
+            
+            # Restart the decoder if it stopped while we were still watching
+            if not worker.is_alive():
+                worker = get_capture_worker(rtsp_url)
             
-            # Show reconnecting message
-            cv2.putText(error_img, "Connection lost. Reconnecting...", (50, 240), 
+            error_img = np.zeros((480, 640, 3), np.uint8)
+            if worker.ring.seq == 0:
+                message = "Error: Could not open stream"
+            else:
+                message = "Connection lost. Reconnecting..."
+            cv2.putText(error_img, message, (50, 240), 
                       cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
             
             # Add some status info
-            status_text = f"Next attempt in {int(reconnect_cooldown - (current_time - last_reconnect_attempt))}s"
+            status_text = f"Next attempt in {worker.next_attempt_in()}s"
             cv2.putText(error_img, status_text, (50, 280), 
                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 1)
             
@@ -956,328 +3456,194 @@ def generate_frames(rtsp_url, is_roi_editor=False):
             time.sleep(0.5)
             continue
         
-        # We have a valid frame - reset reconnection count on success
-        reconnection_count = 0
-        reconnect_cooldown = 5  # Reset to initial cooldown
+        last_seq, frame_time, frame = entry
+        
+        # Drop frames above the profile's rate cap before doing any work on them
+        if min_frame_interval and current_time - last_output_time < min_frame_interval:
+            continue
+        last_output_time = current_time
         
         frame_count += 1
         
-        # Make a copy of the frame for overlays
-        display_frame = frame.copy()
-        
-        # Draw ROIs on the frame
-        if SHOW_ROIS and not is_roi_editor and rois:
-            for roi_id, roi_info in rois.items():
-                points = roi_info.get('points', [])
-                if points and len(points) > 2:
-                    # Convert points to numpy array for OpenCV
-                    pts = np.array(points, np.int32)
-                    pts = pts.reshape((-1, 1, 2))
-                    
-                    # Use different color for active ROIs
-                    color = ROI_ACTIVE_COLOR if roi_info.get('enabled', True) else ROI_COLOR
-                    
-                    # Draw polygon
-                    cv2.polylines(display_frame, [pts], True, color, ROI_THICKNESS)
-                    
-                    # Draw label if available
-                    if 'name' in roi_info:
-                        # Find top-left point for text placement
-                        min_x = min(p[0] for p in points)
-                        min_y = min(p[1] for p in points)
-                        
-                        # Draw semi-transparent background for text
-                        text_size = cv2.getTextSize(roi_info['name'], cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)[0]
-                        cv2.rectangle(display_frame, 
-                                     (min_x, min_y - 20), 
-                                     (min_x + text_size[0], min_y), 
-                                     color, -1)
-                        
-                        # Draw text
-                        cv2.putText(display_frame, roi_info['name'], 
-                                   (min_x, min_y - 5), 
-                                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        # Restart the inference worker if it went idle (e.g. after a reconnect)
+        if run_detection and not inference.is_alive():
+            inference = get_inference_worker(rtsp_url, stream_id)
         
-        # Do object detection if AI is enabled and it's time for detection
-        # Skip detection in ROI editor mode
-        current_detection_objects = {}  # Track objects in current frame
+        # Make a (possibly downscaled) copy of the frame for overlays.
+        # Detection still uses the full-resolution frame; overlay coordinates are scaled.
+        frame_height, frame_width = frame.shape[:2]
+        if out_width and out_width < frame_width:
+            scale = out_width / frame_width
+            display_frame = cv2.resize(frame, (out_width, int(frame_height * scale)), interpolation=cv2.INTER_AREA)
+        else:
+            scale = 1.0
+            display_frame = frame.copy()
         
-        if ai_enabled and not is_roi_editor and current_time - last_detection_time >= detection_interval:
-            try:
-                # Use higher quality for detection frames
-                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-                _, img_encoded = cv2.imencode('.jpg', frame, encode_param)
-                img_bytes = img_encoded.tobytes()
-                
-                # Get stream ID for the request
-                request_stream_id = stream_id if stream_id else str(hash(rtsp_url))
-                
-                # Debug info for troubleshooting
-                logger.debug(f"Sending frame from stream {request_stream_id} to AI server for processing")
-                
-                # Save the image to a temporary file first - this ensures proper image format
-                temp_img_path = os.path.join('/tmp', f"frame_{request_stream_id}_{int(time.time())}.jpg")
-                with open(temp_img_path, 'wb') as f:
-                    f.write(img_bytes)
-                
-                # Send the image file to the AI server using multipart/form-data
-                try:
-                    with open(temp_img_path, 'rb') as img_file:
-                        files = {'image': ('image.jpg', img_file, 'image/jpeg')}
-                        
-                        # The AI server expects 'stream_id' as a parameter
-                        params = {'stream_id': request_stream_id}
-                        if rois and len(rois) > 0:
-                            params['check_roi'] = 'true'
-                        
-                        logger.debug(f"Sending image to AI server with params: {params}")
-                        
-                        # Use the call_ai_server helper function instead of direct request
-                        success, response = call_ai_server(
-                            endpoint="predict",
-                            method="post",
-                            files=files,
-                            params=params,
-                            timeout=2
-                        )
-                        
-                        # Process predictions if successful
-                        if success:
-                            try:
-                                response_data = response.json()
-                                logger.debug(f"Received response from AI server: {response_data}")
-                                
-                                # Handle different response formats - check if the response is a nested structure
-                                if isinstance(response_data, dict) and 'detections' in response_data:
-                                    # Extract the detections array from the nested structure
-                                    predictions = response_data['detections']
-                                    logger.debug(f"Extracted {len(predictions)} detections from nested response")
-                                else:
-                                    # Use the response directly if it's already an array
-                                    predictions = response_data
-                                
-                                # Update prediction cache
-                                prediction_cache[rtsp_url] = {
-                                    'time': current_time,
-                                    'predictions': predictions
-                                }
-                                
-                                # Process object counts
-                                if current_time - last_count_update >= COUNT_UPDATE_INTERVAL:
-                                    for pred in predictions:
-                                        if isinstance(pred, dict):
-                                            label = pred.get('label', 'unknown')
-                                            object_counts[label] += 1
-                                    
-                                    # Update the last count update time
-                                    last_count_update = current_time
-                            except json.JSONDecodeError as e:
-                                logger.error(f"Failed to parse AI server response as JSON: {e}")
-                                logger.debug(f"Response content: {response.text}")
-                        else:
-                            logger.warning(f"AI prediction failed: {response}")
-                    
-                    # Clean up temporary file
-                    try:
-                        os.unlink(temp_img_path)
-                    except:
-                        pass
-                        
-                except requests.RequestException as e:
-                    logger.error(f"Request to AI server failed: {e}")
-                
-            except Exception as e:
-                logger.error(f"AI prediction error: {str(e)}")
-                import traceback
-                logger.error(traceback.format_exc())
-            
-            # Reset detection timer
-            last_detection_time = current_time
+        # Collect the current detections, moved to this frame's capture time
+        predictions = []
+        predicted_boxes = {}
+        cache_data = prediction_cache.get(rtsp_url)
         
-        # Draw cached predictions if available and recent
-        if rtsp_url in prediction_cache:
-            cache_data = prediction_cache[rtsp_url]
-            cache_age = current_time - cache_data['time']
+        # Only show predictions for a limited time
+        if cache_data and current_time - cache_data['time'] < PREDICTION_CACHE_DURATION:
+            predictions = cache_data['predictions']
             
-            # Purge old tracking IDs
-            if cache_age < 0.1:  # Only on fresh detections
-                active_object_ids = set()
-                
-                # First pass - assign tracking IDs to objects
-                for pred in cache_data['predictions']:
-                    if isinstance(pred, dict) and 'bbox' in pred and 'label' in pred:
-                        try:
-                            # Create a key for object tracking
-                            x1, y1, x2, y2 = map(int, pred['bbox'])
-                            label = pred.get('label', 'unknown').lower()
-                            
-                            # Calculate object center point
-                            center_x = (x1 + x2) // 2
-                            center_y = (y1 + y2) // 2
-                            
-                            # Try to match with existing tracked objects
-                            best_match_id = None
-                            best_match_distance = float('inf')
-                            
-                            for obj_id, obj_info in object_tracker.items():
-                                # Only match same class of objects
-                                if obj_info['label'] != label:
-                                    continue
-                                    
-                                # Calculate distance to previous center
-                                prev_x = obj_info['center_x']
-                                prev_y = obj_info['center_y']
-                                distance = ((center_x - prev_x) ** 2 + (center_y - prev_y) ** 2) ** 0.5
-                                
-                                # If within reasonable distance, consider it the same object
-                                if distance < 100 and distance < best_match_distance:  # 100 pixels threshold
-                                    best_match_id = obj_id
-                                    best_match_distance = distance
-                            
-                            if best_match_id is not None:
-                                # Update existing object
-                                object_id = best_match_id
-                                object_tracker[object_id]['center_x'] = center_x
-                                object_tracker[object_id]['center_y'] = center_y
-                                object_tracker[object_id]['time'] = current_time
-                            else:
-                                # Create new tracked object
-                                object_id = next_object_id
-                                next_object_id += 1
-                                object_tracker[object_id] = {
-                                    'label': label,
-                                    'center_x': center_x,
-                                    'center_y': center_y,
-                                    'time': current_time,
-                                    'color': get_color(label)
-                                }
-                            
-                            # Store ID in prediction for rendering
-                            pred['tracking_id'] = object_id
-                            active_object_ids.add(object_id)
-                            
-                        except (ValueError, TypeError) as e:
-                            logger.error(f"Error processing prediction for tracking: {e}, pred: {pred}")
-                
-                # Clean up old tracked objects (not seen in 3 seconds)
-                for obj_id in list(object_tracker.keys()):
-                    if obj_id not in active_object_ids and current_time - object_tracker[obj_id]['time'] > 3.0:
-                        del object_tracker[obj_id]
-            
-            # Only show predictions for a limited time
-            if cache_age < PREDICTION_CACHE_DURATION:
-                predictions = cache_data['predictions']
-                
-                # Draw each prediction
-                for pred in predictions:
-                    if isinstance(pred, dict) and 'bbox' in pred and 'label' in pred:
-                        try:
-                            x1, y1, x2, y2 = map(int, pred['bbox'])
-                            label = pred['label']
-                            formatted_label = format_class_name(label)
-                            
-                            # Look for 'score' first, then fall back to 'confidence' if not found
-                            confidence = pred.get('score', pred.get('confidence', 0))
-                            
-                            # Get tracking ID or default to 0
-                            tracking_id = pred.get('tracking_id', 0)
-                            
-                            # Get color for this object type, preferring the tracked object color
-                            if tracking_id in object_tracker:
-                                color = object_tracker[tracking_id]['color']
-                            else:
-                                color = get_color(label)
-                            
-                            # Calculate box dimensions
-                            box_width = x2 - x1
-                            box_height = y2 - y1
-                            
-                            # Draw bounding box with rounded corners
-                            cv2.rectangle(display_frame, (x1, y1), (x2, y2), color, 2)
-                            
-                            # Draw top identification bar that shows object class and confidence
-                            text = f"{formatted_label} {confidence*100:.0f}%"
-                            text_size = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)[0]
-                            
-                            # Ensure text background doesn't extend beyond frame edge
-                            text_width = min(text_size[0] + 10, box_width)
-                            
-                            # Draw semi-transparent background for text
-                            overlay = display_frame.copy()
-                            cv2.rectangle(overlay, 
-                                         (x1, y1 - 22), 
-                                         (x1 + text_width, y1), 
-                                         color, -1)
-                            # Apply transparency
-                            alpha = 0.7
-                            cv2.addWeighted(overlay, alpha, display_frame, 1 - alpha, 0, display_frame)
-                            
-                            # Draw text
-                            cv2.putText(display_frame, text, 
-                                       (x1 + 5, y1 - 5), 
-                                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-                            
-                            # Draw ID label (bottom-right)
-                            if tracking_id > 0:
-                                id_text = f"#{tracking_id}"
-                                id_size = cv2.getTextSize(id_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)[0]
-                                
-                                # Draw ID background (small box in bottom right of bounding box)
-                                cv2.rectangle(display_frame,
-                                             (x2 - id_size[0] - 5, y2 - id_size[1] - 5),
-                                             (x2, y2),
-                                             color, -1)
-                                
-                                # Draw ID text
-                                cv2.putText(display_frame, id_text,
-                                           (x2 - id_size[0] - 3, y2 - 5),
-                                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-                            
-                        except (ValueError, TypeError) as e:
-                            logger.error(f"Error drawing prediction: {e}, pred: {pred}")
-        
-        # Add timestamp and system info to the frame
-        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            if detection_settings.get('box_prediction', True) and rtsp_url in stream_trackers:
+                track_ids, track_boxes = stream_trackers[rtsp_url].predict(frame_time)
+                predicted_boxes = dict(zip(track_ids.tolist(), track_boxes))
         
-        # Draw semi-transparent background for timestamp
-        ts_size = cv2.getTextSize(current_datetime, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)[0]
-        overlay = display_frame.copy()
-        cv2.rectangle(overlay, (5, 5), (ts_size[0] + 15, 40), (0, 0, 0), -1)
-        # Apply transparency
-        alpha = 0.5
-        cv2.addWeighted(overlay, alpha, display_frame, 1 - alpha, 0, display_frame)
-        
-        # Draw timestamp with outline for better visibility
-        cv2.putText(display_frame, current_datetime, 
-                   (10, 30), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)  # Outline
-        cv2.putText(display_frame, current_datetime, 
-                   (10, 30), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)  # Text
+        # ROIs, detections and the timestamp are drawn in one pass with no full-frame copies
+        compositor.composite(display_frame, scale, predictions, predicted_boxes)
         
         # Convert to JPEG for streaming
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 70]  # Lower quality for streaming
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]  # Lower quality for streaming
         ret, buffer = cv2.imencode('.jpg', display_frame, encode_param)
         frame_bytes = buffer.tobytes()
         
         # Yield the frame in multipart response
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        # No sleep needed - wait_newer() paces the loop at the camera frame rate
+
+class FrameBroadcaster:
+    """Renders and encodes a stream once and hands the same JPEG bytes to every viewer
+    
+    One broadcaster exists per (stream, overlay mode, output profile). It drives
+    generate_frames() on its own thread and publishes each multipart chunk,
+    so overlay drawing and JPEG encoding cost scales with cameras, not viewers.
+    """
+    
+    def __init__(self, key, rtsp_url, is_roi_editor=False, profile=None):
+        self.key = key
+        self.rtsp_url = rtsp_url
+        self.is_roi_editor = is_roi_editor
+        self.profile = profile
+        self.condition = threading.Condition()
+        self.chunk = None
+        self.seq = 0
+        self.subscribers = 0  # Guarded by frame_broadcasters_lock
+        self.last_subscriber_time = time.time()
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"broadcast-{hash(self.key)}")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def is_alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+    
+    def publish(self, chunk):
+        with self.condition:
+            self.seq += 1
+            self.chunk = chunk
+            self.condition.notify_all()
+    
+    def wait_newer(self, last_seq, timeout=1.0):
+        """Get (seq, chunk) for the newest encoded frame newer than last_seq, or None on timeout"""
+        with self.condition:
+            if self.seq <= last_seq:
+                self.condition.wait(timeout)
+            if self.seq <= last_seq:
+                return None
+            return self.seq, self.chunk
+    
+    def unsubscribe(self):
+        with frame_broadcasters_lock:
+            self.subscribers = max(0, self.subscribers - 1)
+            self.last_subscriber_time = time.time()
+    
+    def _should_stop(self):
+        """Check for idleness and deregister atomically so no subscriber can join a dying broadcaster"""
+        with frame_broadcasters_lock:
+            if self.subscribers > 0:
+                return False
+            if time.time() - self.last_subscriber_time < BROADCASTER_IDLE_TIMEOUT:
+                return False
+            if frame_broadcasters.get(self.key) is self:
+                del frame_broadcasters[self.key]
+            self.running = False
+            return True
+    
+    def _run(self):
+        frames = generate_frames(self.rtsp_url, self.is_roi_editor, self.profile)
+        try:
+            for chunk in frames:
+                self.publish(chunk)
+                if self._should_stop():
+                    break
+        except Exception as e:
+            logger.error(f"Error in frame broadcaster for {self.rtsp_url}: {e}")
+        finally:
+            frames.close()
+            self.running = False
+            with frame_broadcasters_lock:
+                if frame_broadcasters.get(self.key) is self:
+                    del frame_broadcasters[self.key]
+            # Wake any viewer still waiting so it can pick up a replacement
+            with self.condition:
+                self.condition.notify_all()
+
+
+def parse_stream_profile(args):
+    """Build a normalized output profile from /video_feed query parameters
+    
+    Args:
+        args (dict): Request arguments - 'profile' selects a preset from STREAM_PROFILES,
+            'width', 'max_fps' and 'quality' override individual values
         
-        # Control frame rate to reduce CPU usage
-        time.sleep(0.03)  # ~30 FPS
+    Returns:
+        tuple: (width, max_fps, quality), hashable so it can key a broadcaster
+    """
+    profile = dict(STREAM_PROFILES.get(args.get('profile', 'full'), STREAM_PROFILES['full']))
+    
+    # Each override falls back to the preset on its own, so one bad value doesn't void the others
+    for name, convert in (('width', int), ('max_fps', float), ('quality', int)):
+        if not args.get(name):
+            continue
+        try:
+            value = convert(args.get(name))
+            if not np.isfinite(value):
+                raise ValueError
+            profile[name] = value
+        except (TypeError, ValueError):
+            logger.debug(f"Ignoring invalid stream profile parameter {name}={args.get(name)!r}")
+    
+    # Clamp to sane ranges so clients can't request absurd encodes
+    width = max(0, min(int(profile['width']), 3840))
+    if 0 < width < 64:
+        width = 64
+    max_fps = max(0.0, min(float(profile['max_fps']), 60.0))
+    quality = max(10, min(int(profile['quality']), 95))
+    return (width, max_fps, quality)
+
+
+def subscribe_frame_broadcaster(rtsp_url, is_roi_editor=False, profile=None):
+    """Get the broadcaster for a stream, overlay mode and profile, starting one if needed, and subscribe to it"""
+    profile = profile or parse_stream_profile({})
+    key = (rtsp_url, is_roi_editor, profile)
+    with frame_broadcasters_lock:
+        broadcaster = frame_broadcasters.get(key)
+        if broadcaster is None or not broadcaster.is_alive():
+            broadcaster = FrameBroadcaster(key, rtsp_url, is_roi_editor, profile)
+            frame_broadcasters[key] = broadcaster
+            broadcaster.start()
+        broadcaster.subscribers += 1
+        broadcaster.last_subscriber_time = time.time()
+        return broadcaster
 
 @app.route('/health', methods=['GET'])
 def health():
     """Check health of AI server and NVR app"""
-    config = load_config()
-    
-    if config['ai_server']['enabled']:
-        success, result = call_ai_server(endpoint="health", timeout=2)
-        if success:
-            ai_status = result.json()
-        else:
-            ai_status = {"status": "DOWN", "error": str(result)}
+    # The AI server's health comes from the background prober, not a live call
+    if ai_client.enabled:
+        if ai_client.health.get('checked_at') is None:
+            # Prober hasn't run yet (e.g. right after startup) - probe once now
+            ai_client.probe_health()
+        ai_status = dict(ai_client.health)
+        ai_status.update(ai_client.get_stats())
     else:
         ai_status = {"status": "DISABLED"}
         
@@ -1297,30 +3663,47 @@ def video_feed():
         
     is_roi_editor = request.args.get('roi_editor', 'false').lower() == 'true'
     
+    # Output profile (resolution, frame rate and JPEG quality), e.g. ?profile=tile or ?width=480&max_fps=5
+    profile = parse_stream_profile(request.args)
+    
     # Track client connections for this stream
     if rtsp_url not in stream_clients:
         stream_clients[rtsp_url] = 0
     stream_clients[rtsp_url] += 1
     logger.debug(f"New client connected to stream {rtsp_url}, total clients: {stream_clients[rtsp_url]}")
     
+    # Every client of the same stream, overlay mode and profile shares one broadcaster
+    broadcaster = subscribe_frame_broadcaster(rtsp_url, is_roi_editor, profile)
+    
     # Create a generator for the client
     def generate():
+        current = broadcaster
+        last_seq = 0
         try:
-            # Use the existing generator
-            for frame in generate_frames(rtsp_url, is_roi_editor):
+            while True:
+                item = current.wait_newer(last_seq, timeout=5.0)
+                if item is None:
+                    if not current.is_alive():
+                        # The broadcaster died underneath us, join a fresh one
+                        current.unsubscribe()
+                        current = subscribe_frame_broadcaster(rtsp_url, is_roi_editor, profile)
+                        last_seq = 0
+                    continue
+                last_seq, frame = item
                 yield frame
         finally:
+            current.unsubscribe()
             # When client disconnects, decrement client count
             if rtsp_url in stream_clients:
                 stream_clients[rtsp_url] = max(0, stream_clients[rtsp_url] - 1)
                 logger.debug(f"Client disconnected from stream {rtsp_url}, remaining clients: {stream_clients[rtsp_url]}")
                 
                 # Only release the stream if no clients are watching
-                if stream_clients[rtsp_url] == 0 and rtsp_url in stream_cache:
-                    logger.info(f"All clients disconnected from {rtsp_url}, keeping stream in cache for future use")
-                    # We don't immediately release the stream, just update the last access time
+                if stream_clients[rtsp_url] == 0 and rtsp_url in capture_workers:
+                    logger.info(f"All clients disconnected from {rtsp_url}, keeping capture worker alive for {CAPTURE_IDLE_TIMEOUT}s")
+                    # We don't immediately stop the decoder, just mark when the last viewer left
                     # This allows quick reconnections without having to reestablish the RTSP connection
-                    stream_cache[rtsp_url]['last_access'] = time.time()
+                    capture_workers[rtsp_url].last_viewer_time = time.time()
     
     return Response(
         generate(),
@@ -1427,8 +3810,13 @@ def settings_ai():
         config['ai_server']['url'] = request.form['ai_server_url']
     # Update enabled status
     config['ai_server']['enabled'] = 'ai_server_enabled' in request.form
+    config['ai_server']['batch_enabled'] = 'ai_batch_enabled' in request.form
+    config['detection']['motion_gating'] = 'motion_detection' in request.form
+    config['detection']['local_roi_filter'] = 'local_roi_filter' in request.form
     
     save_config(config)
+    ai_client.configure(config['ai_server'])
+    apply_detection_settings(config)
     flash("AI settings updated successfully", "success")
     return redirect(url_for('settings'))
 
@@ -1444,6 +3832,8 @@ def settings_recording():
         if os.path.exists(new_path) or os.access(os.path.dirname(new_path), os.W_OK):
             config['recording']['path'] = new_path
             os.makedirs(new_path, exist_ok=True)
+            # Register recordings already in that directory (once per path)
+            start_recording_index_backfill(new_path)
         else:
             flash(f"Invalid recording path: {new_path}", "danger")
             return redirect(url_for('settings'))
@@ -1474,7 +3864,34 @@ def settings_recording():
         if storage_mode in ['file', 'hybrid', 'database']:
             config['recording']['storage_mode'] = storage_mode
     
+    # Update recording mode and segment format
+    if request.form.get('recording_mode') in RECORDING_MODES:
+        config['recording']['mode'] = request.form['recording_mode']
+    if request.form.get('recording_format') in RECORDING_FORMATS:
+        config['recording']['format'] = request.form['recording_format']
+    
+    if 'segment_seconds' in request.form:
+        try:
+            seconds = int(request.form['segment_seconds'])
+            if seconds >= 10:
+                config['recording']['segment_seconds'] = seconds
+        except ValueError:
+            flash("Segment length must be a whole number of seconds", "danger")
+            return redirect(url_for('settings'))
+    
+    # Update HLS playback (checkbox - absent from the form when unchecked)
+    config['recording']['hls_playback'] = 'hls_playback' in request.form
+    if 'hls_min_seconds' in request.form:
+        try:
+            seconds = int(request.form['hls_min_seconds'])
+            if seconds >= 0:
+                config['recording']['hls_min_seconds'] = seconds
+        except ValueError:
+            flash("HLS minimum length must be a whole number of seconds", "danger")
+            return redirect(url_for('settings'))
+    
     save_config(config)
+    sync_recorders(config)
     flash("Recording settings updated successfully", "success")
     return redirect(url_for('settings'))
 
@@ -1510,6 +3927,7 @@ def add_stream():
     }
     
     save_stream_config(streams)
+    sync_recorders()
     flash(f"Stream '{data['name']}' saved successfully", "success")
     
     # Redirect back to the appropriate page
@@ -1526,9 +3944,10 @@ def delete_stream(stream_id):
         stream_name = streams[stream_id]['name']
         stream_url = streams[stream_id]['url']
         
-        # 1. Delete stream from config
+        # 1. Delete stream from config and stop recording it
         del streams[stream_id]
         save_stream_config(streams)
+        stop_recorder(stream_id)
         
         # 2. Delete ROI configuration if exists
         roi_file = os.path.join(ROI_CONFIG_DIR, f"{stream_id}.json")
@@ -1538,9 +3957,16 @@ def delete_stream(stream_id):
                 logger.info(f"Deleted ROI configuration for stream {stream_name}")
             except Exception as e:
                 logger.error(f"Failed to delete ROI file for stream {stream_id}: {e}")
+        invalidate_roi_masks(stream_id)
         
-        # 3. Release stream from cache if present
-        if stream_url in stream_cache:
+        # 3. Stop the inference and capture workers, which releases the stream from cache
+        stop_inference_worker(stream_url)
+        prediction_cache.pop(stream_url, None)
+        stream_trackers.pop(stream_url, None)
+        if stream_url in capture_workers:
+            stop_capture_worker(stream_url)
+            logger.info(f"Stopped capture worker for stream {stream_name}")
+        elif stream_url in stream_cache:
             try:
                 stream_cache[stream_url]['stream'].release()
                 del stream_cache[stream_url]
@@ -1552,29 +3978,9 @@ def delete_stream(stream_id):
         config = load_config()
         if config['recording']['storage_mode'] in ['database', 'hybrid']:
             try:
-                session = get_session()
-                try:
-                    # Delete recordings associated with this stream
-                    recordings = session.query(Recording).filter(Recording.stream_id == stream_id).all()
-                    for recording in recordings:
-                        # Delete file if exists
-                        if recording.has_file and recording.path and os.path.exists(recording.path):
-                            try:
-                                os.remove(recording.path)
-                                logger.info(f"Deleted recording file: {recording.path}")
-                            except Exception as e:
-                                logger.error(f"Failed to delete recording file: {e}")
-                        
-                        # Delete database entry
-                        session.delete(recording)
-                    
-                    session.commit()
-                    logger.info(f"Deleted database entries for stream {stream_name}")
-                except Exception as e:
-                    session.rollback()
-                    logger.error(f"Error deleting database entries for stream {stream_id}: {e}")
-                finally:
-                    session.close()
+                # Delete recordings associated with this stream (files and entries, in batches)
+                deleted, freed = delete_recordings(stream_id=stream_id)
+                logger.info(f"Deleted {deleted} recordings ({freed / 1e9:.2f}GB) for stream {stream_name}")
             except Exception as e:
                 logger.error(f"Database error when deleting stream {stream_id}: {e}")
                 
@@ -1631,86 +4037,138 @@ def api_streams_status():
         roi_file = os.path.join(ROI_CONFIG_DIR, f"{stream_id}.json")
         has_rois = os.path.exists(roi_file)
         
+        # Detection cadence, if the stream has an active inference worker
+        inference = inference_workers.get(stream_url)
+        detection_status = inference.get_status() if inference and inference.is_alive() else None
+        if detection_status is not None and stream_url in stream_trackers:
+            detection_status['active_tracks'] = len(stream_trackers[stream_url])
+            # Where each tracked object is expected to be right now
+            detection_status['tracks'] = stream_trackers[stream_url].get_tracks(time.time())
+        
         status_data[stream_id] = {
             'connected': is_connected,
             'enabled': stream_info.get('enabled', True),
             'has_detections': has_detections,
             'detections': detections,
             'has_rois': has_rois,
+            'detection': detection_status,
+            'recording': recorders[stream_id].get_status() if stream_id in recorders else None,
             'last_updated': datetime.now().isoformat()
         }
     
     return jsonify(status_data)
 
+def hls_min_seconds(config):
+    """Shortest recording played as HLS, or None when HLS playback is off"""
+    if not config['recording'].get('hls_playback', False):
+        return None
+    return config['recording'].get('hls_min_seconds', 600)
+
+
+def recording_to_dict(recording, rec_path, hls_threshold=None, thumbnails=None):
+    """Playback API representation of a Recording row
+    
+    'hls' is the HLS playlist URL for recordings of at least hls_threshold
+    seconds (see hls_min_seconds()), otherwise None. 'thumbnails' is the
+    sprite layout from get_thumbnail_layouts() plus the sprite URL, if the
+    recording has one.
+    """
+    path = recording.path or ''
+    if path and os.path.isabs(path):
+        path = os.path.relpath(path, rec_path)
+    hls = None
+    if hls_threshold is not None and recording.duration and recording.duration >= hls_threshold:
+        hls = url_for('recording_hls', recording_id=recording.id, name='index.m3u8')
+    return {
+        'id': recording.id,
+        # Make sure path uses forward slashes for URL compatibility
+        'path': path.replace('\\', '/'),
+        'stream_id': recording.stream_id,
+        'camera': recording.camera_name,
+        'timestamp': recording.timestamp.isoformat(),
+        'date': recording.timestamp.strftime("%Y-%m-%d"),
+        'time': recording.timestamp.strftime("%H:%M:%S"),
+        'duration': recording.duration,
+        'size': recording.size_bytes,
+        'event_id': recording.event_id,
+        'tags': json.loads(recording.tags) if recording.tags else [],
+        'hls': hls,
+        'thumbnails': dict(thumbnails, sprite=url_for('recording_thumbnail_sprite', recording_id=recording.id))
+                      if thumbnails else None
+    }
+
+
+def encode_recordings_cursor(recording):
+    """Opaque pagination cursor pointing after the given recording"""
+    raw = f"{recording.timestamp.isoformat()}|{recording.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_recordings_cursor(cursor):
+    """Decode a cursor from encode_recordings_cursor() into (timestamp, id)
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, recording_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(recording_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+def parse_time_range(args):
+    """(start, end) from 'date' (YYYY-MM-DD) or 'start'/'end' (ISO datetime) query parameters
+    
+    Either bound is None when not given; end is exclusive.
+    
+    Raises:
+        ValueError: If a date or time is malformed
+    """
+    start = end = None
+    if args.get('date'):
+        start = datetime.strptime(args['date'], "%Y-%m-%d")
+        end = start + timedelta(days=1)
+    if args.get('start'):
+        start = datetime.fromisoformat(args['start'])
+    if args.get('end'):
+        end = datetime.fromisoformat(args['end'])
+    return start, end
+
+
+def resolve_stream_ids(cameras):
+    """Stream IDs of a list of stream IDs or camera names ('all' and blanks are skipped)"""
+    streams = load_stream_config()
+    names = {info.get('name', '').lower(): stream_id for stream_id, info in streams.items()}
+    return [camera if camera in streams else names.get(camera.lower(), camera)
+            for camera in cameras if camera and camera != 'all']
+
+
+def query_recordings_for_day(day, camera='all'):
+    """Recordings of one day from the index, filtered by stream ID (or camera name)"""
+    if camera == 'all' or not camera:
+        return get_recordings_for_day(day)
+    if camera in load_stream_config():
+        return get_recordings_for_day(day, stream_id=camera)
+    return get_recordings_for_day(day, camera_name=camera)
+
+
 @app.route('/playback')
 @login_required
 def playback():
     """Recording playback page"""
-    config = load_config()
-    rec_path = config["recording"]["path"]
-    
     # Add today's date for the datepicker default
     today_date = datetime.now().strftime("%Y-%m-%d")
     
     # Add streams data to fix the template error
     streams = load_stream_config()
     
-    # Get all recordings, organized by date
-    recordings = []
-    
-    if os.path.exists(rec_path):
-        # Get recordings from all subdirectories
-        for root, dirs, files in os.walk(rec_path):
-            for file in files:
-                if file.endswith('.mp4') or file.endswith('.avi') or file.endswith('.mkv'):
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(file_path, rec_path)
-                    file_mtime = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    
-                    # Extract camera name and timestamp from filename if possible
-                    camera_name = "Unknown"
-                    timestamp = file_mtime
-                    
-                    # Try to parse filename like "camera1_20230215_153045.mp4"
-                    match = re.match(r'(.+)_(\d{8})_(\d{6})\.(mp4|avi|mkv)', file)
-                    if match:
-                        camera_name = match.group(1).replace('_', ' ').title()
-                        try:
-                            date_str = match.group(2)
-                            time_str = match.group(3)
-                            timestamp = datetime.strptime(f"{date_str}_{time_str}", "%Y%m%d_%H%M%S")
-                        except ValueError:
-                            pass
-                    
-                    # Make sure rel_path uses forward slashes for URL compatibility
-                    rel_path = rel_path.replace('\\', '/')
-                    
-                    recordings.append({
-                        'path': rel_path,
-                        'camera': camera_name,
-                        'timestamp': timestamp.isoformat(),
-                        'date': timestamp.strftime("%Y-%m-%d"),
-                        'time': timestamp.strftime("%H:%M:%S"),
-                        'size': os.path.getsize(file_path)
-                    })
-    
-    # Group recordings by date
-    recordings_by_date = {}
-    for rec in recordings:
-        date = rec['date']
-        if date not in recordings_by_date:
-            recordings_by_date[date] = []
-        recordings_by_date[date].append(rec)
-    
-    # Sort each date's recordings by timestamp
-    for date in recordings_by_date:
-        recordings_by_date[date].sort(key=lambda x: x['timestamp'], reverse=True)
-    
-    # Sort dates
-    sorted_dates = sorted(recordings_by_date.keys(), reverse=True)
+    # Only the days with recordings are rendered; the page loads each day's
+    # recordings a page at a time from /api/recordings
+    sorted_dates = [day.strftime("%Y-%m-%d") for day in get_recording_dates()]
     
     return render_template('playback.html',
-                           recordings_by_date=recordings_by_date,
                            sorted_dates=sorted_dates,
                            streams=streams,
                            today_date=today_date)
@@ -1728,68 +4186,371 @@ def get_recordings_by_date():
         today = datetime.now().strftime('%Y-%m-%d')
         date = today
     
-    # Get camera filter if provided
-    camera_id = request.args.get('camera', 'all')
-    
-    # Get all recordings for the specified date
-    recordings = []
+    try:
+        day = datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "Invalid date, expected YYYY-MM-DD"}), 400
     
-    if os.path.exists(rec_path):
-        # Get recordings from all subdirectories
-        for root, dirs, files in os.walk(rec_path):
-            for file in files:
-                if file.endswith('.mp4'):
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(file_path, rec_path)
-                    file_mtime = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    
-                    # Extract camera name and timestamp from filename if possible
-                    camera_name = "Unknown"
-                    timestamp = file_mtime
-                    
-                    # Try to parse filename like "camera1_20230215_153045.mp4"
-                    match = re.match(r'(.+)_(\d{8})_(\d{6})\.mp4', file)
-                    if match:
-                        camera_name = match.group(1).replace('_', ' ').title()
-                        try:
-                            date_str = match.group(2)
-                            time_str = match.group(3)
-                            timestamp = datetime.strptime(f"{date_str}_{time_str}", "%Y%m%d_%H%M%S")
-                        except ValueError:
-                            pass
-                    
-                    # Check if recording matches the requested date
-                    recording_date = timestamp.strftime("%Y-%m-%d")
-                    if recording_date == date:
-                        # Add recording to list
-                        rec = {
-                            'path': rel_path,
-                            'camera': camera_name,
-                            'timestamp': timestamp.isoformat(),
-                            'date': recording_date,
-                            'time': timestamp.strftime("%H:%M:%S"),
-                            'size': os.path.getsize(file_path)
-                        }
-                        
-                        # Filter by camera if specified and not 'all'
-                        if camera_id == 'all' or camera_name.lower() == camera_id.lower():
-                            recordings.append(rec)
+    # Get camera filter if provided (a stream ID, or a camera name)
+    camera_id = request.args.get('camera', 'all')
     
-    # Sort recordings by timestamp (newest first)
-    recordings.sort(key=lambda x: x['timestamp'], reverse=True)
+    # Indexed (stream_id, timestamp) query, newest first
+    hls_threshold = hls_min_seconds(config)
+    rows = query_recordings_for_day(day, camera_id)
+    layouts = get_thumbnail_layouts(rec.id for rec in rows)
+    recordings = [recording_to_dict(rec, rec_path, hls_threshold, layouts.get(rec.id)) for rec in rows]
     
     return jsonify({
         'date': date,
         'recordings': recordings
     })
 
+@app.route('/api/recordings')
+@login_required
+def api_recordings():
+    """Keyset-paginated recordings, newest first
+    
+    Query parameters:
+        camera: Stream ID or camera name ('all' or omitted for every camera)
+        date: A day (YYYY-MM-DD), or
+        start, end: ISO datetimes bounding the time range (end exclusive)
+        limit: Page size (default RECORDINGS_PAGE_SIZE)
+        cursor: next_cursor from the previous page
+    """
+    config = load_config()
+    rec_path = config["recording"]["path"]
+    
+    try:
+        start, end = parse_time_range(request.args)
+        before = None
+        if request.args.get('cursor'):
+            before = decode_recordings_cursor(request.args['cursor'])
+        limit = min(max(int(request.args.get('limit', RECORDINGS_PAGE_SIZE)), 1), RECORDINGS_PAGE_MAX)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    camera = request.args.get('camera', 'all')
+    stream_id = camera_name = None
+    if camera and camera != 'all':
+        if camera in load_stream_config():
+            stream_id = camera
+        else:
+            camera_name = camera
+    
+    recordings, has_more = get_recordings_page(stream_id=stream_id, camera_name=camera_name,
+                                               start=start, end=end, before=before, limit=limit)
+    layouts = get_thumbnail_layouts(rec.id for rec in recordings)
+    return jsonify({
+        'recordings': [recording_to_dict(rec, rec_path, hls_min_seconds(config), layouts.get(rec.id))
+                       for rec in recordings],
+        'next_cursor': encode_recordings_cursor(recordings[-1]) if has_more else None
+    })
+
+@app.route('/api/export')
+@login_required
+def export_recordings():
+    """Download the recordings of a time range as a zip archive, streamed as it is built
+    
+    Query parameters:
+        date, or start and end: The time range (see parse_time_range)
+        camera: Stream ID or camera name, may be repeated ('all' or omitted for every camera)
+    """
+    try:
+        start, end = parse_time_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if start is None or end is None:
+        return jsonify({"error": "Give a date, or a start and an end"}), 400
+    
+    stream_ids = resolve_stream_ids(request.args.getlist('camera'))
+    
+    # The export range is inclusive
+    recordings = get_export_recordings(start, end - timedelta(microseconds=1), stream_ids or None)
+    if not recordings:
+        return jsonify({"error": "No recordings in this time range"}), 404
+    
+    filename = f"smartnvr_export_{start.strftime('%Y%m%d_%H%M%S')}_{end.strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(iter_export_zip(recordings, start, end), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/api/exports', methods=['GET'])
+@login_required
+def api_export_jobs():
+    """Status of the most recent export jobs"""
+    return jsonify({"jobs": [job.to_dict() for job in list_export_jobs()]})
+
+@app.route('/api/exports', methods=['POST'])
+@login_required
+def api_create_export_job():
+    """Queue a background export of a time range of recordings
+    
+    JSON or form fields:
+        date, or start and end: The time range (see parse_time_range)
+        camera: Stream ID or camera name, or a list of them (omitted or 'all' for every camera)
+        format: 'zip' (default) or 'directory'
+    """
+    data = request.get_json(silent=True) or request.form
+    try:
+        start, end = parse_time_range(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if start is None or end is None:
+        return jsonify({"error": "Give a date, or a start and an end"}), 400
+    if end <= start:
+        return jsonify({"error": "The end must be after the start"}), 400
+    
+    cameras = data.get('camera') if request.is_json else data.getlist('camera')
+    if isinstance(cameras, str):
+        cameras = [cameras]
+    export_format = data.get('format') or 'zip'
+    if export_format not in ('zip', 'directory'):
+        return jsonify({"error": f"Unsupported export format: {export_format}"}), 400
+    
+    try:
+        job = create_export_job(start, end - timedelta(microseconds=1), export_settings()['path'],
+                                resolve_stream_ids(cameras or []) or None, export_format)
+    except Exception as e:
+        logger.error(f"Failed to queue export: {e}")
+        return jsonify({"error": "Could not queue the export"}), 500
+    if job is None:
+        return jsonify({"error": "No recordings in this time range"}), 404
+    
+    export_worker.wake()
+    return jsonify(job), 202
+
+@app.route('/api/exports/<job_id>')
+@login_required
+def api_export_job(job_id):
+    """Status and progress (files and bytes) of an export job"""
+    job = get_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Export job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/exports/<job_id>/cancel', methods=['POST'])
+@login_required
+def api_cancel_export_job(job_id):
+    """Cancel a queued or running export job; a running job keeps its partial output for resuming"""
+    job = cancel_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Export job not found"}), 404
+    if job['status'] not in (ExportJob.CANCELLED, ExportJob.RUNNING):
+        return jsonify({"error": f"Export job is {job['status']}", "job": job}), 409
+    return jsonify(job)
+
+@app.route('/api/exports/<job_id>/resume', methods=['POST'])
+@login_required
+def api_resume_export_job(job_id):
+    """Queue a cancelled or failed export job again, continuing after the recordings it already copied"""
+    job = resume_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Export job not found"}), 404
+    if job['status'] != ExportJob.QUEUED:
+        return jsonify({"error": f"Export job is {job['status']}", "job": job}), 409
+    export_worker.wake()
+    return jsonify(job)
+
+@app.route('/api/exports/<job_id>', methods=['DELETE'])
+@login_required
+def api_delete_export_job(job_id):
+    """Delete an export job and its output (cancel it first if it is running)"""
+    job = delete_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Export job not found"}), 404
+    if job['status'] == ExportJob.RUNNING:
+        return jsonify({"error": "Export job is running, cancel it first", "job": job}), 409
+    return jsonify({"status": "deleted", "job": job})
+
+@app.route('/api/exports/<job_id>/download')
+@login_required
+def api_download_export(job_id):
+    """Download the archive of a completed zip export job"""
+    job = get_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Export job not found"}), 404
+    if job.status != ExportJob.COMPLETED or job.format != 'zip':
+        return jsonify({"error": "Only completed zip exports can be downloaded"}), 409
+    if not os.path.isfile(job.output_path):
+        return jsonify({"error": "Export file not found"}), 404
+    return send_file(job.output_path, mimetype='application/zip', as_attachment=True,
+                     download_name=os.path.basename(job.output_path), conditional=True)
+
+@app.route('/api/recordings/<int:recording_id>/thumbnails')
+@login_required
+def recording_thumbnails(recording_id):
+    """Sprite sheet layout of a recording: tile size, grid and the time of each tile"""
+    layout = get_thumbnail_layouts([recording_id]).get(recording_id)
+    if layout is None:
+        return jsonify({"error": "No thumbnails for this recording (yet)"}), 404
+    layout['sprite'] = url_for('recording_thumbnail_sprite', recording_id=recording_id)
+    return jsonify(layout)
+
+@app.route('/api/recordings/<int:recording_id>/thumbnails.jpg')
+@login_required
+def recording_thumbnail_sprite(recording_id):
+    """Sprite sheet JPEG of a recording"""
+    sprite = get_thumbnail_sprite(recording_id)
+    if sprite is None:
+        abort(404)
+    data, created_at = sprite
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(f"{recording_id}-{int(created_at.timestamp())}" if created_at else str(recording_id))
+    response.cache_control.private = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
 @app.route('/recordings/<path:filename>')
 @login_required
 def recording_file(filename):
-    """Serve a recording file"""
+    """Serve a recording file
+    
+    Range requests (seeking) and conditional requests (ETag/Last-Modified)
+    are answered without sending the whole file. With recording.accel_redirect
+    set, only the headers are sent and the reverse proxy streams the file
+    itself with sendfile. Recordings whose file is gone but whose content is
+    stored in the database are streamed from there.
+    """
     config = load_config()
     rec_path = config["recording"]["path"]
-    return send_from_directory(rec_path, filename)
+    path = safe_join(rec_path, filename)
+    if path is None:
+        abort(404)
+    mimetype = RECORDING_MIMETYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+    
+    if not os.path.isfile(path):
+        recording = get_recording_by_path(path)
+        if recording is None or not recording.has_content:
+            abort(404)
+        return send_recording_content(recording, mimetype)
+    
+    accel_redirect = config['recording'].get('accel_redirect', '')
+    if accel_redirect:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_redirect.rstrip('/') + '/' + quote(filename)
+        return response
+    
+    return send_file(path, mimetype=mimetype, conditional=True, etag=True)
+
+def send_recording_content(recording, mimetype):
+    """Stream a recording's content from the database, honouring Range and ETag"""
+    size = recording.size_bytes or 0
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(f"recording-{recording.id}-{size}")
+    response.last_modified = recording.timestamp
+    response.accept_ranges = 'bytes'
+    
+    if request.if_none_match.contains(f"recording-{recording.id}-{size}"):
+        response.status_code = 304
+        return response
+    
+    start, end = 0, size
+    byte_range = request.range.range_for_length(size) if request.range else None
+    if request.range and byte_range is None:
+        response.status_code = 416
+        response.headers['Content-Range'] = f"bytes */{size}"
+        return response
+    if byte_range:
+        start, end = byte_range
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, end, size)
+    
+    response.response = iter_recording_content(recording.id, start, end)
+    response.content_length = end - start
+    return response
+
+def prune_hls_cache(max_gb, keep=None):
+    """Remove the least recently played HLS packages until the cache fits max_gb"""
+    packages = []
+    for entry in os.scandir(HLS_CACHE_DIR):
+        if not entry.is_dir() or entry.name.endswith('.tmp') or entry.path == keep:
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        packages.append((entry.stat().st_mtime, size, entry.path))
+    
+    total = sum(size for _, size, _ in packages)
+    if keep and os.path.isdir(keep):
+        total += sum(f.stat().st_size for f in os.scandir(keep) if f.is_file())
+    
+    for _, size, package_dir in sorted(packages):
+        if total <= max_gb * 1e9:
+            break
+        shutil.rmtree(package_dir, ignore_errors=True)
+        total -= size
+
+def build_hls_package(recording):
+    """Remux a recording into a fragmented-MP4 HLS package, once
+    
+    The package (index.m3u8, init.mp4 and HLS_FRAGMENT_SECONDS fragments) is
+    written to HLS_CACHE_DIR/<recording id>/ with a stream copy, so the
+    player fetches only the fragments around the playback position. Packages
+    are rebuilt if the recording file is newer.
+    
+    Returns:
+        The package directory, or None if ffmpeg failed
+    """
+    package_dir = os.path.join(HLS_CACHE_DIR, str(recording.id))
+    playlist = os.path.join(package_dir, 'index.m3u8')
+    
+    with hls_build_locks_lock:
+        lock = hls_build_locks.setdefault(recording.id, threading.Lock())
+    
+    with lock:
+        if os.path.exists(playlist) and os.path.getmtime(playlist) >= os.path.getmtime(recording.path):
+            os.utime(package_dir)  # Mark as recently played for cache eviction
+            return package_dir
+        
+        build_dir = package_dir + '.tmp'
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(build_dir)
+        command = [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error',
+                   '-i', recording.path, '-map', '0', '-c', 'copy',
+                   '-f', 'hls',
+                   '-hls_time', str(HLS_FRAGMENT_SECONDS),
+                   '-hls_playlist_type', 'vod',
+                   '-hls_segment_type', 'fmp4',
+                   '-hls_fmp4_init_filename', 'init.mp4',
+                   '-hls_segment_filename', os.path.join(build_dir, 'fragment_%05d.m4s'),
+                   os.path.join(build_dir, 'index.m3u8')]
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=HLS_BUILD_TIMEOUT)
+            error = result.stderr.decode(errors='replace').strip() if result.returncode != 0 else None
+        except (OSError, subprocess.TimeoutExpired) as e:
+            error = str(e)
+        
+        if error is not None:
+            logger.error(f"Could not build HLS package for recording {recording.id}: {error}")
+            shutil.rmtree(build_dir, ignore_errors=True)
+            return None
+        
+        shutil.rmtree(package_dir, ignore_errors=True)
+        os.rename(build_dir, package_dir)
+    
+    prune_hls_cache(load_config()['recording'].get('hls_cache_gb', 2), keep=package_dir)
+    return package_dir
+
+@app.route('/recordings/hls/<int:recording_id>/<name>')
+@login_required
+def recording_hls(recording_id, name):
+    """Serve the HLS playlist or a fragment of a recording
+    
+    Requesting the playlist builds the package on first use.
+    """
+    config = load_config()
+    if not config['recording'].get('hls_playback', False):
+        abort(404)
+    
+    if name == 'index.m3u8':
+        recording = get_recording(recording_id)
+        if recording is None or not recording.path or not os.path.isfile(recording.path):
+            abort(404)
+        package_dir = build_hls_package(recording)
+        if package_dir is None:
+            return jsonify({"error": "Could not prepare recording for streaming"}), 500
+    else:
+        package_dir = os.path.join(HLS_CACHE_DIR, str(recording_id))
+    
+    mimetype = HLS_MIMETYPES.get(os.path.splitext(name)[1].lower(), 'application/octet-stream')
+    return send_from_directory(package_dir, name, mimetype=mimetype, conditional=True)
 
 @app.route('/roi/<stream_id>')
 @login_required
@@ -1853,6 +4614,9 @@ def save_roi(stream_id):
         with open(roi_file, 'w') as f:
             json.dump(data, f, indent=4)
         
+        # Rebuild the rasterized masks from the new polygons on next use
+        invalidate_roi_masks(stream_id)
+        
         # Send ROIs to AI server if enabled
         config = load_config()
         if config['ai_server']['enabled']:
@@ -1862,7 +4626,7 @@ def save_roi(stream_id):
                 'rois': data
             }
             
-            success, response = call_ai_server(
+            success, response = ai_client.request(
                 endpoint="roi", 
                 method="post", 
                 json_data=roi_data, 
@@ -1975,10 +4739,24 @@ if __name__ == '__main__':
     # Initialize database
     init_db()
     
+    # Register recordings made before the recording index existed (runs once)
+    start_recording_index_backfill(load_config()['recording']['path'])
+    
+    # Keep the AI server health status fresh in the background
+    ai_client.start_health_prober()
+    
     # Start the scheduled tasks thread (only once)
     task_thread = threading.Thread(target=run_scheduled_tasks)
     task_thread.daemon = True
     task_thread.start()
     
+    # With the debug reloader the parent process only watches files; recording
+    # there as well would run a second ffmpeg per camera
+    debug = True
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        sync_recorders()
+        thumbnail_worker.start()
+        export_worker.start()
+    
     # Run the Flask application
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
+    app.run(host='0.0.0.0', port=5000, debug=debug, threaded=True)